@@ -0,0 +1,483 @@
+# Replays recorded market data to try out triangle strategies on it, much faster than it happened.
+# Websocket messages recorded by bookmirror.WebsocketFeed (level2 snapshots and updates, and matches) are converted once
+# into an events file: a NumPy structured array with one fixed-width record per book level change or match, which
+# runs memory-map instead of reading (like fillcache.py). A JSON file beside it has the products.
+# The feed only sends a book's snapshot when subscribing, so the converter adds a snapshot of every book at the end of
+# each day (UTC). A run of one day then only has to replay those to have the books as the day starts.
+# A replay rebuilds the books with a bookmirror.OrderBookMirror, which a MarketInfo of the recorded products uses as its
+# book mirror, so strategies can use coinutil's helpers and trianglescanner as they would live.
+# Strategies are evaluated every interval seconds of simulated time. Runs can be split across processes by day or by
+# groups of products.
+#
+# python backtest.py convert messages.jsonl.gz events.npy
+# python backtest.py run events.npy --split day --workers 4
+# python backtest.py run events.npy --split products --groups BTC-USD,ETH-USD,ETH-BTC --groups LTC-USD,LTC-BTC
+import argparse
+import array
+import concurrent.futures
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+import bookmirror
+import coinutil
+import trianglescanner
+
+logger = logging.getLogger(__name__)
+
+# Kinds of events
+RESET = 0  # a product's book is replaced by a snapshot, whose levels follow
+BID = 1  # a bid level's size (0 removes it)
+ASK = 2  # an ask level's size
+MATCH = 3  # a trade, side is the maker's side
+
+EVENT_DTYPE = np.dtype(
+    [
+        ("time", "<f8"),
+        ("product", "<i2"),
+        ("kind", "i1"),
+        ("side", "i1"),  # 0 buy, 1 sell, for matches
+        ("price", "<f8"),
+        ("size", "<f8"),
+    ]
+)
+
+# Events are replayed this many at a time
+CHUNK_EVENTS = 65536
+
+DAY = 86400
+
+
+def metaPath(eventspath):
+    return eventspath + ".json"
+
+
+def productInfo(pid):
+    # Product details for a product that wasn't recorded with them, enough for MarketInfo and the limit helpers
+    base, quote = pid.split("-")
+    return {
+        "id": pid,
+        "base_currency": base,
+        "quote_currency": quote,
+        "base_increment": "0.00000001",
+        "quote_increment": "0.01" if quote in ("USD", "USDC", "EUR", "GBP") else "0.00000001",
+        "post_only": False,
+        "limit_only": False,
+        "cancel_only": False,
+        "trading_disabled": False,
+        "status": "online",
+    }
+
+
+def convertMessages(messagespaths, eventspath, products=None):
+    """
+    Converts files of recorded level2 and match messages (see bookmirror.WebsocketFeed's recordpath) into an events
+    file at eventspath, sorted by time.
+    products is the list of product details (as from get_products) to keep with the events for MarketInfo; those of
+    products without details are made up (see productInfo).
+    Snapshots have no time of their own, and get that of the message before them (or after, at the start).
+    Snapshots of every book are added at the end of each day (see addDaySnapshots).
+    Returns the number of events.
+    """
+    if isinstance(messagespaths, str):
+        messagespaths = [messagespaths]
+    codes = {}
+    columns = {name: array.array(code) for name, code in (
+        ("time", "d"), ("product", "h"), ("kind", "b"), ("side", "b"), ("price", "d"), ("size", "d")
+    )}
+
+    def add(t, pid, kind, side, price, size):
+        if not pid in codes:
+            codes[pid] = len(codes)
+        columns["time"].append(t)
+        columns["product"].append(codes[pid])
+        columns["kind"].append(kind)
+        columns["side"].append(side)
+        columns["price"].append(price)
+        columns["size"].append(size)
+
+    nan = float("nan")
+    for path in messagespaths:
+        lasttime = nan
+        with bookmirror.openMessages(path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                kind = message.get("type")
+                pid = message.get("product_id")
+                if "time" in message:
+                    lasttime = bookmirror.parseTime(message["time"])
+                if kind == "snapshot":
+                    add(lasttime, pid, RESET, 0, 0.0, 0.0)
+                    for price, size in message["bids"]:
+                        add(lasttime, pid, BID, 0, float(price), float(size))
+                    for price, size in message["asks"]:
+                        add(lasttime, pid, ASK, 1, float(price), float(size))
+                elif kind == "l2update":
+                    for side, price, size in message["changes"]:
+                        add(lasttime, pid, BID if side == "buy" else ASK, 0 if side == "buy" else 1, float(price), float(size))
+                elif kind == "match":
+                    side = 0 if message["side"] == "buy" else 1
+                    add(lasttime, pid, MATCH, side, float(message["price"]), float(message["size"]))
+    events = np.empty(len(columns["time"]), dtype=EVENT_DTYPE)
+    for name, column in columns.items():
+        events[name] = np.frombuffer(column, dtype=column.typecode) if len(column) else []
+    # snapshots before the first timed message take its time
+    times = events["time"]
+    timed = np.flatnonzero(~np.isnan(times))
+    if len(timed):
+        times[: timed[0]] = times[timed[0]]
+    events = addDaySnapshots(events[np.argsort(times, kind="stable")])
+    with open(eventspath + ".tmp", "wb") as f:
+        np.save(f, events)
+    os.replace(eventspath + ".tmp", eventspath)
+    details = {p["id"]: p for p in products or []}
+    productids = sorted(codes, key=codes.get)
+    meta = {
+        "products": productids,
+        "productinfo": [details.get(pid, productInfo(pid)) for pid in productids],
+        "events": len(events),
+        "start": float(events["time"][0]) if len(events) else None,
+        "end": float(events["time"][-1]) if len(events) else None,
+    }
+    with open(metaPath(eventspath) + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(metaPath(eventspath) + ".tmp", metaPath(eventspath))
+    logger.info("Converted %s events of %s products to %s", len(events), len(productids), eventspath)
+    return len(events)
+
+
+def bookEvents(t, code, bids, asks):
+    # A snapshot of a book of price to size dicts as events: a RESET and its levels, best first
+    events = np.zeros(1 + len(bids) + len(asks), dtype=EVENT_DTYPE)
+    events["time"] = t
+    events["product"] = code
+    events["kind"][0] = RESET
+    n = 1
+    for kind, side, levels in ((BID, 0, sorted(bids.items(), reverse=True)), (ASK, 1, sorted(asks.items()))):
+        if levels:
+            events["kind"][n : n + len(levels)] = kind
+            events["side"][n : n + len(levels)] = side
+            events["price"][n : n + len(levels)] = [price for price, size in levels]
+            events["size"][n : n + len(levels)] = [size for price, size in levels]
+            n += len(levels)
+    return events
+
+
+def addDaySnapshots(events):
+    """
+    Adds a snapshot of every book that has had one (the RESET and levels of the book as it is then) before the first
+    event of each day (UTC), timed just before the day starts, so that a day's books can be had from them without
+    replaying the days before (see dayTasks).
+    The books are rebuilt here by going through the events in order, as Replay does.
+    """
+    times = events["time"]
+    if len(times) == 0:
+        return events
+    days = np.floor(times / DAY).astype(np.int64)
+    newdays = (np.flatnonzero(np.diff(days)) + 1).tolist()
+    if not newdays:
+        return events
+    books = {}  # product code -> (bids, asks), dicts of price to size
+    pieces = []
+    start = 0
+    for end in newdays:
+        chunk = events[start:end]
+        for code, kind, price, size in zip(
+            chunk["product"].tolist(), chunk["kind"].tolist(), chunk["price"].tolist(), chunk["size"].tolist()
+        ):
+            if kind == RESET:
+                books[code] = ({}, {})
+            elif (kind == BID or kind == ASK) and code in books:
+                levels = books[code][0 if kind == BID else 1]
+                if size == 0.0:
+                    levels.pop(price, None)
+                else:
+                    levels[price] = size
+        pieces.append(chunk)
+        t = float(np.nextafter(days[end] * float(DAY), -np.inf))
+        for code in sorted(books):
+            pieces.append(bookEvents(t, code, *books[code]))
+        start = end
+    pieces.append(events[start:])
+    return np.concatenate(pieces)
+
+
+def loadEvents(eventspath):
+    # The events, memory-mapped, and the products they are of
+    with open(metaPath(eventspath)) as f:
+        meta = json.load(f)
+    return np.load(eventspath, mmap_mode="r"), meta
+
+
+class RecordedProducts:
+    # Stands in for the public client for MarketInfo, with the recorded products. There are no books but the mirror's.
+    def __init__(self, products):
+        self.products = products
+
+    def get_products(self):
+        return [dict(p) for p in self.products]
+
+    def get_product_order_book(self, product_id, level=1):
+        raise Exception("No book for {0} in the replay yet".format(product_id))
+
+
+class Replay:
+    """
+    Replays events (a slice of an events file) of productids, rebuilding their books in mirror.
+    Every interval seconds of simulated time, strategies are evaluated with evaluate(replay), against the books as they
+    were at that time. Strategies can also have onMatch(replay, pid, side, price, size), called for each match.
+    Events before evaluatefrom (a time) only bring the books up to date ("warm up"), without evaluating.
+    mi is a MarketInfo of the products, with the mirror as its book mirror, and time the simulated time.
+    """
+    def __init__(self, events, meta, strategies, interval=1.0, evaluatefrom=None):
+        self.events = events
+        self.productids = meta["products"]
+        self.strategies = strategies
+        self.interval = interval
+        self.evaluatefrom = evaluatefrom
+        self.mirror = bookmirror.OrderBookMirror(self.productids)
+        self.mi = coinutil.MarketInfo(RecordedProducts(meta["productinfo"]), None)
+        self.mi.bookmirror = self.mirror
+        self.time = None
+        self.evaluations = 0
+
+    def evaluate(self):
+        self.evaluations += 1
+        for strategy in self.strategies:
+            strategy.evaluate(self)
+
+    def run(self):
+        # Replays every event. Returns the number of events and the simulated seconds evaluated.
+        mirror = self.mirror
+        productids = self.productids
+        matchers = [s for s in self.strategies if hasattr(s, "onMatch")]
+        nextevaluation = None
+        first = None
+        t = None
+        for i in range(0, len(self.events), CHUNK_EVENTS):
+            for t, product, kind, side, price, size in self.events[i : i + CHUNK_EVENTS].tolist():
+                evaluating = self.evaluatefrom is None or t >= self.evaluatefrom
+                if evaluating:
+                    if nextevaluation is None:
+                        first = t
+                        nextevaluation = t
+                    if t >= nextevaluation:
+                        # the books as they were just before this event
+                        self.time = t
+                        self.evaluate()
+                        nextevaluation = t - (t - first) % self.interval + self.interval
+                pid = productids[product]
+                if kind == RESET:
+                    mirror.clearBook(pid)
+                elif kind == BID or kind == ASK:
+                    mirror.setLevel(pid, kind == BID, price, size)
+                elif matchers and evaluating:
+                    self.time = t
+                    for strategy in matchers:
+                        strategy.onMatch(self, pid, side, price, size)
+        return len(self.events), (t - first) if first is not None else 0.0
+
+
+class TriangleStrategy:
+    """
+    Looks for triangles that would have returned more than threshold (a fraction, after fees) at any of sizes, at each
+    evaluation, using trianglescanner.TriangleScanner on the replayed books.
+    For the best one each time, also works out the limit order for its first leg (see coinutil.getBestLimitBuyInfo).
+    result() has the number of evaluations and of opportunities, the best return seen, the estimated profit
+    (return times size, summed), and the opportunities by triangle.
+    """
+    def __init__(self, sizes=trianglescanner.DEFAULT_SIZES, fee=trianglescanner.DEFAULT_TAKER_FEE, threshold=0.0):
+        self.sizes = sizes
+        self.fee = fee
+        self.threshold = threshold
+        self.scanner = None
+        self.evaluations = 0
+        self.opportunities = 0
+        self.bestreturn = None
+        self.profit = 0.0
+        self.bytriangle = {}
+        self.limitorders = 0
+
+    def evaluate(self, replay):
+        if self.scanner is None:
+            self.scanner = trianglescanner.TriangleScanner(replay.mi, self.sizes, self.fee, workers=1)
+        self.evaluations += 1
+        books = {}
+        for pid in replay.productids:
+            snapshot = replay.mirror.snapshot(pid)
+            if snapshot is not None and len(snapshot.bidprices) and len(snapshot.askprices):
+                books[pid] = snapshot
+        result = self.scanner.scan(books)
+        ranked = [r for r in result["ranked"] if not np.isnan(r["bestreturn"])]
+        if not ranked:
+            return
+        best = ranked[0]
+        if self.bestreturn is None or best["bestreturn"] > self.bestreturn:
+            self.bestreturn = best["bestreturn"]
+        if best["bestreturn"] <= self.threshold:
+            return
+        for r in ranked:
+            if r["bestreturn"] <= self.threshold:
+                break
+            self.opportunities += 1
+            self.profit += r["bestreturn"] * r["bestsize"]
+            self.bytriangle[r["chain"]] = self.bytriangle.get(r["chain"], 0) + 1
+        # the first leg is traded first, it is the last in the triangle (see trianglescanner.py)
+        pa = best["triangle"].tri[2]
+        book = books[pa.trueid]
+        if pa.action == "buy":
+            coinutil.getBestLimitBuyInfo(replay.mi, pa.trueid, best["bestsize"], book)
+        else:
+            coinutil.getBestLimitSellInfo(replay.mi, pa.trueid, best["bestsize"] / book.bestbid, book)
+        self.limitorders += 1
+
+    def result(self):
+        return {
+            "evaluations": self.evaluations,
+            "opportunities": self.opportunities,
+            "bestreturn": self.bestreturn,
+            "profit": self.profit,
+            "limitorders": self.limitorders,
+            "bytriangle": self.bytriangle,
+        }
+
+
+def warmupStart(events, start, codes):
+    # Where replaying has to start for the books of the products (codes) to be whole at event start: the last snapshot
+    # of each before it, which is the one added at the end of the day before (see addDaySnapshots)
+    resets = np.flatnonzero(events["kind"][:start] == RESET)
+    first = start
+    for code in codes:
+        mine = resets[events["product"][resets] == code]
+        if len(mine):
+            first = min(first, int(mine[-1]))
+    return first
+
+
+def dayTasks(eventspath):
+    """
+    One task per day (UTC) of the events: (start, end, evaluatefrom, None), where replaying starts at start to warm up
+    the books, and evaluation begins at evaluatefrom, the start of the day.
+    """
+    events, meta = loadEvents(eventspath)
+    times = events["time"]
+    if len(times) == 0:
+        return []
+    codes = range(len(meta["products"]))
+    tasks = []
+    for day in range(int(times[0] // DAY), int(times[-1] // DAY) + 1):
+        start = int(np.searchsorted(times, day * DAY))
+        end = int(np.searchsorted(times, (day + 1) * DAY))
+        if end > start:
+            tasks.append((warmupStart(events, start, codes), end, float(day * DAY), None))
+    return tasks
+
+
+def runTask(eventspath, task, strategyfactory, interval):
+    """
+    Replays one task in this process: (start, end, evaluatefrom, productids), where productids (None for all) are
+    the products to replay.
+    Returns the result of the strategy made by strategyfactory, and how long it took.
+    """
+    t = time.perf_counter()
+    start, end, evaluatefrom, productids = task
+    events, meta = loadEvents(eventspath)
+    events = events[start:end]
+    if productids is not None:
+        codes = [meta["products"].index(pid) for pid in productids]
+        events = events[np.isin(events["product"], codes)]
+        # codes stay those of the whole file, so the mirror has every product, but only these get events
+    strategy = strategyfactory()
+    replay = Replay(events, meta, [strategy], interval, evaluatefrom)
+    nevents, simulated = replay.run()
+    seconds = time.perf_counter() - t
+    return {
+        "start": start,
+        "end": end,
+        "productids": productids,
+        "events": nevents,
+        "evaluations": replay.evaluations,
+        "simulatedseconds": simulated,
+        "seconds": seconds,
+        "speedup": simulated / seconds if seconds > 0 else None,
+        "result": strategy.result(),
+    }
+
+
+def runBacktest(eventspath, strategyfactory=TriangleStrategy, split="day", groups=None, interval=1.0, workers=None):
+    """
+    Replays an events file through a strategy made by strategyfactory for each task (in the worker process, so
+    strategyfactory must be picklable, eg a class), in a pool of workers processes.
+    split "day" makes a task per day, "products" a task per group of product ids in groups (whole triangles should be
+    in one group), and None one task for everything.
+    Returns the tasks' reports, in order (see runTask).
+    """
+    if split == "day":
+        tasks = dayTasks(eventspath)
+    elif split == "products":
+        if not groups:
+            raise Exception("Splitting by products needs the groups of products")
+        events, meta = loadEvents(eventspath)
+        tasks = [(0, len(events), None, list(group)) for group in groups]
+    else:
+        events, meta = loadEvents(eventspath)
+        tasks = [(0, len(events), None, None)]
+    logger.info("Replaying %s in %s tasks", eventspath, len(tasks))
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            pool.submit(runTask, eventspath, task, strategyfactory, interval) for task in tasks
+        ]
+        reports = []
+        for future in futures:
+            report = future.result()
+            logger.info(
+                "Replayed %s events (%.0f simulated seconds) in %.2fs",
+                report["events"],
+                report["simulatedseconds"],
+                report["seconds"],
+            )
+            reports.append(report)
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded market data through triangle strategies.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert = commands.add_parser("convert", help="convert recorded websocket messages to an events file")
+    convert.add_argument("messages", nargs="+")
+    convert.add_argument("events")
+    run = commands.add_parser("run", help="replay an events file")
+    run.add_argument("events")
+    run.add_argument("--split", choices=["day", "products", "none"], default="day")
+    run.add_argument(
+        "--groups",
+        action="append",
+        default=None,
+        help="comma-separated product ids replayed together, for --split products (give it once per group)",
+    )
+    run.add_argument("--interval", type=float, default=1.0, help="simulated seconds between evaluations")
+    run.add_argument("--workers", type=int, default=None)
+    run.add_argument("--output", default=None, help="json file to write the reports to")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if args.command == "convert":
+        convertMessages(args.messages, args.events)
+    else:
+        reports = runBacktest(
+            args.events,
+            split=None if args.split == "none" else args.split,
+            groups=[group.split(",") for group in args.groups or []],
+            interval=args.interval,
+            workers=args.workers,
+        )
+        text = json.dumps(reports, indent=2)
+        if args.output is not None:
+            with open(args.output, "w") as f:
+                f.write(text)
+        else:
+            print(text)
@@ -0,0 +1,221 @@
+# Runs CryptoTax for many accounts at once, each in its own process.
+# All the processes share one candle cache file and one API rate limiter, so prices fetched for one account are
+# there for the others, and together they never make more requests than the API allows.
+#
+# The manifest is a csv with columns account, fillspath and outputpath, one account per row.
+# Several fills files for one account (see cryptotax.mergeFills) can be given in fillspath, separated by ";".
+#
+# python batchtaxes.py manifest.csv --report batchreport.csv
+import argparse
+import concurrent.futures
+import csv
+import logging
+import os
+import time
+
+import candlecache
+import cryptotax
+import transactionsinks
+
+logger = logging.getLogger(__name__)
+
+# The rate limiter shared by the processes, set by initWorker when each worker process starts
+workerlimiter = None
+
+
+def readManifest(manifestpath):
+    """
+    Returns a list of (account, fillspaths, outputpath) from the manifest csv.
+    fillspaths is a single path, or a list if the row has several.
+    """
+    accounts = []
+    with open(manifestpath, newline="", encoding="utf-8-sig") as f:
+        for row in csv.DictReader(f):
+            fillspaths = [p.strip() for p in row["fillspath"].split(";") if p.strip()]
+            if len(fillspaths) == 1:
+                fillspaths = fillspaths[0]
+            accounts.append((row["account"], fillspaths, row["outputpath"]))
+    return accounts
+
+
+def initWorker(limiter, loglevel):
+    global workerlimiter
+    workerlimiter = limiter
+    logging.basicConfig(level=loglevel, format="%(processName)s %(message)s")
+
+
+def runAccount(account, fillspaths, outputpath, candlecachepath, offline, fixedpoint):
+    """
+    Does one account, the same as exampletaxes.py, in a worker process.
+    Returns a dict of results for the report. A failure (eg, "Could not find good historical price") is returned as
+    ok False with the error, instead of raised, so the other accounts carry on.
+    The transactions are written to outputpath + ".tmp", which is moved to outputpath only if the account succeeds, so
+    a failed account leaves no partial output.
+    """
+    t = time.perf_counter()
+    result = {
+        "account": account,
+        "ok": False,
+        "error": "",
+        "fills": 0,
+        "transactions": 0,
+        "apicalls": 0,
+        "seconds": 0.0,
+        "fillspersecond": 0.0,
+    }
+    ct = None
+    writer = None
+    temppath = outputpath + ".tmp"
+    try:
+        historicratesclient = None
+        if not offline:
+            import priceclient
+
+            historicratesclient = priceclient.HistoricRatesClient(limiter=workerlimiter)
+        # Transactions are written as they are made, instead of kept in memory
+        writer = transactionsinks.Form8949Writer(temppath, fixedpoint)
+        ct = cryptotax.CryptoTax(
+            candlecachepath=candlecachepath,
+            historicratesclient=historicratesclient,
+            offline=offline,
+            fixedpoint=fixedpoint,
+            sinks=[writer],
+        )
+        plan = ct.planPriceFetches(fillspaths)
+        ct.fetchPlannedPrices(plan)
+        ct.readFills(fillspaths)
+        result["ok"] = True
+    except Exception as e:
+        logger.exception("Account %s failed", account)
+        result["error"] = "{0}: {1}".format(type(e).__name__, e)
+    finally:
+        if ct is not None:
+            result["fills"] = ct.fillcount
+            result["transactions"] = ct.transactioncount
+            if ct._historicratesclient is not None:
+                result["apicalls"] = ct._historicratesclient.apicalls
+            ct.closeSinks()
+            ct.candlecache.close()
+        elif writer is not None:
+            writer.close()
+        if result["ok"]:
+            os.replace(temppath, outputpath)
+        elif os.path.exists(temppath):
+            os.remove(temppath)
+    result["seconds"] = time.perf_counter() - t
+    if result["seconds"] > 0:
+        result["fillspersecond"] = result["fills"] / result["seconds"]
+    return result
+
+
+def runBatch(
+    manifestpath,
+    candlecachepath="candlecache.sqlite",
+    workers=None,
+    rate=3.0,
+    burst=3,
+    offline=False,
+    fixedpoint=False,
+    reportpath=None,
+):
+    """
+    Runs every account in the manifest across a pool of worker processes (os.cpu_count() if workers is None).
+    rate and burst are for the one rate limiter shared by all the workers (see priceclient.TokenBucket).
+    Returns the results of runAccount in manifest order, and writes them to reportpath as a csv if given.
+    """
+    accounts = readManifest(manifestpath)
+    limiter = None
+    if not offline:
+        import priceclient
+
+        limiter = priceclient.SharedTokenBucket(rate, burst)
+    # Create the cache tables once, before the workers open it
+    candlecache.CandleCache(candlecachepath).close()
+    t = time.perf_counter()
+    results = [None] * len(accounts)
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=initWorker,
+        initargs=(limiter, logging.getLogger().getEffectiveLevel()),
+    ) as pool:
+        futures = {
+            pool.submit(
+                runAccount,
+                account,
+                fillspaths,
+                outputpath,
+                candlecachepath,
+                offline,
+                fixedpoint,
+            ): n
+            for n, (account, fillspaths, outputpath) in enumerate(accounts)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            n = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # the worker process itself died
+                result = {"account": accounts[n][0], "ok": False, "error": repr(e)}
+            results[n] = result
+            if result["ok"]:
+                logger.info(
+                    "%s: %s fills, %s transactions in %.1fs (%.0f fills/s)",
+                    result["account"],
+                    result["fills"],
+                    result["transactions"],
+                    result["seconds"],
+                    result["fillspersecond"],
+                )
+            else:
+                logger.warning("%s failed: %s", result["account"], result["error"])
+    seconds = time.perf_counter() - t
+    failed = sum(1 for result in results if not result["ok"])
+    logger.info(
+        "Did %s accounts in %.1fs, %s failed", len(results) - failed, seconds, failed
+    )
+    if reportpath is not None:
+        writeReport(results, reportpath)
+    return results
+
+
+def writeReport(results, reportpath):
+    fieldnames = [
+        "account",
+        "ok",
+        "error",
+        "fills",
+        "transactions",
+        "apicalls",
+        "seconds",
+        "fillspersecond",
+    ]
+    with open(reportpath, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
+        writer.writeheader()
+        for result in results:
+            writer.writerow(result)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run CryptoTax for every account in a manifest csv.")
+    parser.add_argument("manifest")
+    parser.add_argument("--candlecache", default="candlecache.sqlite")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--rate", type=float, default=3.0, help="API requests per second, for all workers together")
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--fixedpoint", action="store_true")
+    parser.add_argument("--report", default=None, help="csv file for the results of each account")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    results = runBatch(
+        args.manifest,
+        candlecachepath=args.candlecache,
+        workers=args.workers,
+        rate=args.rate,
+        offline=args.offline,
+        fixedpoint=args.fixedpoint,
+        reportpath=args.report,
+    )
+    if not all(result["ok"] for result in results):
+        raise SystemExit(1)
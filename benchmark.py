@@ -0,0 +1,276 @@
+# Benchmarks for the gains engine and coinutil, to tell whether a change makes large runs slower.
+# They run on fills made by synthfills.py and a fake Coinbase client, so they need no network or API keys.
+# Results are written as JSON. Given the JSON of an earlier run as a baseline, every benchmark that got slower
+# by more than the threshold is reported as a regression.
+#
+# python benchmark.py --output bench.json
+# python benchmark.py --baseline bench.json
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import random
+import tempfile
+import time
+
+import numpy as np
+
+import coinutil
+import cryptotax
+import synthfills
+
+logger = logging.getLogger(__name__)
+
+
+class FakeClient:
+    """
+    Stands in for the cbpro clients and priceclient.HistoricRatesClient, with made-up products, order books and
+    candles that are the same every time.
+    Every currency has a USD and a BTC market, and every other one an ETH market too, so there are plenty of triangles.
+    """
+    def __init__(self, currencies=synthfills.DEFAULT_CURRENCIES, booklevels=200):
+        self.currencies = list(currencies)
+        self.booklevels = booklevels
+        self.apicalls = 0
+
+    def get_products(self):
+        products = []
+        for n, curr in enumerate(self.currencies):
+            quotes = ["USD"]
+            if curr != "BTC":
+                quotes.append("BTC")
+            if curr not in ("BTC", "ETH") and n % 2 == 0:
+                quotes.append("ETH")
+            for quote in quotes:
+                products.append(
+                    {
+                        "id": curr + "-" + quote,
+                        "base_currency": curr,
+                        "quote_currency": quote,
+                        "base_increment": "0.00000001",
+                        "quote_increment": "0.01" if quote == "USD" else "0.00000001",
+                        "post_only": False,
+                        "limit_only": False,
+                        "cancel_only": False,
+                        "trading_disabled": False,
+                        "status": "online",
+                    }
+                )
+        return products
+
+    def get_product_order_book(self, product_id, level=2):
+        # booklevels levels each side of 100.00, a cent apart
+        r = random.Random(product_id)
+        bids = []
+        asks = []
+        for n in range(self.booklevels):
+            bids.append(["{0:.2f}".format(99.99 - n * 0.01), "{0:.8f}".format(r.uniform(0.01, 5.0)), 1])
+            asks.append(["{0:.2f}".format(100.01 + n * 0.01), "{0:.8f}".format(r.uniform(0.01, 5.0)), 1])
+        return {"sequence": 1, "bids": bids, "asks": asks}
+
+    def get_product_historic_rates(self, product_id, start=None, end=None, granularity=None):
+        self.apicalls += 1
+        start = int(
+            datetime.datetime.fromisoformat(start).replace(tzinfo=datetime.timezone.utc).timestamp()
+        )
+        end = int(
+            datetime.datetime.fromisoformat(end).replace(tzinfo=datetime.timezone.utc).timestamp()
+        )
+        candles = []
+        t = end - end % granularity
+        while t >= start - start % granularity:
+            price = 100.0 + (t // granularity) % 97
+            candles.append([t, price - 1.0, price + 1.0, price, price + 0.5, 10.0])
+            t -= granularity
+        return candles
+
+    def getManyHistoricRates(self, requestlist):
+        return [
+            self.get_product_historic_rates(pid, start, end, granularity)
+            for pid, start, end, granularity in requestlist
+        ]
+
+
+def newCryptoTax(client):
+    return cryptotax.CryptoTax(historicratesclient=client)
+
+
+def benchReadFillsForPrices(fillspath, client):
+    ct = newCryptoTax(client)
+    t = time.perf_counter()
+    ct.readFillsForPrices(fillspath)
+    seconds = time.perf_counter() - t
+    return seconds, countFills(fillspath)
+
+
+def benchReadFillsForGains(fillspath, client):
+    ct = newCryptoTax(client)
+    pricelogs = ct.readFillsForPrices(fillspath)
+    t = time.perf_counter()
+    ct.readFillsForGains(fillspath, pricelogs)
+    return time.perf_counter() - t, ct.fillcount
+
+
+def benchReadFills(fillspath, client):
+    ct = newCryptoTax(client)
+    t = time.perf_counter()
+    ct.readFills(fillspath)
+    return time.perf_counter() - t, ct.fillcount
+
+
+def benchPullFromHoldings(nlots, client):
+    # Pulls that each take about three lots, until the lots are gone
+    r = random.Random(0)
+    ct = newCryptoTax(client)
+    day = datetime.date(2019, 1, 1).toordinal()
+    sizes = [r.uniform(0.001, 1.0) for n in range(nlots)]
+    for size in sizes:
+        ct.addToHoldings("BTC", size, size * 8000.0, day)
+    pulls = [sum(sizes[n : n + 3]) * 0.999 for n in range(0, nlots - 3, 3)]
+    t = time.perf_counter()
+    for amt in pulls:
+        ct.pullFromHoldings("BTC", amt)
+    return time.perf_counter() - t, len(pulls)
+
+
+def benchClosestPrice(n, client):
+    # A price every 10 seconds, and queries that all have a price within the tolerance
+    r = random.Random(0)
+    ct = newCryptoTax(client)
+    pricelog = [(1546300800.0 + 10.0 * k, 8000.0 + k % 100) for k in range(n)]
+    queries = [r.uniform(pricelog[0][0], pricelog[-1][0]) for k in range(n)]
+    t = time.perf_counter()
+    for timestamp in queries:
+        ct.closestPrice("BTC", pricelog, timestamp)
+    return time.perf_counter() - t, n
+
+
+def benchMarketInfo(repeat, client):
+    t = time.perf_counter()
+    for n in range(repeat):
+        coinutil.MarketInfo(client, client)
+    return time.perf_counter() - t, repeat
+
+
+def benchOrderBookEstimates(n, client):
+    # Market orders big enough to go about half way through the book
+    mi = coinutil.MarketInfo(client, client)
+    book = client.get_product_order_book("BTC-USD", level=2)
+    funds = sum(float(ask[0]) * float(ask[1]) for ask in book["asks"]) / 2
+    size = sum(float(bid[1]) for bid in book["bids"]) / 2
+    t = time.perf_counter()
+    for k in range(n):
+        coinutil.estimateMarketBuyFilledSize(mi, "BTC-USD", funds, book)
+        coinutil.estimateMarketSellExecutedValue(mi, "BTC-USD", size, book)
+    return time.perf_counter() - t, 2 * n
+
+
+def benchOrderBookSnapshot(n, client):
+    # The same queries as benchOrderBookEstimates, of sizes up to twice as big, all at once on an OrderBookSnapshot
+    book = client.get_product_order_book("BTC-USD", level=2)
+    t = time.perf_counter()
+    snapshot = coinutil.OrderBookSnapshot(book)
+    funds = np.linspace(0.0, snapshot.askcumnotional[-1], n)
+    sizes = np.linspace(0.0, snapshot.bidcumsize[-1], n)
+    snapshot.filledSize(funds)
+    snapshot.executedValue(sizes)
+    return time.perf_counter() - t, 2 * n
+
+
+def countFills(fillspath):
+    return sum(1 for fill in cryptotax.parseFills(fillspath))
+
+
+def runBenchmarks(rows=20000, seed=0, repeat=3, fragmentation=3):
+    """
+    Runs every benchmark repeat times on a fills file of about rows fills, keeping the fastest time of each.
+    Returns the results as a dict that can be saved as JSON.
+    """
+    client = FakeClient()
+    with tempfile.TemporaryDirectory() as tmp:
+        fillspath = os.path.join(tmp, "fills.csv")
+        nfills = synthfills.generateFills(
+            fillspath, rows=rows, seed=seed, fragmentation=fragmentation
+        )
+        benchmarks = [
+            ("readFillsForPrices", benchReadFillsForPrices, fillspath),
+            ("readFillsForGains", benchReadFillsForGains, fillspath),
+            ("readFills", benchReadFills, fillspath),
+            ("pullFromHoldings", benchPullFromHoldings, rows),
+            ("closestPrice", benchClosestPrice, rows),
+            ("MarketInfo", benchMarketInfo, 200),
+            ("orderBookEstimates", benchOrderBookEstimates, 2000),
+            ("orderBookSnapshot", benchOrderBookSnapshot, 200000),
+        ]
+        results = {}
+        for name, bench, arg in benchmarks:
+            best = None
+            for n in range(repeat):
+                seconds, count = bench(arg, client)
+                if best is None or seconds < best:
+                    best = seconds
+            results[name] = {
+                "seconds": best,
+                "count": count,
+                "persecond": count / best if best > 0 else None,
+            }
+            logger.info("%-20s %10.4fs %12s", name, best, count)
+    return {
+        "rows": nfills,
+        "seed": seed,
+        "repeat": repeat,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        "results": results,
+    }
+
+
+def regressions(report, baseline, threshold=0.2):
+    """
+    The benchmarks that take more than threshold (a fraction) longer per item (fill, pull, query, ...) in report
+    than in baseline, as a list of (name, baseline seconds per item, seconds per item).
+    Per item, so that runs with a different number of rows can be compared.
+    """
+    slower = []
+    for name, result in report["results"].items():
+        old = baseline.get("results", {}).get(name)
+        if old is None:
+            continue
+        oldtime = old["seconds"] / old["count"]
+        newtime = result["seconds"] / result["count"]
+        if newtime > oldtime * (1.0 + threshold):
+            slower.append((name, oldtime, newtime))
+    return slower
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the gains engine and coinutil.")
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--output", default=None, help="json file to write the results to")
+    parser.add_argument("--baseline", default=None, help="json file of earlier results to compare with")
+    parser.add_argument("--threshold", type=float, default=0.2, help="slowdown reported as a regression, eg 0.2 for 20%%")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, format="%(message)s")
+    logger.setLevel(logging.INFO)
+    report = runBenchmarks(rows=args.rows, seed=args.seed, repeat=args.repeat)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = regressions(report, baseline, args.threshold)
+        for name, old, new in slower:
+            print(
+                "REGRESSION {0}: {1:.3g}s -> {2:.3g}s per item ({3:+.0%})".format(
+                    name, old, new, new / old - 1.0
+                )
+            )
+        if slower:
+            raise SystemExit(1)
+        print("No regressions against {0}".format(args.baseline))
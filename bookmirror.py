@@ -0,0 +1,272 @@
+# OrderBookMirror keeps a copy of the level 2 order books of some products up to date from the Coinbase Pro websocket
+# feed, so that the coinutil trading helpers can have a product's book without a REST request right before an order.
+# The level2 channel sends a "snapshot" of the whole book for each product, then "l2update" messages with the
+# changed levels; a level with size 0 is gone. The levels are kept in SortedDicts, best price first.
+#
+# Give a MarketInfo its mirror with startMirror(mi), and coinutil.getOrderBook answers from it (see there).
+# The feed can also be recorded to a file, and played back with ReplayFeed without a connection.
+import datetime
+import gzip
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+import sortedcontainers
+
+import coinutil
+
+logger = logging.getLogger(__name__)
+
+WEBSOCKET_URL = "wss://ws-feed.pro.coinbase.com"
+
+# Levels of each side in the snapshots served to the helpers
+DEFAULT_DEPTH = 200
+
+
+class OrderBookMirror:
+    """
+    The books of productids. For each product, bids maps minus the price to the size (so the best bid comes first)
+    and asks maps the price to the size.
+    A product's book is only served once its snapshot has arrived, and not after the feed is lost (see reset),
+    until the next snapshot.
+    snapshot(pid) gives the best depth levels of a side as a coinutil.OrderBookSnapshot. It is only made again after
+    the book has changed, so asking again for a book that hasn't changed takes a dict lookup.
+    Messages can come from the feed's thread while other threads ask for books.
+    """
+    def __init__(self, productids, depth=DEFAULT_DEPTH):
+        self.productids = list(productids)
+        self.depth = depth
+        self.bids = {pid: sortedcontainers.SortedDict() for pid in self.productids}
+        self.asks = {pid: sortedcontainers.SortedDict() for pid in self.productids}
+        self.synced = {pid: False for pid in self.productids}
+        self.snapshots = {}
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.updates = 0
+        self.lastmessage = None  # time.monotonic() of the last message
+
+    def handle(self, message):
+        # Applies one message of the level2 channel
+        kind = message.get("type")
+        pid = message.get("product_id")
+        if kind == "snapshot" and pid in self.bids:
+            bids = sortedcontainers.SortedDict(
+                (-float(price), float(size)) for price, size in message["bids"]
+            )
+            asks = sortedcontainers.SortedDict(
+                (float(price), float(size)) for price, size in message["asks"]
+            )
+            with self.lock:
+                self.bids[pid] = bids
+                self.asks[pid] = asks
+                self.synced[pid] = True
+                self.snapshots.pop(pid, None)
+        elif kind == "l2update" and pid in self.bids:
+            with self.lock:
+                if not self.synced[pid]:
+                    return
+                for side, price, size in message["changes"]:
+                    self.setLevel(pid, side == "buy", float(price), float(size))
+                self.updates += 1
+        elif kind == "error":
+            logger.warning("Error from the websocket feed: %s", message)
+        self.messages += 1
+        self.lastmessage = time.monotonic()
+
+    def clearBook(self, pid):
+        # Empties a product's book, ready for the levels of a snapshot. Like setLevel, without taking the lock.
+        self.bids[pid] = sortedcontainers.SortedDict()
+        self.asks[pid] = sortedcontainers.SortedDict()
+        self.synced[pid] = True
+        self.snapshots.pop(pid, None)
+
+    def setLevel(self, pid, isbid, price, size):
+        """
+        Sets the size at a price level of a product's book, removing the level if size is 0.
+        Doesn't take the lock, so call it holding the lock, or from the only thread using the mirror (see backtest.py).
+        """
+        if isbid:
+            book, key = self.bids[pid], -price
+        else:
+            book, key = self.asks[pid], price
+        if size == 0.0:
+            book.pop(key, None)
+        else:
+            book[key] = size
+        self.snapshots.pop(pid, None)
+
+    def reset(self):
+        # The feed was lost: stop serving books until new snapshots arrive
+        with self.lock:
+            for pid in self.productids:
+                self.synced[pid] = False
+            self.snapshots.clear()
+
+    def snapshot(self, pid):
+        """
+        The product's book as a coinutil.OrderBookSnapshot of its best depth levels, or None if the product isn't
+        mirrored or its book isn't in sync.
+        """
+        snapshot = self.snapshots.get(pid)
+        if snapshot is not None:
+            return snapshot
+        with self.lock:
+            if not self.synced.get(pid, False):
+                return None
+            bids = self.bids[pid]
+            asks = self.asks[pid]
+            # slicing the keys and values views copies them out of the SortedDicts' lists at once
+            snapshot = coinutil.OrderBookSnapshot.fromArrays(
+                -np.array(bids.keys()[: self.depth], dtype=np.float64),
+                bids.values()[: self.depth],
+                asks.keys()[: self.depth],
+                asks.values()[: self.depth],
+            )
+            self.snapshots[pid] = snapshot
+        return snapshot
+
+    def bestPrices(self, pid):
+        # Best bid and best ask of a product that is in sync, straight from the levels
+        with self.lock:
+            if not self.synced.get(pid, False):
+                return None
+            return -self.bids[pid].peekitem(0)[0], self.asks[pid].peekitem(0)[0]
+
+
+def openMessages(path, mode):
+    # A messages file, gzipped if its name ends in .gz
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t")
+    return open(path, mode)
+
+
+class WebsocketFeed:
+    """
+    Subscribes to the level2 channel of the mirror's products and hands every message to the mirror, from a thread
+    of its own. If the connection is lost, the mirror is reset and the feed connects again after retrywait seconds,
+    which brings new snapshots.
+    With recordpath, every message is also written there as a line of JSON, for ReplayFeed or backtest.py. Add
+    "matches" to channels to record the trades too (the mirror passes them over).
+    """
+    def __init__(self, mirror, url=WEBSOCKET_URL, recordpath=None, retrywait=1.0, channels=("level2",)):
+        self.mirror = mirror
+        self.url = url
+        self.channels = list(channels)
+        self.retrywait = retrywait
+        self.recordfile = openMessages(recordpath, "w") if recordpath else None
+        self.ws = None
+        self.thread = None
+        self.running = False
+
+    def onOpen(self, ws):
+        ws.send(
+            json.dumps(
+                {
+                    "type": "subscribe",
+                    "product_ids": self.mirror.productids,
+                    "channels": self.channels,
+                }
+            )
+        )
+        logger.info("Subscribed to %s for %s products", " ".join(self.channels), len(self.mirror.productids))
+
+    def onMessage(self, ws, text):
+        if self.recordfile is not None:
+            self.recordfile.write(text.rstrip("\n") + "\n")
+        self.mirror.handle(json.loads(text))
+
+    def onError(self, ws, error):
+        logger.warning("Websocket error: %s", error)
+
+    def onClose(self, ws, *args):
+        self.mirror.reset()
+        logger.info("Websocket closed")
+
+    def run(self):
+        import websocket
+
+        while self.running:
+            self.ws = websocket.WebSocketApp(
+                self.url,
+                on_open=self.onOpen,
+                on_message=self.onMessage,
+                on_error=self.onError,
+                on_close=self.onClose,
+            )
+            self.ws.run_forever()
+            if self.running:
+                time.sleep(self.retrywait)
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.ws is not None:
+            self.ws.close()
+        if self.thread is not None:
+            self.thread.join()
+        if self.recordfile is not None:
+            self.recordfile.close()
+
+
+class ReplayFeed:
+    """
+    Plays a file of recorded messages (see WebsocketFeed's recordpath) into the mirror, to test or measure it
+    without a connection.
+    With speed, messages are spaced out by the differences of their "time" fields divided by speed (2.0 plays twice
+    as fast as recorded); without it, as fast as they can be applied.
+    """
+    def __init__(self, mirror, path, speed=None):
+        self.mirror = mirror
+        self.path = path
+        self.speed = speed
+        self.thread = None
+
+    def run(self):
+        start = None
+        first = None
+        with openMessages(self.path, "r") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                if self.speed and "time" in message:
+                    t = parseTime(message["time"])
+                    if first is None:
+                        first = t
+                        start = time.monotonic()
+                    wait = (t - first) / self.speed - (time.monotonic() - start)
+                    if wait > 0:
+                        time.sleep(wait)
+                self.mirror.handle(message)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def join(self):
+        self.thread.join()
+
+
+def parseTime(text):
+    # Seconds since the epoch of the feed's times, eg "2019-08-31T19:33:52.820000Z"
+    return datetime.datetime.fromisoformat(text.rstrip("Z")[:26]).replace(
+        tzinfo=datetime.timezone.utc
+    ).timestamp()
+
+
+def startMirror(mi, url=WEBSOCKET_URL, depth=DEFAULT_DEPTH, recordpath=None):
+    """
+    Mirrors the books of the products of mi's usdtriangles, and has the coinutil helpers use it for mi.
+    Returns the feed, to stop() when done.
+    """
+    mirror = OrderBookMirror(mi.usdtrianglesproductids, depth)
+    mi.bookmirror = mirror
+    return WebsocketFeed(mirror, url, recordpath).start()
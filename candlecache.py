@@ -0,0 +1,104 @@
+# CandleCache keeps the historic rates ("candles") we get from the Coinbase API in a local SQLite database,
+# so that running the same year again doesn't need to ask the API again.
+# A candle is [bucketstarttime, low, high, open, close, volume], the same as the API returns.
+import sqlite3
+import time
+
+
+class CandleCache:
+    """
+    On-disk store of candles by product and granularity.
+    Besides the candles themselves, it records which time ranges have already been fetched ("coverage").
+    A minute with no trades has no candle, so without the coverage we couldn't tell "no candle" from "never asked".
+    Use path ":memory:" for a cache that only lasts as long as the object.
+    A cache file can be used by several processes at once (see batchtaxes.py). It is put in WAL mode so that
+    reading doesn't have to wait for another process writing.
+    """
+    def __init__(self, path=":memory:"):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60.0)
+        if path != ":memory:":
+            self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS candles (
+                product TEXT NOT NULL,
+                granularity INTEGER NOT NULL,
+                time INTEGER NOT NULL,
+                low REAL, high REAL, open REAL, close REAL, volume REAL,
+                PRIMARY KEY (product, granularity, time)
+            );
+            CREATE TABLE IF NOT EXISTS coverage (
+                product TEXT NOT NULL,
+                granularity INTEGER NOT NULL,
+                start REAL NOT NULL,
+                end REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS coverage_index ON coverage (product, granularity, start);
+            """
+        )
+        self.conn.commit()
+
+    def coverage(self, pid, granularity, start, end):
+        # The covered ranges overlapping [start, end], in order
+        return self.conn.execute(
+            "SELECT start, end FROM coverage WHERE product = ? AND granularity = ? AND start <= ? AND end >= ? ORDER BY start",
+            (pid, granularity, end, start),
+        ).fetchall()
+
+    def missingRanges(self, pid, granularity, start, end):
+        """
+        Returns the list of (start, end) ranges within [start, end] that have not been fetched yet.
+        """
+        covered = self.coverage(pid, granularity, start, end)
+        if start == end:
+            return [] if covered else [(start, end)]
+        missing = []
+        t = start
+        for cstart, cend in covered:
+            if cstart > t:
+                missing.append((t, cstart))
+            t = max(t, cend)
+        if t < end:
+            missing.append((t, end))
+        return missing
+
+    def getCandles(self, pid, granularity, start, end):
+        """
+        Returns the candles with a bucket start time within [start, end], newest first like the API does.
+        Returns None if part of the range hasn't been fetched.
+        """
+        if self.missingRanges(pid, granularity, start, end):
+            return None
+        rows = self.conn.execute(
+            "SELECT time, low, high, open, close, volume FROM candles WHERE product = ? AND granularity = ? AND time >= ? AND time <= ? ORDER BY time DESC",
+            (pid, granularity, start, end),
+        ).fetchall()
+        return [list(row) for row in rows]
+
+    def addCandles(self, pid, granularity, start, end, candles):
+        """
+        Stores the candles the API returned for a request of [start, end], and marks that range as covered.
+        The part of the range that could still get new trades (the current candle, or the future) is not marked covered.
+        """
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO candles VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            ((pid, granularity, c[0], c[1], c[2], c[3], c[4], c[5]) for c in candles),
+        )
+        end = min(end, time.time() - granularity)
+        if end >= start:
+            # merge with the covered ranges it overlaps or touches
+            for cstart, cend in self.coverage(pid, granularity, start, end):
+                start = min(start, cstart)
+                end = max(end, cend)
+            self.conn.execute(
+                "DELETE FROM coverage WHERE product = ? AND granularity = ? AND start <= ? AND end >= ?",
+                (pid, granularity, end, start),
+            )
+            self.conn.execute(
+                "INSERT INTO coverage VALUES (?, ?, ?, ?)", (pid, granularity, start, end)
+            )
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -1,6 +1,11 @@
 # MarketInfo contains the Coinbase pro clients, as well as a list of available products and possible triangles.
 # A triangle is my term for a three-part transaction that converts USD to a crypto, to another crypto, then back to USD.
 # One motivation for this project was to investigate split-second arbitrage opportunites in these triangles.
+import logging
+
+logger = logging.getLogger(__name__)
+
+
 class MarketInfo:
     def __init__(self, p_c, a_c):  # pass in intiated public and authenticated clients
         self.public_client = p_c
@@ -13,6 +18,12 @@ class MarketInfo:
         self.alltriangles = []
         self.usdtriangles = []
         self.usdtrianglesproductids = []
+        self.bookmirror = None  # see getOrderBook
+        self.listeners = []  # see addListener
+        # every product by id, and its position in products, so status updates don't have to search for it
+        self.productindex = {}
+        for n, p in enumerate(self.products):
+            self.productindex[p["id"]] = n
         for p in self.products:
             blacklist = ["GBP", "EUR"]
             badproduct = False
@@ -24,8 +35,7 @@ class MarketInfo:
                 or p["trading_disabled"] == True
                 or p["status"] != "online"
             ):
-                print("A market is partially disabled")
-                print(p)
+                logger.info("A market is partially disabled: %s", p)
                 badproduct = True
             for bl in blacklist:
                 if bl in p["id"]:
@@ -42,52 +52,147 @@ class MarketInfo:
                 self.currencies.append(parts[0])
             if parts[1] not in self.currencies:
                 self.currencies.append(parts[1])
-        i = 0
-        while i != len(self.biproductids):
-            j = i + 1
-            while j != len(self.biproductids):
-                if (
-                    self.biproductids[i].split("-")[1]
-                    == self.biproductids[j].split("-")[0]
-                    and (
-                        self.biproductids[j].split("-")[1]
-                        + "-"
-                        + self.biproductids[i].split("-")[0]
-                    )
-                    in self.biproductids
-                ):
-                    pa0 = ProductAction(self.biproductids[i], self.productids)
-                    pa1 = ProductAction(self.biproductids[j], self.productids)
-                    pa2 = ProductAction(
-                        self.biproductids[j].split("-")[1]
-                        + "-"
-                        + self.biproductids[i].split("-")[0],
-                        self.productids,
-                    )
-                    tri = Triangle(pa0, pa1, pa2)
-                    if (not tri.reorderSyn(1) in self.alltriangles) and (
-                        not tri.reorderSyn(2) in self.alltriangles
-                    ):
-                        self.alltriangles.append(tri)
-                j += 1
-            i += 1
+        self.buildTriangles()
+
+    def buildTriangles(self):
+        """
+        Finds every triangle in the products.
+        The currencies and products form a graph, adjacency maps each currency to the set of currencies it has a market with.
+        Each set of three currencies that are all connected is two triangles, one in each direction.
+        Triangles are stored once, in the rotation and order that a scan of biproductids pairs would find them first,
+        so alltriangles and usdtriangles come out the same as they always have.
+        """
+        self.adjacency = productAdjacency(self.productids)
+        biindex = {}  # nameid -> position in biproductids
+        for n, nameid in enumerate(self.biproductids):
+            biindex.setdefault(nameid, n)
+        productidset = set(self.productids)
+
+        # Visit each connected set of three currencies once: only follow edges to currencies later in this order.
+        rank = {
+            cur: n
+            for n, cur in enumerate(
+                sorted(self.adjacency, key=lambda c: (len(self.adjacency[c]), c))
+            )
+        }
+        later = {
+            cur: {c for c in self.adjacency[cur] if rank[c] > rank[cur]}
+            for cur in self.adjacency
+        }
+        found = []
+        for a in later:
+            for b in later[a]:
+                for c in later[a] & later[b]:
+                    for cycle in ((a, b, c), (a, c, b)):
+                        # the nameids converting cycle[1] to cycle[0], cycle[2] to cycle[1], cycle[0] to cycle[2]
+                        ids = [
+                            cycle[0] + "-" + cycle[1],
+                            cycle[1] + "-" + cycle[2],
+                            cycle[2] + "-" + cycle[0],
+                        ]
+                        # a pair scan finds a rotation when its second product comes later in biproductids than its first
+                        first = min(
+                            (biindex[ids[k]], biindex[ids[(k + 1) % 3]], k)
+                            for k in range(3)
+                            if biindex[ids[(k + 1) % 3]] > biindex[ids[k]]
+                        )
+                        found.append((first, ids))
+        found.sort()
+        self.triangleindex = {}  # canonical cycle key -> triangle in alltriangles
+        for (i, j, k), ids in found:
+            tri = Triangle(
+                ProductAction(ids[k], productidset),
+                ProductAction(ids[(k + 1) % 3], productidset),
+                ProductAction(ids[(k + 2) % 3], productidset),
+            )
+            self.alltriangles.append(tri)
+            self.triangleindex[tri.cycleKey()] = tri
+
         for tri in self.alltriangles:
             if tri.hasCurrency("USD"):
                 triusd = tri.reorderSyn(0)
                 triusd.reorderToBeginWith("USD")
                 self.usdtriangles.append(triusd)
+
+        # product -> the usdtriangles trading in it
+        self.producttriangles = {}
+        for tri in self.usdtriangles:
+            for pa in tri.tri:
+                if not pa.trueid in self.producttriangles:
+                    self.producttriangles[pa.trueid] = []
+                    self.usdtrianglesproductids.append(pa.trueid)
+                self.producttriangles[pa.trueid].append(tri)
+        self.indexTriangleStatus()
+
+    def indexTriangleStatus(self):
+        """
+        Which products and usdtriangles can be traded right now, kept up to date by updateProducts.
+        productstatus maps each product in productsdict to productOK. blocked counts, for each usdtriangle (by
+        cycleKey), how many of its products are not OK, and oktriangles holds the usdtriangles with none, by cycleKey.
+        """
+        self.productstatus = {pid: self.productOK(pid) for pid in self.productsdict}
+        self.blocked = {}
+        self.oktriangles = {}
         for tri in self.usdtriangles:
-            for i in range(3):
-                if not tri.tri[i].trueid in self.usdtrianglesproductids:
-                    self.usdtrianglesproductids.append(tri.tri[i].trueid)
+            key = tri.cycleKey()
+            self.blocked[key] = sum(
+                1 for pid in tri.trueids if not self.productstatus.get(pid, False)
+            )
+            if self.blocked[key] == 0:
+                self.oktriangles[key] = tri
+
+    def addListener(self, listener):
+        """
+        listener(kind, item, ok) is called whenever a product or usdtriangle becomes tradable or stops being tradable,
+        with kind "product" and the product id, or kind "triangle" and the triangle.
+        """
+        self.listeners.append(listener)
+
+    def notify(self, kind, item, ok):
+        for listener in self.listeners:
+            listener(kind, item, ok)
+
+    def trianglesWithProduct(self, pid):
+        # The usdtriangles that trade in the product, in either direction
+        tris = self.producttriangles.get(pid)
+        if tris is None:
+            tris = self.producttriangles.get(reverseID(pid), [])
+        return tris
 
     def updateProducts(self, statusmsg):
+        """
+        Takes the products of a message from the status channel, and updates which products and triangles are OK,
+        looking only at the products in the message and the triangles they are in.
+        """
         sprods = statusmsg.get("products", {})
-        for p in self.products:
-            for sp in sprods:
-                if p["id"] == sp["id"]:
-                    p = sp  # replace the mi's product info with the new product info coming in from the websocket. Note: although it seems to me that the dict coming in through the status channel should have identical keys to the product info obtained by auth_client.get_products, they are slightly different. Notably, the product in the status channel is missing the 'trading_disabled' key. I emailed help about this, it doesn't seem right. There are other differences, but this is the main one.
-                    self.productsdict[p["id"]] = sp
+        for sp in sprods:
+            n = self.productindex.get(sp["id"])
+            if n is None:
+                continue
+            # replace the mi's product info with the new product info coming in from the websocket. Note: although it seems to me that the dict coming in through the status channel should have identical keys to the product info obtained by auth_client.get_products, they are slightly different. Notably, the product in the status channel is missing the 'trading_disabled' key. I emailed help about this, it doesn't seem right. There are other differences, but this is the main one.
+            self.products[n] = sp
+            self.productsdict[sp["id"]] = sp
+            self.productChanged(sp["id"])
+
+    def productChanged(self, pid):
+        ok = self.productOK(pid)
+        if ok == self.productstatus.get(pid):
+            return
+        self.productstatus[pid] = ok
+        self.notify("product", pid, ok)
+        for tri in self.producttriangles.get(pid, []):
+            key = tri.cycleKey()
+            self.blocked[key] += -1 if ok else 1
+            if ok and self.blocked[key] == 0:
+                self.oktriangles[key] = tri
+                self.notify("triangle", tri, True)
+            elif not ok and self.blocked[key] == 1:
+                del self.oktriangles[key]
+                self.notify("triangle", tri, False)
+
+    def okTriangles(self):
+        # The usdtriangles whose products are all OK right now
+        return list(self.oktriangles.values())
 
     def productOK(self, pid):
         p = self.productsdict[pid]
@@ -100,6 +205,9 @@ class MarketInfo:
         return ok
 
     def triangleOK(self, triangle):
+        blocked = self.blocked.get(triangle.cycleKey())
+        if blocked is not None:
+            return blocked == 0
         return (
             self.productOK(triangle.pa0.trueid)
             and self.productOK(triangle.pa1.trueid)
@@ -124,9 +232,9 @@ class ProductAction:
             self.trueid = reverseID(self.nameid)
             self.action = "sell"
         else:
-            print(
-                "Supplied nameid %s or its reverse could not be found in the product list"
-                % self.nameid
+            logger.warning(
+                "Supplied nameid %s or its reverse could not be found in the product list",
+                self.nameid,
             )
 
     def __eq__(self, other):
@@ -156,6 +264,10 @@ class Triangle:
         self.pa1 = pa_1
         self.pa2 = pa_2
         self.tri = [self.pa0, self.pa1, self.pa2]
+        self.trueids = frozenset((pa_0.trueid, pa_1.trueid, pa_2.trueid))
+        ids = [pa.nameid for pa in self.tri]
+        k = ids.index(min(ids))
+        self.cyclekey = (ids[k], ids[(k + 1) % 3], ids[(k + 2) % 3])
 
     def __eq__(
         self, other
@@ -176,10 +288,12 @@ class Triangle:
 
     def hasProduct(self, pid):
         # is the product present in natural or reverse direction?
-        for pa in self.tri:
-            if pa.trueid == pid or pa.trueid == reverseID(pid):
-                return True
-        return False
+        return pid in self.trueids or reverseID(pid) in self.trueids
+
+    def cycleKey(self):
+        # The same for every rotation of the triangle, different for the reverse direction. Rotating (reorder) doesn't
+        # change it, so it is worked out once.
+        return self.cyclekey
 
     def reorderToBeginWith(self, cur):
         # reorder if any pa has the cur. if the order is already good, or the cur is not contained in any pa, do nothing.
@@ -220,6 +334,16 @@ class Triangle:
         print(self.tri[0].nameid + " " + self.tri[1].nameid + " " + self.tri[2].nameid)
 
 
+def productAdjacency(productids):
+    # The graph of currencies and products: maps each currency to the set of currencies it has a market with
+    adjacency = {}
+    for pid in productids:
+        parts = pid.split("-")
+        adjacency.setdefault(parts[0], set()).add(parts[1])
+        adjacency.setdefault(parts[1], set()).add(parts[0])
+    return adjacency
+
+
 def reverseID(pid):
     return pid.split("-")[1] + "-" + pid.split("-")[0]
 
@@ -269,18 +393,158 @@ def reducePrecision(amount_str, increment_str):
                 amt_prec += parts_amt[1][i]
     return amt_prec
 
+class OrderBookSnapshot:
+    '''
+    A level 2 order book parsed once into NumPy arrays, for asking about many order sizes against the same book.
+    For each side, prices and sizes of the levels, best first, and their running totals: cumsize is the size of
+    that level and all better ones, cumnotional their value in the quote currency.
+    The estimate and limit price functions below take a snapshot in place of the book from get_product_order_book.
+    The query methods take a single amount or an array of them.
+    NumPy is only imported by the functions that use it, so importing coinutil (eg for MarketInfo) stays quick.
+    '''
+    def __init__(self, level2book):
+        import numpy as np
+
+        self.sequence = level2book.get("sequence")
+        for side in ("bids", "asks"):
+            levels = level2book[side]
+            self.setSide(
+                side[:-1],
+                np.array([float(level[0]) for level in levels], dtype=np.float64),
+                np.array([float(level[1]) for level in levels], dtype=np.float64),
+            )
+
+    @classmethod
+    def fromArrays(cls, bidprices, bidsizes, askprices, asksizes, sequence=None):
+        # A snapshot of levels that are already numbers, best first, eg from bookmirror.OrderBookMirror
+        import numpy as np
+
+        snapshot = cls.__new__(cls)
+        snapshot.sequence = sequence
+        snapshot.setSide("bid", np.asarray(bidprices, dtype=np.float64), np.asarray(bidsizes, dtype=np.float64))
+        snapshot.setSide("ask", np.asarray(askprices, dtype=np.float64), np.asarray(asksizes, dtype=np.float64))
+        return snapshot
+
+    def setSide(self, side, prices, sizes):
+        import numpy as np
+
+        setattr(self, side + "prices", prices)
+        setattr(self, side + "sizes", sizes)
+        setattr(self, side + "cumsize", np.cumsum(sizes))
+        setattr(self, side + "cumnotional", np.cumsum(prices * sizes))
+
+    @property
+    def bestbid(self):
+        return float(self.bidprices[0])
+
+    @property
+    def bestask(self):
+        return float(self.askprices[0])
+
+    def filledSize(self, funds):
+        # Size a market buy of funds (in the quote currency) gets, see estimateMarketBuyFilledSize
+        return walkBook(self.askcumnotional, self.askcumsize, self.askprices, funds, True)
+
+    def executedValue(self, size):
+        # Value (in the quote currency) a market sell of size gets, see estimateMarketSellExecutedValue
+        return walkBook(self.bidcumsize, self.bidcumnotional, self.bidprices, size)
+
+    def buyCost(self, size):
+        # Funds (in the quote currency) a market buy needs to get size
+        return walkBook(self.askcumsize, self.askcumnotional, self.askprices, size)
+
+    def slippageCurve(self, sizes, side="buy"):
+        '''
+        Average price and slippage of market orders of each of sizes (in the base currency) on one side ("buy" or
+        "sell"). Slippage is how much worse the average price is than the best price, as a fraction of it.
+        Sizes beyond the whole book are priced as the whole book.
+        Returns two arrays, the average prices and the slippages.
+        '''
+        import numpy as np
+
+        sizes = np.asarray(sizes, dtype=np.float64)
+        if side == "buy":
+            filled = np.minimum(sizes, self.askcumsize[-1] if len(self.askcumsize) else 0.0)
+            average = self.buyCost(filled) / np.where(filled > 0, filled, np.nan)
+            return average, average / self.bestask - 1.0
+        filled = np.minimum(sizes, self.bidcumsize[-1] if len(self.bidcumsize) else 0.0)
+        average = self.executedValue(filled) / np.where(filled > 0, filled, np.nan)
+        return average, 1.0 - average / self.bestbid
+
+
+def walkBook(cumin, cumout, prices, amounts, divide=False):
+    '''
+    Goes through one side of a book, best level first, spending amounts of what cumin counts (eg funds) to get what
+    cumout counts (eg size), at the prices of the levels (times the price, or divided by it with divide).
+    All the levels that amount covers entirely are taken, and the rest of it is spent at the next level, with one
+    searchsorted for all the amounts.
+    An amount beyond the whole side gets all of it.
+    '''
+    n = len(cumin)
+    if isinstance(amounts, (int, float)) or getattr(amounts, "ndim", 1) == 0:
+        # a single amount, without making arrays
+        if n == 0:
+            return 0.0
+        k = int(cumin.searchsorted(amounts))
+        if k == n:
+            return float(cumout[-1])
+        spent = float(cumin[k - 1]) if k else 0.0
+        got = float(cumout[k - 1]) if k else 0.0
+        price = float(prices[k])
+        return got + ((amounts - spent) / price if divide else (amounts - spent) * price)
+    import numpy as np
+
+    amounts = np.asarray(amounts, dtype=np.float64)
+    if n == 0:
+        return np.zeros(amounts.shape)
+    k = np.searchsorted(cumin, amounts, side="left")
+    before = np.maximum(k - 1, 0)
+    spent = np.where(k > 0, cumin[before], 0.0)
+    got = np.where(k > 0, cumout[before], 0.0)
+    price = prices[np.minimum(k, n - 1)]
+    partial = (amounts - spent) / price if divide else (amounts - spent) * price
+    return np.where(k < n, got + partial, cumout[-1])
+
+
+def orderBook(mi, pid, level2book=0):
+    # The book given, or else the product's current book (see getOrderBook)
+    return level2book if level2book else getOrderBook(mi, pid)
+
+
+def getOrderBook(mi, pid):
+    """
+    The product's current level 2 book: an OrderBookSnapshot from mi.bookmirror if there is one and it is in sync
+    for the product (see bookmirror.py), otherwise the book from the API.
+    """
+    if mi.bookmirror is not None:
+        snapshot = mi.bookmirror.snapshot(pid)
+        if snapshot is not None:
+            return snapshot
+    return mi.public_client.get_product_order_book(pid, level=2)
+
+
+def getOrderBookSnapshot(mi, pid):
+    return OrderBookSnapshot(mi.public_client.get_product_order_book(pid, level=2))
+
+
+def bestPrices(l2b):
+    # Best bid and best ask, of a book or an OrderBookSnapshot
+    if isinstance(l2b, OrderBookSnapshot):
+        return l2b.bestbid, l2b.bestask
+    return float(l2b["bids"][0][0]), float(l2b["asks"][0][0])
+
+
 '''
 When you make a "market buy" you will accept the best asks in order on the order book until your order size is filled.
 As a result, the price may vary as your order is filled, and you don't know the size of your fill a priori.
 For large orders, particularly on smaller markets, the price could change a lot ("slippage")
 These functions run through the order book and estimate final filled size.
+level2book can be an OrderBookSnapshot, which answers without going through the book level by level.
 '''
 def estimateMarketBuyFilledSize(mi, pid, funds, level2book=0):
-    l2b = (
-        level2book
-        if level2book
-        else mi.public_client.get_product_order_book(pid, level=2)
-    )
+    l2b = orderBook(mi, pid, level2book)
+    if isinstance(l2b, OrderBookSnapshot):
+        return l2b.filledSize(funds)
     fundsremaining = funds
     filledsize = 0.0
     for ask in l2b["asks"]:
@@ -298,11 +562,9 @@ def estimateMarketBuyFilledSize(mi, pid, funds, level2book=0):
 
 
 def estimateMarketSellExecutedValue(mi, pid, size, level2book=0):
-    l2b = (
-        level2book
-        if level2book
-        else mi.public_client.get_product_order_book(pid, level=2)
-    )
+    l2b = orderBook(mi, pid, level2book)
+    if isinstance(l2b, OrderBookSnapshot):
+        return l2b.executedValue(size)
     sizeremaining = size
     executedvalue = 0.0
     for bid in l2b["bids"]:
@@ -324,15 +586,8 @@ Simply put, this is an attempt to buy/sell at market price immediately, but with
 There is always the chance that your order will be undercut/overcut as the market moves though, and not filled immediately.
 '''
 def getBestLimitBuyInfo(mi, pid, funds, level2book=0):
-    l2b = (
-        level2book
-        if level2book
-        else mi.public_client.get_product_order_book(pid, level=2)
-    )
-    bestbid = l2b["bids"][0]
-    bestbidprice = float(bestbid[0])
-    bestask = l2b["asks"][0]
-    bestaskprice = float(bestask[0])
+    l2b = orderBook(mi, pid, level2book)
+    bestbidprice, bestaskprice = bestPrices(l2b)
     limitbidprice = bestbidprice  # The price I will ultimately bid
     quoteincrement = float(mi.productsdict[pid]["quote_increment"])
     if (
@@ -351,11 +606,7 @@ def getBestLimitBuyInfo(mi, pid, funds, level2book=0):
 
 
 def bestLimitBuy(mi, pid, funds, level2book=0, coid=""):
-    l2b = (
-        level2book
-        if level2book
-        else mi.public_client.get_product_order_book(pid, level=2)
-    )
+    l2b = orderBook(mi, pid, level2book)
     pricesize = getBestLimitBuyInfo(mi, pid, funds, l2b)
     limitbidprice_str = pricesize[0]
     limitbidvolume_str = pricesize[1]
@@ -369,11 +620,8 @@ def bestLimitBuy(mi, pid, funds, level2book=0, coid=""):
 
 
 def getBestLimitSellInfo(mi, pid, size, level2book=0):
-    l2b = level2book if level2book else mi.public_client.get_product_order_book(pid, level=2)
-    bestbid = l2b["bids"][0]
-    bestbidprice = float(bestbid[0])
-    bestask = l2b["asks"][0]
-    bestaskprice = float(bestask[0])
+    l2b = orderBook(mi, pid, level2book)
+    bestbidprice, bestaskprice = bestPrices(l2b)
     limitaskprice = bestaskprice # the price I will ultimately ask
     quoteincrement = float(mi.productsdict[pid]['quote_increment'])
     if  bestaskprice-bestbidprice>5.0*quoteincrement: #If the spread is greater than eg 0.05 USD, ask two cents lower
@@ -385,7 +633,7 @@ def getBestLimitSellInfo(mi, pid, size, level2book=0):
     )
     return (limitaskprice_str, limitaskvolume_str)
 def bestLimitSell(mi, pid, size, level2book=0, coid=''):
-    l2b = level2book if level2book else mi.public_client.get_product_order_book(pid, level=2)
+    l2b = orderBook(mi, pid, level2book)
     pricesize = getBestLimitSellInfo(mi,pid,size,l2b)
     limitaskprice_str = pricesize[0]
     limitaskvolume_str = pricesize[1]
@@ -0,0 +1,96 @@
+# Derives the USD price of a currency from the prices of other markets in our own fills ("cross rates"), eg XTZ's from
+# an XTZ-BTC fill and a BTC-USD fill a few seconds apart, so that fewer prices have to be requested from the API.
+# The markets form a graph of currencies (see coinutil.productAdjacency). A price is derived through the chain of
+# markets to USD whose prices are closest in time, each one within the tolerance.
+import heapq
+
+
+def pricelogKey(pid):
+    # The key of a product's prices in pricelogs: the base currency for USD markets (whose prices are USD prices of the
+    # currency), the product id for the others
+    base, quote = pid.split("-")
+    return base if quote == "USD" else pid
+
+
+def productId(key):
+    # The product of a pricelogs key, the opposite of pricelogKey
+    return key if "-" in key else key + "-USD"
+
+
+class CrossRates:
+    """
+    Finds USD prices through chains of markets.
+    nearest(key, timestamp) gives the (time, price) closest to timestamp among the prices of pricelogs key (see
+    pricelogKey), or None, eg for the pricelogs of CryptoTax or a priceindex.PriceIndex.
+    adjacency is the graph of markets to look through, eg a coinutil.MarketInfo's. Without it, the graph is made of
+    the markets that there are prices for.
+    Chains are at most maxhops markets long.
+    """
+    def __init__(self, tolerance, adjacency=None, maxhops=3):
+        self.tolerance = tolerance
+        self.fixedadjacency = adjacency
+        self.maxhops = maxhops
+        self.keys = frozenset()
+        self.adjacency = {}
+
+    def graph(self, keys):
+        if self.fixedadjacency is not None:
+            return self.fixedadjacency
+        # The graph depends only on which keys there are prices for. The same resolver is given the keys of different
+        # pricelogs (eg the look-ahead window, a PriceIndex, those of a single currency), so it is made again whenever
+        # the set of keys is not the one it was made for, even if there are as many of them.
+        keys = frozenset(keys)
+        if keys != self.keys:
+            # coinutil (and NumPy with it) is only imported when needed, so importing cryptotax stays quick
+            import coinutil
+
+            self.keys = keys
+            self.adjacency = coinutil.productAdjacency([productId(key) for key in self.keys])
+        return self.adjacency
+
+    def derivePrice(self, curr, timestamp, keys, nearest):
+        """
+        The USD price of curr at timestamp through the chain of markets whose prices add up to the least time away
+        from timestamp. keys are the pricelogs keys there are prices for.
+        Returns the price and the chain of products used, eg (0.000123 * 7300.0, ["XTZ-BTC", "BTC-USD"]),
+        or None if no chain has prices within the tolerance.
+        """
+        adjacency = self.graph(keys)
+        # (time away, hops, currency, factor, chain), where the USD price of curr is factor times that of currency
+        heap = [(0.0, 0, curr, 1.0, [])]
+        # currency -> fewest hops it has been reached with. Currencies come off the heap least time away first, so a
+        # currency reached again is only worth going on from if it took fewer hops: the maxhops limit may have stopped
+        # the chains through it that took more.
+        done = {}
+        while heap:
+            cost, hops, cur, factor, chain = heapq.heappop(heap)
+            if cur == "USD":
+                return factor, chain
+            if cur in done and done[cur] <= hops:
+                continue
+            done[cur] = hops
+            if hops == self.maxhops:
+                continue
+            for other in sorted(adjacency.get(cur, ())):
+                if other in done and done[other] <= hops + 1:
+                    continue
+                if other == "USD":
+                    pid = cur + "-USD"
+                elif cur + "-" + other in keys:
+                    pid = cur + "-" + other
+                else:
+                    pid = other + "-" + cur
+                entry = nearest(pricelogKey(pid), timestamp)
+                if entry is None:
+                    continue
+                away = abs(entry[0] - timestamp)
+                if away >= self.tolerance or entry[1] <= 0:
+                    continue
+                if pid.startswith(cur + "-"):
+                    # one cur is price other
+                    newfactor = factor * entry[1]
+                else:
+                    # one other is price cur
+                    newfactor = factor / entry[1]
+                heapq.heappush(heap, (cost + away, hops + 1, other, newfactor, chain + [pid]))
+        return None
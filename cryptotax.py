@@ -1,11 +1,475 @@
+import array
 import bisect
+import collections
 import csv
-import time
 import datetime
+import decimal
+import functools
+import hashlib
+import heapq
+import itertools
+import json
+import logging
+import os
+import time
+
+import candlecache
+import crossrates
+import instrumentation
+import transactionsinks
+
+logger = logging.getLogger(__name__)
+
+# In fixed-point mode (see CryptoTax), crypto amounts are whole numbers of units of 10**-digits of the currency, where
+# digits starts at SIZE_DIGITS (satoshis, for BTC) and grows for a currency whose amounts in the fills have more
+# decimals, up to MAX_SIZE_DIGITS. USD amounts are whole numbers of 10**-USD_DIGITS dollars.
+# The amounts are kept in 64-bit integer arrays, so none may be bigger than FIXED_MAX.
+SIZE_DIGITS = 8
+MAX_SIZE_DIGITS = 18
+USD_DIGITS = transactionsinks.USD_DIGITS
+FIXED_MAX = 2**63 - 1
+
+# The decimal arithmetic of fixed-point mode: enough precision that products of a price and an amount are exact, and
+# exponents as big and small as decimal has, so scaling an amount never rounds it
+DECIMAL_CONTEXT = decimal.Context(prec=100, Emax=decimal.MAX_EMAX, Emin=decimal.MIN_EMIN)
+
+# How far apart in time (seconds) the same fill may be in two overlapping fills files and still be recognized
+DEDUPE_WINDOW = 1.0
+
+# How far away in time (seconds) a price from our own fills may be and still be used as the fair market value.
+PRICE_TOLERANCE = 30.0
+
+# getHistoricPrice looks for minute candles up to this many seconds before and after a fill
+PRICE_FETCH_MARGIN = 1200
+
+# The most candles the API returns for one historic rates request
+MAX_CANDLES = 300
+
+# readFillsForGains looks up the prices of this many fills at a time (see batchPrices)
+PRICE_BATCH_FILLS = 4096
+
+# Checkpoints hash the fills file this many bytes at a time
+HASH_CHUNK_BYTES = 1 << 20
+
+
+class Fill:
+    """
+    One row of the modified fills csv (see README.md), with the columns the gains calculation uses converted to their types.
+    sizestr and totalstr keep the original text, because it goes into the human-readable transaction descriptions.
+    day is the date of the fill as a proleptic Gregorian ordinal (see datetime.date.toordinal).
+    offset is where the row starts in the csv file, in bytes.
+    """
+    __slots__ = (
+        "tradeid",
+        "product",
+        "side",
+        "basecurrency",
+        "quotecurrency",
+        "timestamp",
+        "size",
+        "sizestr",
+        "price",
+        "total",
+        "totalstr",
+        "unit",
+        "day",
+        "offset",
+    )
+
+    def __init__(self, row, offset=None):
+        self.tradeid = row["trade id"]
+        self.product = row["product"]
+        self.side = row["side"]
+        self.basecurrency = row["size unit"]
+        self.quotecurrency = self.product.split("-")[1]
+        self.timestamp = float(row["timestamp"])
+        self.sizestr = row["size"]
+        self.size = float(self.sizestr)
+        self.price = float(row["price"])
+        self.totalstr = row["total"]
+        self.total = float(self.totalstr)
+        self.unit = row["price/fee/total unit"]
+        self.day = dayOrdinal(row["yyyy"], row["mm"], row["dd"])
+        self.offset = offset
+
+
+def toFixed(text, digits):
+    """
+    Converts a decimal number as written in the fills csv (eg "-101.49201", or "2e-8" as Excel sometimes writes tiny
+    sizes) to a whole number of 10**-digits units, exactly: the text is parsed with decimal and scaled there, never
+    through a float. Raises an Exception if it has more decimals than that (other than trailing zeros), rather than
+    round it, or if it is bigger than FIXED_MAX units.
+    """
+    try:
+        units = parseDecimal(text).scaleb(digits, DECIMAL_CONTEXT)
+    except decimal.Overflow:
+        raise Exception("{0} is too big for 64-bit units of 10**-{1}".format(text, digits))
+    if units != units.to_integral_value(context=DECIMAL_CONTEXT):
+        raise Exception("{0} has more than {1} decimals".format(text, digits))
+    if units.copy_abs() > FIXED_MAX:
+        raise Exception("{0} is too big for 64-bit units of 10**-{1}".format(text, digits))
+    return int(units)
+
+
+def decimalPlaces(text):
+    # How many decimals a number as written in the fills csv has, not counting trailing zeros
+    if "e" in text or "E" in text:
+        return max(0, -parseDecimal(text).normalize(DECIMAL_CONTEXT).as_tuple().exponent)
+    return len(text.partition(".")[2].rstrip("0"))
+
+
+def parseDecimal(text):
+    # A number as written in the fills csv as a decimal.Decimal, exactly
+    try:
+        value = decimal.Decimal(text)
+    except decimal.InvalidOperation:
+        raise Exception("{0!r} is not a number".format(text))
+    if not value.is_finite():
+        raise Exception("{0!r} is not a number".format(text))
+    if len(text) > DECIMAL_CONTEXT.prec:
+        # more digits than the arithmetic keeps exactly
+        raise Exception("{0!r} is too long".format(text))
+    return value
+
+
+def describeFill(fill):
+    # Names a fill in error messages
+    if fill is None:
+        return "Fill"
+    return "Fill {0} of {1} at {2} (trade id {3!r})".format(
+        fill.side, fill.product, fill.timestamp, fill.tradeid
+    )
+
+
+@functools.lru_cache(maxsize=4096)
+def dayOrdinal(yyyy, mm, dd):
+    return datetime.date(int(yyyy), int(mm), int(dd)).toordinal()
+
+
+def formatDay(day):
+    # The date format used on form 8949, eg 8/28/2019
+    d = datetime.date.fromordinal(day)
+    return "{0}/{1}/{2}".format(d.month, d.day, d.year)
+
+
+class LotLedger:
+    """
+    The holdings of a single currency, as a FIFO queue of lots.
+    Each lot has a size, a USD basis and the day it was acquired. They are kept in parallel arrays, oldest first.
+    head is the index of the oldest lot we still hold, so pulling lots off the front doesn't move the rest of them.
+    Consumed lots are only dropped from the arrays once they make up most of them.
+    totalsize is the sum of the sizes of the lots still held.
+    With fixedpoint set, sizes and bases are whole numbers of units (see CryptoTax) in 64-bit integer arrays,
+    and a lot is split exactly, so it is never left with dust.
+    """
+    def __init__(self, fixedpoint=False):
+        self.fixedpoint = fixedpoint
+        typecode = "q" if fixedpoint else "d"
+        self.sizes = array.array(typecode)
+        self.bases = array.array(typecode)
+        self.days = array.array("l")
+        self.head = 0
+        self.totalsize = 0 if fixedpoint else 0.0
+
+    def __len__(self):
+        return len(self.sizes) - self.head
+
+    def __repr__(self):
+        return "LotLedger({0} lots, totalsize {1})".format(len(self), self.totalsize)
+
+    def lot(self, i):
+        # (size, usdbasis, day) of the i-th oldest lot still held
+        i += self.head
+        return (self.sizes[i], self.bases[i], self.days[i])
+
+    def add(self, size, usdbasis, day):
+        self.sizes.append(size)
+        self.bases.append(usdbasis)
+        self.days.append(day)
+        self.totalsize += size
+
+    def pull(self, amt):
+        """
+        Removes amt from the oldest lots. A lot bigger than what is left to pull is decremented in place.
+        Returns the list of (size, usdbasis, day) pulled, whose sizes add up to amt.
+        """
+        pulled = []
+        sizes = self.sizes
+        bases = self.bases
+        h = self.head
+        amtleft = amt
+        debug = logger.isEnabledFor(logging.DEBUG)
+        while True:
+            if debug:
+                logger.debug("*%s", amtleft)
+                logger.debug("*%s", (sizes[h], bases[h], self.days[h]))
+            if amtleft < sizes[h]:
+                # the oldest holding is bigger than the amount we are pulling.
+                # decrement the oldest holding by amtleft
+                if self.fixedpoint:
+                    # the basis pulled is rounded down, and the rest stays with the lot, so no basis is lost
+                    basis = bases[h] * amtleft // sizes[h]
+                else:
+                    basis = amtleft / sizes[h] * bases[h]
+                sizes[h] = sizes[h] - amtleft
+                bases[h] = bases[h] - basis
+                pulled.append((amtleft, basis, self.days[h]))
+                self.totalsize -= amtleft
+                break
+            else:
+                # the oldest holding is equal or smaller than the amount we are pulling
+                amtleft -= sizes[h]
+                pulled.append((sizes[h], bases[h], self.days[h]))
+                self.totalsize -= sizes[h]
+                h += 1
+                if h == len(sizes):
+                    # This only matters if the amtleft is >0.0. (ie, that's a problem beause we want to pull more from holdings, but there's no holdings left.) It is 0.0 if you just drew down the last of your holdings exactly.
+                    logger.log(
+                        logging.WARNING if amtleft > 0 else logging.DEBUG,
+                        "there were no holdings left with amtleft:%s",
+                        amtleft,
+                    )
+                    break
+                if amtleft <= 0:
+                    # amtleft can't be truly negative due to the enclosing if statement. It is 0.0 when the holding drawn from was EXACTLY the size of amtleft.
+                    if debug:
+                        logger.debug("while pulling amtleft was <= 0  amtleft:%s", amtleft)
+                    break
+        self.head = h
+        if h == len(sizes):
+            self.totalsize = 0 if self.fixedpoint else 0.0
+        if h > 1024 and h * 2 > len(sizes):
+            self.compact()
+        return pulled
+
+    def scaleSizes(self, factor):
+        # Multiplies the sizes of the lots by factor, when the currency's amounts get more digits (see CryptoTax.toUnits)
+        try:
+            self.sizes = array.array("q", [size * factor for size in self.sizes])
+        except OverflowError:
+            raise Exception(
+                "Holdings too big for 64-bit integers at {0} times more digits".format(factor)
+            )
+        self.totalsize *= factor
+
+    def toDict(self):
+        # The lots still held, as lists that can be saved as JSON
+        return {
+            "sizes": self.sizes[self.head :].tolist(),
+            "bases": self.bases[self.head :].tolist(),
+            "days": self.days[self.head :].tolist(),
+        }
+
+    @classmethod
+    def fromDict(cls, lots, fixedpoint=False):
+        ledger = cls(fixedpoint)
+        for size, usdbasis, day in zip(lots["sizes"], lots["bases"], lots["days"]):
+            ledger.add(size, usdbasis, day)
+        return ledger
+
+    def compact(self):
+        # Drop the lots that have been pulled completely
+        del self.sizes[: self.head]
+        del self.bases[: self.head]
+        del self.days[: self.head]
+        self.head = 0
+
+
+def parseFills(fillspath, offset=None):
+    """
+    Reads the modified fills csv one row at a time, yielding a Fill for each row.
+    If offset is given, reading starts there instead of after the header. It must be the start of a row.
+    """
+    with open(fillspath, "rb") as fillscsv:
+        fieldnames = next(csv.reader([fillscsv.readline().decode("utf-8-sig")]))
+        if offset is not None:
+            fillscsv.seek(offset)
+        linestart = [fillscsv.tell()]
+
+        def lines():
+            # The csv reader reads one line per row. Keep track of where each line starts.
+            while True:
+                linestart[0] = fillscsv.tell()
+                line = fillscsv.readline()
+                if not line:
+                    return
+                yield line.decode("utf-8")
+
+        for values in csv.reader(lines(), delimiter=","):
+            if values:
+                yield Fill(dict(zip(fieldnames, values)), linestart[0])
+
+
+def mergeFills(fillspaths, stats=None, parse=parseFills):
+    """
+    Reads several time-ordered fills csvs (eg, overlapping monthly and yearly statements) as one, yielding Fills in time order.
+    fillspaths can also be a single path, which is just parsed.
+    A file is only opened once the merge reaches the time of its first fill, so files that don't overlap in time are
+    read one after the other. A fill that was already read from another file is dropped, counted in stats if given.
+    parse is the function that reads a single file (see CryptoTax.parseFillsFile). The first fill of each file is
+    found up front with parseFills whatever parse is, which only reads the header and first row, so eg the fill
+    cache of a file is only built once the merge reaches it.
+    """
+    if isinstance(fillspaths, str):
+        yield from parse(fillspaths)
+        return
+    # Files not opened yet, by the time of their first fill, latest first
+    waiting = []
+    for n, path in enumerate(fillspaths):
+        fills = parseFills(path)
+        first = next(fills, None)
+        fills.close()
+        if first is not None:
+            waiting.append((first.timestamp, n, path))
+    waiting.sort(reverse=True)
+    merging = []  # heap of (timestamp, n, fill, fills) with the next fill of each open file
+    seen = FillDeduper()
+    while merging or waiting:
+        while waiting and (not merging or waiting[-1][0] <= merging[0][0]):
+            timestamp, n, path = waiting.pop()
+            fills = parse(path)
+            fill = next(fills, None)
+            if fill is not None:
+                heapq.heappush(merging, (fill.timestamp, n, fill, fills))
+        timestamp, n, fill, fills = merging[0]
+        nextfill = next(fills, None)
+        if nextfill is None:
+            heapq.heappop(merging)
+        else:
+            heapq.heapreplace(merging, (nextfill.timestamp, n, nextfill, fills))
+        if seen.isNew(fill, n):
+            yield fill
+        elif stats is not None:
+            stats.count("duplicate fills dropped")
+
+
+class FillDeduper:
+    """
+    Recognizes fills read from more than one file, for fills arriving in time order.
+    A fill is identified by product and trade id. Fills without a trade id are identified by product, time, side,
+    size and total, and the number of times that combination has come up in the same file, so that identical
+    fills within one file are all kept, while the same rows in a second file are not.
+    Only the fills of the last DEDUPE_WINDOW seconds are remembered, so memory stays small.
+    """
+    def __init__(self):
+        self.kept = {}  # fill key to how many of that fill have been kept
+        self.counts = {}  # (fill key, file number) to how many of that fill were in that file
+        self.recent = collections.deque()  # (timestamp, fill key, file number) in the order seen
+
+    def isNew(self, fill, n):
+        if fill.tradeid != "":
+            key = (fill.product, fill.tradeid)
+        else:
+            key = (fill.product, fill.timestamp, fill.side, fill.sizestr, fill.totalstr)
+        recent = self.recent
+        while recent and fill.timestamp - recent[0][0] > DEDUPE_WINDOW:
+            timestamp, oldkey, oldn = recent.popleft()
+            self.counts.pop((oldkey, oldn), None)
+            self.kept.pop(oldkey, None)
+        recent.append((fill.timestamp, key, n))
+        count = self.counts.get((key, n), 0) + 1
+        self.counts[(key, n)] = count
+        if count > self.kept.get(key, 0):
+            self.kept[key] = count
+            return True
+        return False
+
+
+def windowedFills(fills, pricelogs=None, atend=None, pairprices=False, holdtail=False):
+    """
+    Yields each of the time-ordered fills together with a pricelogs dict (as made by CryptoTax.readFillsForPrices)
+    that holds every USD price within PRICE_TOLERANCE seconds of it, before or after, and with pairprices set,
+    the prices of the other markets too (see crossrates.pricelogKey).
+    Fills wait in a queue until a fill PRICE_TOLERANCE seconds later has been read, and prices are dropped once
+    they are too old for any fill still to come, so only the prices inside the window are kept.
+    pricelogs can be given to start with the prices of earlier fills (see CryptoTax.saveCheckpoint).
+    atend, if given, is called with the queue of fills still waiting and the pricelogs once all fills are read,
+    before the last fills are yielded. With holdtail set, those last fills are not yielded at all (see
+    CryptoTax.readFills).
+    """
+    if pricelogs is None:
+        pricelogs = {}
+    pending = collections.deque()  # fills read, but waiting for the look-ahead window to fill up
+    for fill in fills:
+        logged = fill.unit == "USD" or pairprices
+        if logged:
+            key = crossrates.pricelogKey(fill.product)
+            if not key in pricelogs:
+                pricelogs[key] = []
+            pricelogs[key].append((fill.timestamp, fill.price))
+        pending.append(fill)
+        # Every price that could be close enough to the oldest pending fill has been read once a fill
+        # PRICE_TOLERANCE seconds later shows up (the csv is ordered by time).
+        while fill.timestamp - pending[0].timestamp >= PRICE_TOLERANCE:
+            yield pending.popleft(), pricelogs
+        if logged:
+            trimPricelog(pricelogs[key], pending[0].timestamp)
+    if atend is not None:
+        atend(pending, pricelogs)
+    if holdtail:
+        return
+    while pending:
+        yield pending.popleft(), pricelogs
+
+
+def nearestPrice(pricelog, timestamp):
+    """
+    Binary search of a pricelog (ordered pairs of (timestamp,price)) for the entry closest in time to timestamp.
+    Returns None if the pricelog is empty.
+    """
+    if len(pricelog) == 0:
+        return None
+    index = bisect.bisect(pricelog, (timestamp, 0))
+    if index == 0:
+        return pricelog[0]
+    elif index == len(pricelog):
+        return pricelog[-1]
+    elif abs(pricelog[index][0] - timestamp) < abs(pricelog[index - 1][0] - timestamp):
+        return pricelog[index]
+    else:
+        return pricelog[index - 1]
 
-import cbpro
 
-import coinutil as cu
+def procuredCurrency(fill):
+    # The currency procured in a crypto-to-crypto fill, whose USD price is needed. None for fills in USD markets.
+    if fill.quotecurrency == "USD":
+        return None
+    return fill.basecurrency if fill.side == "BUY" else fill.quotecurrency
+
+
+def hashFileRange(path, start, end, sha=None):
+    # Adds the bytes of a file from start up to end to sha (a new hashlib.sha256 if None), and returns it
+    if sha is None:
+        sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = f.read(min(remaining, HASH_CHUNK_BYTES))
+            if not chunk:
+                break
+            sha.update(chunk)
+            remaining -= len(chunk)
+    return sha
+
+
+def isoRange(start, end):
+    # The API takes start and end times as ISO 8601 strings
+    return (
+        datetime.datetime.utcfromtimestamp(start).isoformat(),
+        datetime.datetime.utcfromtimestamp(end).isoformat(),
+    )
+
+
+def trimPricelog(pricelog, timestamp):
+    """
+    Drops the prices at the front of a time-ordered pricelog that are too old to be used for any fill at or after timestamp.
+    """
+    n = 0
+    while n < len(pricelog) and timestamp - pricelog[n][0] >= PRICE_TOLERANCE:
+        n += 1
+    if n:
+        del pricelog[:n]
 
 class CryptoTax:
     """
@@ -13,19 +477,58 @@ class CryptoTax:
     gains or losses from a disposal of crypto assets. This is the typical way capital
     gains and losses are calculated by a stock broker for clients' tax documents.
     """
-    def __init__(self, coinbase_key, coinbase_b64secret, coinbase_passphrase):
-        # Create cbpro objects to make API calls to coinbase
-        self.public_client = cbpro.PublicClient()
-        self.auth_client = cbpro.AuthenticatedClient(
-            coinbase_key, coinbase_b64secret, coinbase_passphrase
-        )
+    def __init__(
+        self,
+        coinbase_key=None,
+        coinbase_b64secret=None,
+        coinbase_passphrase=None,
+        candlecachepath=":memory:",
+        historicratesclient=None,
+        offline=False,
+        fixedpoint=False,
+        sinks=None,
+        fillcache=False,
+        publicclient=None,
+        crossrates=False,
+    ):
+        # The cbpro clients, MarketInfo and the historic rates client are only created (and their modules imported)
+        # the first time they are used, see the properties below. A run that finds every price in the fills or
+        # the candle cache never needs them.
+        # publicclient and historicratesclient can be given instead, eg replayclient.ReplayClient to run without the API.
+        self.coinbase_key = coinbase_key
+        self.coinbase_b64secret = coinbase_b64secret
+        self.coinbase_passphrase = coinbase_passphrase
+        self._public_client = publicclient
+        self._auth_client = None
+        self._mi = None
+        self._historicratesclient = historicratesclient
 
-        # coinutil is a library I wrote that contains common utilities for my Coinbase API related projects.
-        # MarketInfo mostly just keeps track of the current status of currency markets on Coinbase (eg, active, limited, disabled)
-        self.mi = cu.MarketInfo(self.public_client, self.auth_client)
+        # With offline set, the API is never used. A price that isn't in the fills or the candle cache is an error.
+        self.offline = offline
+
+        # With fixedpoint set, sizes, totals and bases are exact scaled integers instead of floats: crypto amounts in
+        # units of 10**-digits, and USD in 10**-USD_DIGITS dollars, parsed straight from the text in the fills csv.
+        # sizedigits has the digits of each currency, which grow as amounts with more decimals come up (see toUnits).
+        # Proceeds, cost and gain are then in 10**-USD_DIGITS dollars, and are only rounded to cents when written.
+        self.fixedpoint = fixedpoint
+        self.sizedigits = {}
+
+        # With fillcache set, the parsed fills of each fills csv are kept in a binary file next to it, and later runs
+        # read that instead of parsing the csv again while it is unchanged (see fillcache.py).
+        self.fillcache = fillcache
+
+        # With crossrates set, a crypto-to-crypto fill with no USD price close enough in the fills gets one derived from
+        # the prices of other markets in the fills (eg XTZ-BTC and BTC-USD), before asking the API (see crossrates.py).
+        # Each such transaction records where its price came from in "pricesource".
+        self.crossrates = crossrates
+        self._crossrateresolver = None
+
+        # Historic prices we had to get from the API are kept here, so we don't ask for the same prices again.
+        # Give a file path to keep them between runs.
+        self.candlecache = candlecache.CandleCache(candlecachepath)
 
         # A "holding" is a quantity of a cryptocurrency, its value in USD at time of acquisition ("basis") and date/time acquired.
-        # holdings is a dict that maps currency names to a list of holdings.
+        # holdings is a dict that maps currency names to a LotLedger of holdings.
         self.holdings = {}
 
         # Transactions are what will ultimately populate IRS form 8949.
@@ -33,7 +536,94 @@ class CryptoTax:
         # we will construct a "transaction" which records the date/time the asset was acquired,
         # and the gain/loss from the transaction.
         # Each transaction is a {description, date acquired, date disposed, proceeds, cost or basis, gain or loss}
+        # Transactions are handed to the sinks as they are made (see transactionsinks.py). Without sinks given,
+        # they are all kept in self.transactions. With sinks, nothing is kept, so memory doesn't grow with them.
         self.transactions = []
+        self.keepstransactions = sinks is None
+        if sinks is None:
+            sinks = [transactionsinks.ListSink(self.transactions)]
+        self.sinks = sinks
+
+        # Number of fills processed so far, and the last one
+        self.fillcount = 0
+        self.lastfill = None
+
+        # Number of transactions made so far, including those made before resuming from a checkpoint
+        self.transactioncount = 0
+
+        # (offset, sha256 of the fills file up to offset) of the checkpoint resumed from, so saveCheckpoint only has
+        # to hash what was read since
+        self.checkpointsha = None
+
+        # Counters and time spent per phase, see statsReport
+        self.stats = instrumentation.Instrumentation()
+
+    @property
+    def public_client(self):
+        # cbpro object to make API calls to coinbase
+        if self._public_client is None:
+            import cbpro
+
+            self._public_client = cbpro.PublicClient()
+        return self._public_client
+
+    @property
+    def auth_client(self):
+        if self._auth_client is None:
+            import cbpro
+
+            self._auth_client = cbpro.AuthenticatedClient(
+                self.coinbase_key, self.coinbase_b64secret, self.coinbase_passphrase
+            )
+        return self._auth_client
+
+    @property
+    def mi(self):
+        # coinutil is a library I wrote that contains common utilities for my Coinbase API related projects.
+        # MarketInfo mostly just keeps track of the current status of currency markets on Coinbase (eg, active, limited, disabled)
+        if self._mi is None:
+            import coinutil as cu
+
+            self._mi = cu.MarketInfo(self.public_client, self.auth_client)
+        return self._mi
+
+    @property
+    def historicratesclient(self):
+        # Historic prices are requested through this client, which keeps to the API's request limit
+        # and can make several requests at once.
+        if self._historicratesclient is None:
+            import priceclient
+
+            self._historicratesclient = priceclient.HistoricRatesClient()
+        return self._historicratesclient
+
+    @property
+    def crossrateresolver(self):
+        # Uses the markets of MarketInfo if it has been made already, otherwise those there are prices for
+        if self._crossrateresolver is None:
+            adjacency = self._mi.adjacency if self._mi is not None else None
+            self._crossrateresolver = crossrates.CrossRates(PRICE_TOLERANCE, adjacency)
+        return self._crossrateresolver
+
+    def parseFillsFile(self, fillspath, offset=None):
+        # Fills of a single fills csv, from the fill cache if it is on
+        if self.fillcache:
+            import fillcache
+
+            return fillcache.cachedFills(fillspath, offset)
+        return parseFills(fillspath, offset)
+
+    def cachedPriceColumns(self, fillspath):
+        # The prices and times of a single fills file from the fill cache's columns (see fillcache.priceColumns), or
+        # None if the fill cache is off or there are several files
+        if not self.fillcache or not isinstance(fillspath, str):
+            return None
+        import fillcache
+
+        t = time.perf_counter()
+        columns = fillcache.priceColumns(fillspath, self.crossrates)
+        self.stats.phasetimes["parse"] += time.perf_counter() - t
+        return columns
 
     def readFillsForPrices(self, fillspath):
         """
@@ -46,268 +636,503 @@ class CryptoTax:
         pricelogs = (
             {}
         )  # dict with basecurrency pointing to ordered pairs of (timestamp,price) where price is price in USD
+        # With crossrates, also product ids of the other markets pointing to their prices (see crossrates.pricelogKey)
+        columns = self.cachedPriceColumns(fillspath)
+        if columns is not None:
+            return {
+                key: list(zip(times.tolist(), prices.tolist()))
+                for key, (times, prices) in columns[0].items()
+            }
         # the csv is already ordered by time
-        with open(fillspath, newline="") as fillscsv:
-            fillsreader = csv.DictReader(fillscsv, delimiter=",")
-            for row in fillsreader:
-                if row["price/fee/total unit"] != "USD":
-                    continue
-                curr = row["size unit"]
-                if not curr in pricelogs:
-                    pricelogs[curr] = []
-                pricelogs[curr].append((float(row["timestamp"]), float(row["price"])))
+        for fill in self.stats.timedIter(mergeFills(fillspath, parse=self.parseFillsFile), "parse"):
+            if fill.unit != "USD" and not self.crossrates:
+                continue
+            key = crossrates.pricelogKey(fill.product)
+            if not key in pricelogs:
+                pricelogs[key] = []
+            pricelogs[key].append((fill.timestamp, fill.price))
         return pricelogs
 
     def readFillsForGains(self, fillspath, pricelogs):
         """
         Loop through the fills and add to or pull from holdings.
         Generate transactions whenever a crypto asset is disposed of.
-        The 'BUY' and 'SELL' side terminology is Coinbase's, and extremely important to keep straight.
+        pricelogs is the complete price history made by readFillsForPrices. It is put in a priceindex.PriceIndex, and
+        the prices of PRICE_BATCH_FILLS fills at a time are looked up at once (see batchPrices).
+        fillspath can also be a list of fills files, which are merged (see mergeFills), here and in
+        readFillsForPrices, readFills and planPriceFetches.
         """
-        with open(fillspath, newline="") as fillscsv:
-            fillsreader = csv.DictReader(fillscsv, delimiter=",")
-            i = 0
-            for row in fillsreader:
-                print("--------------")
-                print("i: {0}".format(i))
-                quotecurrency = row["product"].split("-")[1]
-                basecurrency = row["size unit"]
-                side = row["side"]
-                print(
-                    "{0} in {1}-{2}   tradeid:{3}".format(
-                        side, basecurrency, quotecurrency, row["trade id"]
-                    )
+        import priceindex
+
+        index = priceindex.PriceIndex.fromPricelogs(pricelogs)
+        fills = self.stats.timedIter(mergeFills(fillspath, self.stats, self.parseFillsFile), "parse")
+        while True:
+            batch = list(itertools.islice(fills, PRICE_BATCH_FILLS))
+            if not batch:
+                break
+            for fill, price in zip(batch, self.batchPrices(batch, index)):
+                self.processFill(fill, index, price)
+
+    def batchPrices(self, fills, index):
+        """
+        The USD prices of the currencies procured by crypto-to-crypto fills, for all of the fills at once, with one
+        search of index (a priceindex.PriceIndex) per currency.
+        Returns a list with the (price, pricesource) of each fill, or None for fills in USD markets and those with no
+        price within PRICE_TOLERANCE seconds, which are left to resolvePrice.
+        """
+        t = time.perf_counter()
+        resolved = [None] * len(fills)
+        positions = {}  # currency -> positions in fills of the fills procuring it
+        for n, fill in enumerate(fills):
+            curr = procuredCurrency(fill)
+            if curr is not None:
+                if not curr in positions:
+                    positions[curr] = []
+                positions[curr].append(n)
+        hits = 0
+        for curr, ns in positions.items():
+            prices, distances, outside = index.closestPrices(
+                curr, [fills[n].timestamp for n in ns], PRICE_TOLERANCE
+            )
+            source = curr + "-USD"
+            for n, price, far in zip(ns, prices.tolist(), outside.tolist()):
+                if not far:
+                    resolved[n] = (price, source)
+                    hits += 1
+        self.stats.counters["pricelog hits"] += hits
+        self.stats.phasetimes["price resolution"] += time.perf_counter() - t
+        return resolved
+
+    def readFills(self, fillspath, checkpointpath=None, final=False):
+        """
+        Single pass equivalent of readFillsForPrices followed by readFillsForGains.
+        The fills are read once. Instead of a complete price history, we keep a window of USD prices
+        reaching PRICE_TOLERANCE seconds behind and ahead of the fill being processed (see windowedFills).
+        closestPrice never uses a price further away than that, so the result is identical to the two-pass version,
+        while memory depends only on how many fills happen within the window, not on the size of the file.
+
+        If checkpointpath is given, the state is saved there at the end (see saveCheckpoint), and if a checkpoint
+        already exists there, processing resumes from it: only the fills added to the file since are read.
+        The fills of the last PRICE_TOLERANCE seconds of the file are then left for the next run, because fills
+        appended later may have their prices: they aren't processed, and the checkpoint is saved before them.
+        So each run's transactions are those of the fills from where the last run stopped to PRICE_TOLERANCE seconds
+        before the end of the file, and together they are the same as those of a single run over the whole file.
+        With final set (no more fills will be appended, or they are too late to matter), every fill is processed,
+        and the checkpoint is saved after the last one.
+        Checkpoints only work with a single fills file.
+        """
+        if checkpointpath is not None and not isinstance(fillspath, str):
+            raise Exception("A checkpoint can only be used with a single fills file")
+        offset = None
+        pricelogs = None
+        if checkpointpath is not None and os.path.exists(checkpointpath):
+            offset, pricelogs = self.loadCheckpoint(checkpointpath, fillspath)
+        atend = None
+        atendargs = []
+        if checkpointpath is not None:
+
+            def saveAtEnd(pending, pricelogs):
+                if final:
+                    # saved below, once the pending fills are processed too
+                    atendargs.append((pending, pricelogs))
+                else:
+                    self.saveCheckpoint(checkpointpath, fillspath, pending, pricelogs, offset)
+
+            atend = saveAtEnd
+
+        if offset is not None:
+            fills = self.parseFillsFile(fillspath, offset)
+        else:
+            fills = mergeFills(fillspath, self.stats, self.parseFillsFile)
+        self.processFills(fills, pricelogs, atend, holdtail=atend is not None and not final)
+        for pending, pricelogs in atendargs:
+            self.saveCheckpoint(
+                checkpointpath, fillspath, pending, pricelogs, offset, finished=True
+            )
+
+    def processFills(self, fills, pricelogs=None, atend=None, holdtail=False):
+        """
+        Same as readFills, for fills from anywhere instead of the modified fills csv: any iterable of Fill
+        in time order, such as ingest.joinStatements makes from the statements downloaded from Coinbase Pro.
+        pricelogs, atend and holdtail are passed on to windowedFills.
+        """
+        fills = self.stats.timedIter(fills, "parse")
+        for fill, pricelogs in windowedFills(fills, pricelogs, atend, self.crossrates, holdtail):
+            self.processFill(fill, pricelogs)
+
+    def saveCheckpoint(self, checkpointpath, fillspath, pending, pricelogs, offset=None, finished=False):
+        """
+        Saves the state after the last fill that has been processed with its full price window, so that a later run
+        over the same file, with more fills appended, can pick up from there.
+        pending are the fills read but not processed yet (see windowedFills). Those are read again when resuming,
+        so that they see the prices of any fills appended after them, the same as in a run over the whole file.
+        With finished set, pending have been processed since, and the checkpoint is after the last of them.
+        The checkpoint holds the position in the file, a hash of the whole file up to that position (to detect a
+        changed file), the open lots, and the USD prices that fills after that position may still need.
+        """
+        if pending and finished:
+            with open(fillspath, "rb") as f:
+                f.seek(pending[-1].offset)
+                f.readline()
+                offset = f.tell()
+            pending = ()
+        elif pending:
+            offset = pending[0].offset
+        elif offset is None:
+            with open(fillspath, "rb") as f:
+                offset = len(f.readline())
+        # The prices from pending fills are added again when those are read again
+        pendingprices = collections.Counter(
+            crossrates.pricelogKey(fill.product)
+            for fill in pending
+            if fill.unit == "USD" or self.crossrates
+        )
+        if self.checkpointsha is not None and self.checkpointsha[0] <= offset:
+            # the file up to the checkpoint resumed from was hashed when loading it
+            sha = hashFileRange(
+                fillspath, self.checkpointsha[0], offset, self.checkpointsha[1].copy()
+            )
+        else:
+            sha = hashFileRange(fillspath, 0, offset)
+        checkpoint = {
+            "fillspath": fillspath,
+            "offset": offset,
+            "sha256": sha.hexdigest(),
+            "fillcount": self.fillcount,
+            "transactioncount": self.transactioncount,
+            "lasttimestamp": self.lastfill.timestamp if self.lastfill else None,
+            "lasttradeid": self.lastfill.tradeid if self.lastfill else None,
+            "fixedpoint": self.fixedpoint,
+            "usddigits": USD_DIGITS,
+            "sizedigits": self.sizedigits,
+            "holdings": {
+                curr: ledger.toDict() for curr, ledger in self.holdings.items()
+            },
+            "pricelogs": {
+                curr: pricelog[: len(pricelog) - pendingprices[curr]]
+                for curr, pricelog in pricelogs.items()
+            },
+        }
+        with open(checkpointpath + ".tmp", "w") as f:
+            json.dump(checkpoint, f)
+        os.replace(checkpointpath + ".tmp", checkpointpath)
+        logger.info(
+            "Saved checkpoint after %s fills at offset %s", self.fillcount, offset
+        )
+
+    def loadCheckpoint(self, checkpointpath, fillspath):
+        """
+        Restores the state saved by saveCheckpoint, after checking that the fills file still starts the same: all of
+        it up to the checkpoint's position is hashed again.
+        Returns the offset to continue reading the file from, and the pricelogs to continue with.
+        """
+        with open(checkpointpath) as f:
+            checkpoint = json.load(f)
+        offset = checkpoint["offset"]
+        sha = None
+        if os.path.getsize(fillspath) >= offset:
+            sha = hashFileRange(fillspath, 0, offset)
+        if sha is None or sha.hexdigest() != checkpoint.get("sha256"):
+            raise Exception(
+                "{0} doesn't match checkpoint {1}. Fills can only be appended to the file to resume from a checkpoint.".format(
+                    fillspath, checkpointpath
                 )
-                if quotecurrency == "USD" and side == "BUY":
-                    # We are buying crypto with USD
-                    self.addToHoldings(
-                        basecurrency,
-                        float(row["size"]),
-                        -float(row["total"]),
-                        row["yyyy"],
-                        row["mm"],
-                        row["dd"],
-                    )  # Total is how much USD we spent, including fee, to procure size
-                    # There is no gain/loss to recognize.
-                elif quotecurrency != "USD" and side == "BUY":
-                    # We are buying crypto with BTC or ETH. These are the only cryptos used to buy other cryptos. In the docs below and variable names I write like this is BTC, even though it could be ETH.
-
-                    # We are exchanging BTC for property (another crypto)
-                    # This is recognizing a gain or loss between the basis of BTC (in USD) and the value of the procured crypto (in USD)
-                    # Pull out the total BTC we used to place the buy. A list of BTC holdings, each with possibly different bases and times is created, the sum of whose sizes is the total BTC
-                    holdinglist = self.pullFromHoldings(
-                        quotecurrency, -float(row["total"])
-                    )  # total is how much BTC we spent, including fee, to procure size of other currency
-
-                    basecurrencyprice = self.closestPrice(
-                        basecurrency, pricelogs[basecurrency], float(row["timestamp"])
-                    )
-                    usdvalueofcrypto = basecurrencyprice * float(row["size"])
+            )
+        self.checkpointsha = (offset, sha)
+        self.fillcount = checkpoint["fillcount"]
+        self.transactioncount = checkpoint["transactioncount"]
+        if checkpoint.get("fixedpoint", False) != self.fixedpoint:
+            raise Exception(
+                "Checkpoint {0} was saved with fixedpoint={1}".format(
+                    checkpointpath, not self.fixedpoint
+                )
+            )
+        if self.fixedpoint and checkpoint.get("usddigits") != USD_DIGITS:
+            raise Exception(
+                "Checkpoint {0} has USD amounts with other digits than {1}".format(
+                    checkpointpath, USD_DIGITS
+                )
+            )
+        self.sizedigits = checkpoint.get("sizedigits", {})
+        self.holdings = {
+            curr: LotLedger.fromDict(lots, self.fixedpoint)
+            for curr, lots in checkpoint["holdings"].items()
+        }
+        pricelogs = {
+            curr: [tuple(entry) for entry in pricelog]
+            for curr, pricelog in checkpoint["pricelogs"].items()
+        }
+        logger.info(
+            "Resuming from checkpoint after %s fills (last trade id %s at %s)",
+            self.fillcount,
+            checkpoint["lasttradeid"],
+            checkpoint["lasttimestamp"],
+        )
+        return offset, pricelogs
 
-                    # Recognize loss/gain of size usdvalueofcrypto-(total basis of btc)
-                    totalbasisbtc = (
-                        0.0  # This will be "cost or other basis" in IRS form 8949
-                    )
-                    dateacquired = ""
-                    for holding in holdinglist:
-                        totalbasisbtc += holding["usdbasis"]
-                        subdateacquired = "{0}/{1}/{2}".format(
-                            holding["mm"], holding["dd"], holding["yyyy"]
-                        )
-                        if dateacquired == "":
-                            dateacquired = subdateacquired
-                        if subdateacquired != dateacquired:
-                            dateacquired = "VARIOUS"  # If the assets being disposed of were acquired over multiple dates, the "date acquired" entry in the form will read "VARIOUS"
-                    datesold = "{0}/{1}/{2}".format(row["mm"], row["dd"], row["yyyy"])
-                    desc = "{0} {1} (virtual currency)".format(
-                        row["total"][1 : len(row["total"])], quotecurrency
-                    )  # remove the minus sign from the total. This is a human-readable string that will go in the IRS form, the number should just be shown unsigned
-                    self.transactions.append(
-                        {
-                            "description": desc,
-                            "dateacquired": dateacquired,
-                            "datesold": datesold,
-                            "proceeds": usdvalueofcrypto,
-                            "cost": totalbasisbtc,
-                            "gain": usdvalueofcrypto - totalbasisbtc,
-                            "row": row,
-                            "holdinglist": holdinglist,
-                        }
-                    )
+    def processFill(self, fill, pricelogs, price=None):
+        """
+        Add to or pull from holdings for a single fill, generating a transaction if a crypto asset is disposed of.
+        The 'BUY' and 'SELL' side terminology is Coinbase's, and extremely important to keep straight.
+        pricelogs must contain every USD price within PRICE_TOLERANCE seconds of the fill (see resolvePrice).
+        price, if given, is the (price, pricesource) of the procured currency already found (see batchPrices).
+        """
+        quotecurrency = fill.quotecurrency
+        basecurrency = fill.basecurrency
+        side = fill.side
+        if self.fixedpoint:
+            size = self.toUnits(basecurrency, fill.sizestr, fill)
+            total = self.toUnits(quotecurrency, fill.totalstr, fill)
+        else:
+            size = fill.size
+            total = fill.total
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "i: %s  %s in %s-%s   tradeid:%s",
+                self.fillcount,
+                side,
+                basecurrency,
+                quotecurrency,
+                fill.tradeid,
+            )
+        if quotecurrency == "USD" and side == "BUY":
+            # We are buying crypto with USD
+            self.addToHoldings(
+                basecurrency,
+                size,
+                -total,
+                fill.day,
+            )  # Total is how much USD we spent, including fee, to procure size
+            # There is no gain/loss to recognize.
+        elif quotecurrency != "USD" and side == "BUY":
+            # We are buying crypto with BTC or ETH. These are the only cryptos used to buy other cryptos. In the docs below and variable names I write like this is BTC, even though it could be ETH.
 
-                    # Finally, add the new currency to our holdings
-                    self.addToHoldings(
-                        basecurrency,
-                        float(row["size"]),
-                        usdvalueofcrypto,
-                        row["yyyy"],
-                        row["mm"],
-                        row["dd"],
-                    )
+            # We are exchanging BTC for property (another crypto)
+            # This is recognizing a gain or loss between the basis of BTC (in USD) and the value of the procured crypto (in USD)
+            # Pull out the total BTC we used to place the buy. A list of BTC holdings, each with possibly different bases and times is created, the sum of whose sizes is the total BTC
+            holdinglist = self.pullFromHoldings(
+                quotecurrency, -total
+            )  # total is how much BTC we spent, including fee, to procure size of other currency
 
-                elif quotecurrency != "USD" and side == "SELL":
-                    # We are selling crypto for BTC or ETH. Below I write as if the quote currency is BTC, even though it could also be ETH
+            basecurrencyprice, pricesource = price or self.resolvePrice(
+                basecurrency, pricelogs, fill.timestamp
+            )
+            usdvalueofcrypto = self.usdValue(basecurrency, basecurrencyprice, size, fill)
 
-                    # We are exchanging a crypto for BTC
-                    # This is recognizing a gain or loss between the basis of the crypto (in USD) and the value of the procured BTC (in USD)
-                    # Pull out the total crypto used to place the sell. A list of crypto holdings, each with possibly different bases and times is created, the sum of whose sizes is the total crypto
-                    holdinglist = self.pullFromHoldings(
-                        basecurrency, float(row["size"])
-                    )  # size is how much crypto we sold.
+            # Recognize loss/gain of size usdvalueofcrypto-(total basis of btc)
+            totalbasisbtc, dateacquired = self.basisAndDateAcquired(holdinglist)  # This will be "cost or other basis" in IRS form 8949
+            datesold = formatDay(fill.day)
+            desc = "{0} {1} (virtual currency)".format(
+                fill.totalstr[1 : len(fill.totalstr)], quotecurrency
+            )  # remove the minus sign from the total. This is a human-readable string that will go in the IRS form, the number should just be shown unsigned
+            self.addTransaction(
+                {
+                    "description": desc,
+                    "dateacquired": dateacquired,
+                    "datesold": datesold,
+                    "proceeds": usdvalueofcrypto,
+                    "cost": totalbasisbtc,
+                    "gain": usdvalueofcrypto - totalbasisbtc,
+                    "row": fill,
+                    "holdinglist": holdinglist,
+                    "pricesource": pricesource,
+                }
+            )
 
-                    quotecurrencyprice = self.closestPrice(
-                        quotecurrency, pricelogs[quotecurrency], float(row["timestamp"])
-                    )
-                    usdvalueofquotecurrency = quotecurrencyprice * float(
-                        row["total"]
-                    )  # total is the amount of BTC we procured, less fee
-
-                    # Recognize loss/gain of size usdvalueofquotecurrency-(total basis of crypto)
-                    # Sum up the bases in holdinglist, recognize the full gain or loss between usdvalueofquotecurrency and that full basis, and use "VARIOUS" as the date acquired.
-                    totalbasiscrypto = 0.0
-                    dateacquired = ""
-                    for holding in holdinglist:
-                        totalbasiscrypto += holding["usdbasis"]
-                        subdateacquired = "{0}/{1}/{2}".format(
-                            holding["mm"], holding["dd"], holding["yyyy"]
-                        )
-                        if dateacquired == "":
-                            dateacquired = subdateacquired
-                        if subdateacquired != dateacquired:
-                            dateacquired = "VARIOUS"  # If the assets being disposed of were acquired over multiple dates, the "date acquired" entry in the form will read "VARIOUS"
-                    datesold = "{0}/{1}/{2}".format(row["mm"], row["dd"], row["yyyy"])
-                    desc = "{0} {1} (virtual currency)".format(
-                        row["size"], basecurrency
-                    )
-                    self.transactions.append(
-                        {
-                            "description": desc,
-                            "dateacquired": dateacquired,
-                            "datesold": datesold,
-                            "proceeds": usdvalueofquotecurrency,
-                            "cost": totalbasiscrypto,
-                            "gain": usdvalueofquotecurrency - totalbasiscrypto,
-                            "row": row,
-                            "holdinglist": holdinglist,
-                        }
-                    )
+            # Finally, add the new currency to our holdings
+            self.addToHoldings(
+                basecurrency,
+                size,
+                usdvalueofcrypto,
+                fill.day,
+            )
 
-                    # Finally, add the new BTC to our holdings
-                    self.addToHoldings(
-                        quotecurrency,
-                        float(row["total"]),
-                        usdvalueofquotecurrency,
-                        row["yyyy"],
-                        row["mm"],
-                        row["dd"],
-                    )
+        elif quotecurrency != "USD" and side == "SELL":
+            # We are selling crypto for BTC or ETH. Below I write as if the quote currency is BTC, even though it could also be ETH
 
-                elif quotecurrency == "USD" and side == "SELL":
-                    # We are selling crypto for USD.
-
-                    # This is recognizing a loss between the basis of the crypto (in USD) and the USD procured
-                    # Pull out the total crypto we used to place the sell. a list of crypto holdings, each with possible different bases and times is created, the some of whose sizes it the total crypto
-                    holdinglist = self.pullFromHoldings(
-                        basecurrency, float(row["size"])
-                    )  #
-
-                    # Recognize the loss/gain of size totalusd-totalbasiscrypto
-                    totalusd = float(row["total"])
-                    totalbasiscrypto = 0.0
-                    dateacquired = ""
-                    for holding in holdinglist:
-                        totalbasiscrypto += holding["usdbasis"]
-                        subdateacquired = "{0}/{1}/{2}".format(
-                            holding["mm"], holding["dd"], holding["yyyy"]
-                        )
-                        if dateacquired == "":
-                            dateacquired = subdateacquired
-                        if subdateacquired != dateacquired:
-                            dateacquired = "VARIOUS"  # If the assets being disposed of were acquired over multiple dates, the "date acquired" entry in the form will read "VARIOUS"
-                    datesold = "{0}/{1}/{2}".format(row["mm"], row["dd"], row["yyyy"])
-                    desc = "{0} {1} (virtual currency)".format(
-                        row["size"], basecurrency
-                    )
-                    self.transactions.append(
-                        {
-                            "description": desc,
-                            "dateacquired": dateacquired,
-                            "datesold": datesold,
-                            "proceeds": totalusd,
-                            "cost": totalbasiscrypto,
-                            "gain": totalusd - totalbasiscrypto,
-                            "row": row,
-                            "holdinglist": holdinglist,
-                        }
-                    )
+            # We are exchanging a crypto for BTC
+            # This is recognizing a gain or loss between the basis of the crypto (in USD) and the value of the procured BTC (in USD)
+            # Pull out the total crypto used to place the sell. A list of crypto holdings, each with possibly different bases and times is created, the sum of whose sizes is the total crypto
+            holdinglist = self.pullFromHoldings(
+                basecurrency, size
+            )  # size is how much crypto we sold.
 
-                print("--------------")
-                i = i + 1
+            quotecurrencyprice, pricesource = price or self.resolvePrice(
+                quotecurrency, pricelogs, fill.timestamp
+            )
+            usdvalueofquotecurrency = self.usdValue(
+                quotecurrency, quotecurrencyprice, total, fill
+            )  # total is the amount of BTC we procured, less fee
+
+            # Recognize loss/gain of size usdvalueofquotecurrency-(total basis of crypto)
+            # Sum up the bases in holdinglist, recognize the full gain or loss between usdvalueofquotecurrency and that full basis, and use "VARIOUS" as the date acquired.
+            totalbasiscrypto, dateacquired = self.basisAndDateAcquired(holdinglist)
+            datesold = formatDay(fill.day)
+            desc = "{0} {1} (virtual currency)".format(fill.sizestr, basecurrency)
+            self.addTransaction(
+                {
+                    "description": desc,
+                    "dateacquired": dateacquired,
+                    "datesold": datesold,
+                    "proceeds": usdvalueofquotecurrency,
+                    "cost": totalbasiscrypto,
+                    "gain": usdvalueofquotecurrency - totalbasiscrypto,
+                    "row": fill,
+                    "holdinglist": holdinglist,
+                    "pricesource": pricesource,
+                }
+            )
 
-    def addToHoldings(self, curr, size, usdbasis, yyyy, mm, dd):
+            # Finally, add the new BTC to our holdings
+            self.addToHoldings(
+                quotecurrency,
+                total,
+                usdvalueofquotecurrency,
+                fill.day,
+            )
+
+        elif quotecurrency == "USD" and side == "SELL":
+            # We are selling crypto for USD.
+
+            # This is recognizing a loss between the basis of the crypto (in USD) and the USD procured
+            # Pull out the total crypto we used to place the sell. a list of crypto holdings, each with possible different bases and times is created, the some of whose sizes it the total crypto
+            holdinglist = self.pullFromHoldings(basecurrency, size)  #
+
+            # Recognize the loss/gain of size totalusd-totalbasiscrypto
+            totalusd = total
+            totalbasiscrypto, dateacquired = self.basisAndDateAcquired(holdinglist)
+            datesold = formatDay(fill.day)
+            desc = "{0} {1} (virtual currency)".format(fill.sizestr, basecurrency)
+            self.addTransaction(
+                {
+                    "description": desc,
+                    "dateacquired": dateacquired,
+                    "datesold": datesold,
+                    "proceeds": totalusd,
+                    "cost": totalbasiscrypto,
+                    "gain": totalusd - totalbasiscrypto,
+                    "row": fill,
+                    "holdinglist": holdinglist,
+                }
+            )
+
+        self.fillcount += 1
+        self.lastfill = fill
+        self.stats.counters["fills"] += 1
+
+    def addTransaction(self, transaction):
+        self.transactioncount += 1
+        t = time.perf_counter()
+        for sink in self.sinks:
+            sink.add(transaction)
+        self.stats.phasetimes["write"] += time.perf_counter() - t
+
+    def closeSinks(self):
+        # Call at the end of a run, so the sinks can finish writing their files
+        for sink in self.sinks:
+            sink.close()
+
+    def addToHoldings(self, curr, size, usdbasis, day):
         """
         Adds to the holdings of a currency, and records the date aqcquired.
         curr: currency being held
         size: size (amount) of currency being held
         usdbasis: how much USD it took to get this size of currency
+        day: date acquired, as a date ordinal
         """
+        t = time.perf_counter()
         if not curr in self.holdings:
             self.holdings[
                 curr
-            ] = []  # if there is no list of holdings yet for this currency, create it.
-        self.holdings[curr].append(
-            {"size": size, "usdbasis": usdbasis, "yyyy": yyyy, "mm": mm, "dd": dd}
-        )
+            ] = LotLedger(self.fixedpoint)  # if there are no holdings yet for this currency, create the ledger.
+        self.holdings[curr].add(size, usdbasis, day)
+        self.stats.phasetimes["fifo"] += time.perf_counter() - t
 
     def pullFromHoldings(self, curr, amt):
         """
         Removes a specified amount of a currency from the holdings, one holding at a time, until the full amount has been removed.
-        Returns a list of holdings pulled.
-        Each holding has {'size':size, 'usdbasis':usdbasis, 'yyyy':yyyy, 'mm':mm, 'dd':dd}
+        Returns a list of holdings pulled, oldest first.
+        Each holding pulled is a tuple of (size, usdbasis, day)
         amt is coming in as a float
         """
-        pulledholdinglist = (
-            []
-        )  # this will be returned. its a list of holdings whose size add up to the amt
-        holding = self.holdings[
-            curr
-        ]  # list of holdings in the currency. earliest acquired is index 0.
-        print("curr: {0}  amt: {1}".format(curr, amt))
-        amtleft = amt
-        while True:
-            print("*{0}".format(amtleft))
-            print("*{0}".format(holding))
-            if amtleft < holding[0]["size"]:
-                # the oldest holding is bigger than the amount we are pulling.
-                # decrement the oldest holding by amtleft
-                basis = amtleft / holding[0]["size"] * holding[0]["usdbasis"]
-                holding[0]["size"] = holding[0]["size"] - amtleft
-                holding[0]["usdbasis"] = holding[0]["usdbasis"] - basis
-                pulledholdinglist.append(
-                    {
-                        "size": amtleft,
-                        "usdbasis": basis,
-                        "yyyy": holding[0]["yyyy"],
-                        "mm": holding[0]["mm"],
-                        "dd": holding[0]["dd"],
-                    }
+        holding = self.holdings.get(curr)  # ledger of holdings in the currency.
+        logger.debug("curr: %s  amt: %s", curr, amt)
+        if holding is None or len(holding) == 0:
+            raise Exception(
+                "Tried to pull {0} {1} from holdings, but there are no {1} holdings".format(
+                    amt, curr
                 )
-                break
-            else:
-                # the oldest holding is equal or smaller than the amount we are pulling
-                amtleft -= holding[0]["size"]
-                pulledholdinglist.append(holding.pop(0))
-                if len(holding) == 0:
-                    print(
-                        "there were no holdings left with amtleft:{0}".format(amtleft)
-                    )  # This "warning" only matters if it says the amtleft is >0.0. (ie, that's a problem beause we want to pull more from holdings, but there's no holdings left.) It SHOULD print this warning with 0.0 if you just drew down the last of your holdings exactly.
-                    break
-                if amtleft <= 0:
-                    print(
-                        "while pulling amtleft was <= 0  amtleft:{0}".format(amtleft)
-                    )  # This "warning" only matters if amtleft is truly negative. That can't happen due to the enclosing if statement. That means this "warning" SHOULD display with 0.0 when the holding drawn from was EXACTLY the size of amtleft.
-                    break
-        return pulledholdinglist
+            )
+        t = time.perf_counter()
+        pulled = holding.pull(amt)
+        self.stats.phasetimes["fifo"] += time.perf_counter() - t
+        self.stats.counters["disposals"] += 1
+        self.stats.counters["lots scanned"] += len(pulled)
+        self.stats.maximum("most lots in a disposal", len(pulled))
+        return pulled
+
+    def basisAndDateAcquired(self, holdinglist):
+        """
+        Sums up the bases of a list of pulled holdings, and finds the "date acquired" entry for IRS form 8949.
+        If the assets being disposed of were acquired over multiple dates, the "date acquired" entry in the form will read "VARIOUS"
+        """
+        totalbasis = 0 if self.fixedpoint else 0.0
+        firstday = holdinglist[0][2]
+        various = False
+        for size, usdbasis, day in holdinglist:
+            totalbasis += usdbasis
+            if day != firstday:
+                various = True
+        dateacquired = "VARIOUS" if various else formatDay(firstday)
+        return totalbasis, dateacquired
+
+    def usdValue(self, curr, price, amount, fill=None):
+        """
+        USD value of an amount of crypto at a USD price.
+        In fixed-point mode, amount is in units of curr and the value in 10**-USD_DIGITS dollars. It is worked out with
+        decimal from the exact value of the price, and rounded once at the end. Raises an Exception naming fill if the
+        value is bigger than FIXED_MAX.
+        """
+        if not self.fixedpoint:
+            return price * amount
+        digits = self.sizedigits.get(curr, SIZE_DIGITS)
+        units = DECIMAL_CONTEXT.multiply(decimal.Decimal(price), amount).scaleb(
+            USD_DIGITS - digits, DECIMAL_CONTEXT
+        )
+        units = units.to_integral_value(decimal.ROUND_HALF_EVEN, DECIMAL_CONTEXT)
+        if not units.is_finite() or units.copy_abs() > FIXED_MAX:
+            raise Exception(
+                "{0}: {1} {2} at {3} USD doesn't fit in 64-bit units of 10**-{4} dollars".format(
+                    describeFill(fill), amount, curr, price, USD_DIGITS
+                )
+            )
+        return int(units)
+
+    def toUnits(self, curr, text, fill=None):
+        """
+        An amount from the fills csv in fixed-point units of curr: 10**-USD_DIGITS dollars for USD, and for a crypto
+        currency, units of its digits so far. If a crypto amount has more decimals than that, up to MAX_SIZE_DIGITS, the
+        units are made smaller first, and the lots held are scaled to them, so that amounts always match exactly.
+        Raises an Exception naming fill if the amount has too many decimals, or is too big (see toFixed).
+        """
+        try:
+            if curr == "USD":
+                return toFixed(text, USD_DIGITS)
+            digits = self.sizedigits.get(curr, SIZE_DIGITS)
+            needed = decimalPlaces(text)
+            if needed > MAX_SIZE_DIGITS:
+                raise Exception(
+                    "{0} {1} has more than {2} decimals".format(text, curr, MAX_SIZE_DIGITS)
+                )
+            units = toFixed(text, max(digits, needed))
+            if needed > digits:
+                if curr in self.holdings:
+                    self.holdings[curr].scaleSizes(10 ** (needed - digits))
+                logger.debug("%s amounts now have %s digits", curr, needed)
+                self.sizedigits[curr] = needed
+            return units
+        except Exception as e:
+            raise Exception("{0}: {1}".format(describeFill(fill), e))
 
     def closestPrice(self, curr, pricelog, timestamp):
         """
@@ -315,33 +1140,58 @@ class CryptoTax:
         If an entry is not found within 30 seconds of the queried time, get the historic price form the API
         pricelog is list of ordered pairs of (timestamp,price) where price is in USD
         """
-        if len(pricelog) == 0:
-            print("NO PRICE AVAILABLE")
-            return self.getHistoricPrice(curr, timestamp)
-        index = bisect.bisect(pricelog, (timestamp, 0))
-        if index == 0:
-            entry = pricelog[0]
-        elif index == len(pricelog):
-            entry = pricelog[-1]
+        return self.resolvePrice(curr, {curr: pricelog}, timestamp)[0]
+
+    def resolvePrice(self, curr, pricelogs, timestamp):
+        """
+        The USD price of a currency at timestamp, and where it came from ("pricesource"): the product whose fill it is
+        (eg "XTZ-USD"), the chain of products it was derived through (eg "XTZ-BTC BTC-USD", with crossrates set),
+        or "api".
+        The closest USD price in pricelogs is used if it is within PRICE_TOLERANCE seconds, then a cross rate,
+        and only then the API (see getHistoricPrice).
+        pricelogs is a dict of pricelogs, or a priceindex.PriceIndex of them.
+        """
+        t = time.perf_counter()
+        if hasattr(pricelogs, "nearest"):
+            nearest = pricelogs.nearest
         else:
-            if abs(pricelog[index][0] - timestamp) < abs(
-                pricelog[index - 1][0] - timestamp
-            ):
-                entry = pricelog[index]
-            else:
-                entry = pricelog[index - 1]
-        if abs(entry[0] - timestamp) < 30.0:
-            return entry[1]
+
+            def nearest(key, timestamp):
+                return nearestPrice(pricelogs.get(key, []), timestamp)
+
+        entry = nearest(curr, timestamp)
+        if entry is not None and abs(entry[0] - timestamp) < PRICE_TOLERANCE:
+            self.stats.counters["pricelog hits"] += 1
+            self.stats.phasetimes["price resolution"] += time.perf_counter() - t
+            return entry[1], curr + "-USD"
+        self.stats.counters["pricelog misses"] += 1
+        if self.crossrates:
+            derived = self.crossrateresolver.derivePrice(
+                curr,
+                timestamp,
+                pricelogs.times.keys() if hasattr(pricelogs, "times") else pricelogs.keys(),
+                nearest,
+            )
+            if derived is not None:
+                self.stats.counters["cross rate hits"] += 1
+                self.stats.phasetimes["price resolution"] += time.perf_counter() - t
+                logger.debug("Price for %s at %s from %s", curr, timestamp, derived[1])
+                return derived[0], " ".join(derived[1])
+            self.stats.counters["cross rate misses"] += 1
+        if entry is None:
+            logger.info("NO PRICE AVAILABLE for %s at %s", curr, timestamp)
         else:
-            print("NO PRICE ENTRY CLOSE ENOUGH")
-            time.sleep(1.01)  # Avoid too many requests.
-            return self.getHistoricPrice(curr, timestamp)
+            logger.info("NO PRICE ENTRY CLOSE ENOUGH for %s at %s", curr, timestamp)
+        price = self.getHistoricPrice(curr, timestamp)
+        self.stats.phasetimes["price resolution"] += time.perf_counter() - t
+        return price, "api"
 
     def getHistoricPrice(self, curr, timestamp):
         """
         Obtains historical price for a currency. Used only in case our fills document did not already provide a close-enough price.
         Searches first for exact candle (within 1 minute), then requests larger candles if smaller candles are unavailable.
         (A "candle" is the opening, closing, high, and low prices for a currency within a time period.)
+        Candles that were fetched before, in this run or an earlier one, come from the candle cache instead of the API.
 
         Statement from CB Pro provides ISO 8601 string for date/time
         In excel, I convert that to POSIX timestamp, ie seconds since jan 1 1970.
@@ -351,48 +1201,40 @@ class CryptoTax:
         Coinbase's auth_client_get_product_historic_rates takes ISO strings as start/end parameters, but returns time in timestamp format. Eyeroll.
         The returned candle is  [bucketstarttime, low, high, open, close, volume]
         """
-        print(
-            "Attempting to find historical USD price for {0} at {1}".format(
-                curr, timestamp
-            )
+        logger.info(
+            "Attempting to find historical USD price for %s at %s", curr, timestamp
         )
         # this attempts to capture the exact candle of size 60s that contains the time requested
-        info = self.mi.auth_client.get_product_historic_rates(
-            curr + "-USD",
-            start=datetime.datetime.utcfromtimestamp(timestamp - 60).isoformat(),
-            end=datetime.datetime.utcfromtimestamp(timestamp).isoformat(),
-            granularity=60,
-        )
+        info = self.getCandles(curr + "-USD", timestamp - 60, timestamp, 60)
         if type(info) == list:
             if len(info) == 1:
                 candle = info[0]
                 return (candle[3] + candle[4]) * 0.5
             elif len(info) == 0:
-                print("the list thats supposed to have historical data in it is empty")
+                logger.info("the list thats supposed to have historical data in it is empty")
             else:
-                print(
+                logger.debug(
                     "We tried to get 1 candle, but we got more back, using the first candle"
                 )
                 candle = info[0]
                 return (candle[3] + candle[4]) * 0.5
         else:
-            print(
-                "oops, we got something non-list back instead of a list of historical data."
+            logger.warning(
+                "oops, we got something non-list back instead of a list of historical data: %s",
+                info,
             )
 
-        time.sleep(1.0)
-
         # Expand the queried times, find the best time
-        print("trying expanded second query of historical data")
-        info = self.mi.auth_client.get_product_historic_rates(
+        logger.info("trying expanded second query of historical data")
+        info = self.getCandles(
             curr + "-USD",
-            start=datetime.datetime.utcfromtimestamp(timestamp - 1200).isoformat(),
-            end=datetime.datetime.utcfromtimestamp(timestamp + 1200).isoformat(),
-            granularity=60,
+            timestamp - PRICE_FETCH_MARGIN,
+            timestamp + PRICE_FETCH_MARGIN,
+            60,
         )
         if type(info) == list:
             if len(info) == 0:
-                print("the list thats supposed to have historical data in it is empty")
+                logger.info("the list thats supposed to have historical data in it is empty")
             else:
                 closestprice = 0.0
                 deltat = 100000000
@@ -402,23 +1244,17 @@ class CryptoTax:
                         closestprice = (candle[3] + candle[4]) * 0.5
                 return closestprice
         else:
-            print(
-                "oops, we got something non-list back instead of a list of historical data."
+            logger.warning(
+                "oops, we got something non-list back instead of a list of historical data: %s",
+                info,
             )
 
-        time.sleep(1.0)
-
         # Expand the queried times, granularity 1hr, find the best time. search +/- 12 hrs.
-        print("Trying expanded hour query of historical data")
-        info = self.mi.auth_client.get_product_historic_rates(
-            curr + "-USD",
-            start=datetime.datetime.utcfromtimestamp(timestamp - 45000).isoformat(),
-            end=datetime.datetime.utcfromtimestamp(timestamp + 45000).isoformat(),
-            granularity=3600,
-        )
+        logger.info("Trying expanded hour query of historical data")
+        info = self.getCandles(curr + "-USD", timestamp - 45000, timestamp + 45000, 3600)
         if type(info) == list:
             if len(info) == 0:
-                print("the list thats supposed to have historical data in it is empty")
+                logger.info("the list thats supposed to have historical data in it is empty")
             else:
                 closestprice = 0.0
                 deltat = 100000000
@@ -428,33 +1264,201 @@ class CryptoTax:
                         closestprice = (candle[3] + candle[4]) * 0.5
                 return closestprice
         else:
-            print(
-                "oops, we got something non-list back instead of a list of historical data."
+            logger.warning(
+                "oops, we got something non-list back instead of a list of historical data: %s",
+                info,
             )
 
         # We can't find historical price data, something is seriously wrong somewhere, or API is down/disfunctional.
-        print("Could not find good historical price")
+        logger.error("Could not find good historical price for %s at %s", curr, timestamp)
         raise Exception("Could not find good historical price")
 
+    def getCandles(self, pid, start, end, granularity):
+        """
+        Historic rates for a product between two timestamps, as a list of candles, newest first.
+        Answered from the candle cache; only the parts of the range the cache doesn't have are requested from the API.
+        If the API sends back something other than a list (an error message), that is returned instead.
+        """
+        missing = self.candlecache.missingRanges(pid, granularity, start, end)
+        self.stats.count("candle cache misses" if missing else "candle cache hits")
+        for missingstart, missingend in missing:
+            info = self.fetchCandles(pid, missingstart, missingend, granularity)
+            if type(info) != list:
+                return info
+        return self.candlecache.getCandles(pid, granularity, start, end)
+
+    def fetchCandles(self, pid, start, end, granularity):
+        """
+        Requests historic rates from the API and stores them in the candle cache.
+        Returns the API's response.
+        """
+        if self.offline:
+            return {"message": "offline, not requesting historic rates for " + pid}
+        info = self.historicratesclient.get_product_historic_rates(
+            pid, *isoRange(start, end), granularity=granularity
+        )
+        if type(info) == list:
+            self.candlecache.addCandles(pid, granularity, start, end, info)
+        return info
+
+    def planPriceFetches(self, fillspath):
+        """
+        Finds every crypto-to-crypto fill that has no USD price in the fills within PRICE_TOLERANCE seconds,
+        ie every fill for which closestPrice will have to fall back to getHistoricPrice.
+        The USD prices and the times of the crypto-to-crypto fills are collected into a PriceIndex and arrays,
+        and then resolved per currency all at once. With crossrates, fills whose price can be derived from other
+        markets are left out too.
+        getHistoricPrice looks at the minute candles within PRICE_FETCH_MARGIN seconds of the fill, so those ranges are
+        grouped by product, the parts already in the candle cache are left out, and the rest is packed into as few
+        requests of MAX_CANDLES candles as possible.
+        Returns the plan, a list of (pid, start, end, granularity) requests for fetchPlannedPrices.
+        """
+        import numpy as np
+
+        import priceindex
+
+        t = time.perf_counter()
+        usdtimes = {}  # currency -> times of the USD fills (and with crossrates, product -> times of its other fills)
+        usdprices = {}  # currency -> prices of the USD fills (and product -> prices)
+        querytimes = {}  # currency -> times of the crypto-to-crypto fills procuring it
+        columns = self.cachedPriceColumns(fillspath)
+        if columns is not None:
+            for key, (times, prices) in columns[0].items():
+                usdtimes[key] = times
+                usdprices[key] = prices
+            querytimes = columns[1]
+        else:
+            for fill in mergeFills(fillspath, parse=self.parseFillsFile):
+                if fill.unit == "USD" or self.crossrates:
+                    key = crossrates.pricelogKey(fill.product)
+                    if not key in usdtimes:
+                        usdtimes[key] = array.array("d")
+                        usdprices[key] = array.array("d")
+                    usdtimes[key].append(fill.timestamp)
+                    usdprices[key].append(fill.price)
+                curr = procuredCurrency(fill)
+                if curr is not None:
+                    if not curr in querytimes:
+                        querytimes[curr] = array.array("d")
+                    querytimes[curr].append(fill.timestamp)
+        index = priceindex.PriceIndex()
+        for curr in usdtimes:
+            index.add(curr, usdtimes[curr], usdprices[curr])
+
+        ranges = {}  # pid -> list of (start, end) that getHistoricPrice will want to look at
+        nfills = 0
+        for curr in querytimes:
+            timestamps = np.asarray(querytimes[curr], dtype=np.float64)
+            prices, distances, outside = index.closestPrices(
+                curr, timestamps, PRICE_TOLERANCE
+            )
+            missing = timestamps[outside]
+            if self.crossrates and len(missing):
+                # those with a cross rate won't need the API either
+                missing = np.array(
+                    [
+                        timestamp
+                        for timestamp in missing.tolist()
+                        if self.crossrateresolver.derivePrice(
+                            curr, timestamp, usdtimes, index.nearest
+                        )
+                        is None
+                    ]
+                )
+            nfills += len(missing)
+            if len(missing):
+                ranges[curr + "-USD"] = [
+                    (t - PRICE_FETCH_MARGIN, t + PRICE_FETCH_MARGIN)
+                    for t in missing.tolist()
+                ]
+
+        plan = []
+        granularity = 60
+        windowlength = (MAX_CANDLES - 1) * granularity
+        for pid in ranges:
+            missing = []
+            for start, end in ranges[pid]:
+                missing.extend(
+                    self.candlecache.missingRanges(pid, granularity, start, end)
+                )
+            # Cover the missing ranges left to right. Each request starts at the first point not covered yet.
+            missing.sort()
+            coveredto = None
+            for start, end in missing:
+                if coveredto is not None and end <= coveredto:
+                    continue
+                if coveredto is not None and start < coveredto:
+                    start = coveredto
+                while coveredto is None or coveredto < end:
+                    windowstart = start - start % granularity
+                    coveredto = windowstart + windowlength
+                    plan.append((pid, windowstart, coveredto, granularity))
+                    start = coveredto
+        self.stats.phasetimes["plan"] += time.perf_counter() - t
+        self.stats.counters["fills needing historical price"] = nfills
+        logger.info(
+            "%s fills need a historical price. Planned %s historical price requests",
+            nfills,
+            len(plan),
+        )
+        return plan
+
+    def fetchPlannedPrices(self, plan):
+        """
+        Makes the requests planned by planPriceFetches, several at a time, filling the candle cache.
+        """
+        if self.offline and plan:
+            logger.warning(
+                "offline, not making %s planned historical price requests", len(plan)
+            )
+            return
+        logger.info("Fetching %s planned historical price requests", len(plan))
+        with self.stats.phase("fetch"):
+            responses = self.historicratesclient.getManyHistoricRates(
+                [
+                    (pid, *isoRange(start, end), granularity)
+                    for pid, start, end, granularity in plan
+                ]
+            )
+        for (pid, start, end, granularity), info in zip(plan, responses):
+            if type(info) == list:
+                self.candlecache.addCandles(pid, granularity, start, end, info)
+            else:
+                logger.warning(
+                    "oops, we got something non-list back instead of a list of historical data. %s: %s",
+                    pid,
+                    info,
+                )
+
     def sumHoldings(self, holding):
-        totalsize = 0.0
-        for h in holding:
-            totalsize += h["size"]
-        return totalsize
+        # holding is a LotLedger, which keeps its total up to date
+        return holding.totalsize
 
     def writeTransactions(self, path):
         # Write transactions to csv in a way that can easily be transferred to IRS form 8949
-        with open(path, "w", newline="") as f:
-            fieldnames = [
-                "description",
-                "dateacquired",
-                "datesold",
-                "proceeds",
-                "cost",
-                "gain",
-            ]
-            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction="ignore")
-
-            writer.writeheader()
+        if not self.keepstransactions:
+            raise Exception(
+                "With sinks, transactions aren't kept to write at the end. Add a transactionsinks.Form8949Writer to the sinks instead."
+            )
+        with self.stats.phase("write"), transactionsinks.Form8949Writer(
+            path, self.fixedpoint
+        ) as writer:
             for t in self.transactions:
-                writer.writerow(t)
+                writer.add(t)
+
+    def statsReport(self):
+        """
+        Counters and time per phase for everything done so far, including the API calls made by the historic rates client
+        and the time it spent waiting on the rate limit. See instrumentation.Instrumentation.
+        """
+        report = self.stats.report()
+        client = self._historicratesclient  # don't create it just to report nothing
+        report["counters"]["api calls"] = getattr(client, "apicalls", 0)
+        report["counters"]["api retries"] = getattr(client, "retries", 0)
+        report["phases"]["sleeping"] = getattr(client, "sleeptime", 0.0)
+        return report
+
+    def writeStats(self, path):
+        # Write statsReport to a JSON file
+        with open(path, "w") as f:
+            json.dump(self.statsReport(), f, indent=2)
@@ -1,8 +1,13 @@
+import logging
 import os
 
 import dotenv
 
 import cryptotax
+import instrumentation
+
+# Show progress messages, but not a message for every fill. Use logging.DEBUG to see every fill and every holding pulled.
+logging.basicConfig(level=logging.INFO, format="%(message)s")
 
 # load environment variables containing my Coinbase API keys
 dotenv.load_dotenv()
@@ -17,15 +22,41 @@ passphrase = os.getenv("coinbase_passphrase")
 # A "fill" means an order submitted to Coinbase was executed, or "filled". See README.md for more.
 # So this is a list of all filled orders.
 fillspath = "example_fills_data/fills_2019.csv"
+# To make it from the "fills" and "accounts" statements as downloaded, instead of by hand in Excel:
+# ingest.writeFills("fills.csv", "account.csv", fillspath)
+# fillspath can also be a list of overlapping fills files, eg monthly and yearly statements; fills in more than one are
+# only counted once.
 
-# Create the CryptoTax object and give it the Coinbase API keys
-ct = cryptotax.CryptoTax(key, b64secret, passphrase)
+# Historic prices obtained from the API are saved here, so running again doesn't have to request them again.
+candlecachepath = "candlecache.sqlite"
 
-# Create the pricelogs used to look up historical prices (see README.md for more)
-pricelogs = ct.readFillsForPrices(fillspath)
+# Create the CryptoTax object and give it the Coinbase API keys
+# Add fixedpoint=True to do the arithmetic exactly in integer units of each currency and nano-dollars instead of floats.
+# Add crossrates=True to derive prices from other markets in the fills (eg XTZ-BTC and BTC-USD) before asking the API.
+# Add fillcache=True to keep the parsed fills in a binary file next to the csv, so runs after the first don't parse it again.
+# To run without the API, record its responses once with replayclient.RecordingClient and give
+# historicratesclient=replayclient.ReplayClient(archivepath) (see replayclient.py).
+ct = cryptotax.CryptoTax(key, b64secret, passphrase, candlecachepath)
+
+# Find the crypto-to-crypto fills with no close enough USD price in the fills, and get the historical prices
+# for all of them from the API in as few requests as possible, before the gains are calculated.
+plan = ct.planPriceFetches(fillspath)
+ct.fetchPlannedPrices(plan)
 
 # Loop through the fills and add to or pull from holdings, generating transactions whenever a crypto asset is disposed of.
-ct.readFillsForGains(fillspath, pricelogs)
+# Prices for crypto-to-crypto trades are looked up from the USD fills close by in time (see README.md for more).
+# This reads the fills once; ct.readFillsForPrices followed by ct.readFillsForGains does the same in two passes.
+# For a fills file that new fills keep getting appended to, ct.readFills(fillspath, checkpointpath) saves the
+# holdings at the end, and the next run only processes the fills appended since. The last PRICE_TOLERANCE seconds
+# of fills wait for the next run, unless final=True is given (see CryptoTax.readFills).
+ct.readFills(fillspath)
 
 # Write the transactions to a csv in a format easily transferable to IRS form 8949
 ct.writeTransactions("transactions.csv")
+# For very many transactions, give CryptoTax sinks instead, so they are written as they are made rather than kept
+# in memory, eg sinks=[transactionsinks.Form8949Writer("transactions.csv"), transactionsinks.ScheduleDTotals("scheduled.json")],
+# and call ct.closeSinks() at the end.
+
+# Time spent in each phase, and counters such as how many prices had to be requested from the API
+print(instrumentation.formatReport(ct.statsReport()))
+ct.writeStats("runstats.json")
@@ -0,0 +1,161 @@
+# A binary cache of the parsed fills, kept next to the fills csv, so that a run over a file that hasn't changed
+# doesn't have to parse the csv again.
+# The fills are saved as a NumPy structured array (one fixed-width record per fill, holding just the fields of
+# cryptotax.Fill), which later runs memory-map instead of reading. A small JSON file beside it records which
+# version of the csv it was made from.
+# The price passes of CryptoTax take the columns they need straight from the array (see priceColumns). The gains pass
+# goes through the fills one at a time, so it still gets a Fill made for each record (see cachedFills), which is most of
+# the time of a run from the cache.
+import hashlib
+import json
+import logging
+import os
+
+import numpy as np
+
+import crossrates
+import cryptotax
+
+logger = logging.getLogger(__name__)
+
+# Fills are turned back into Fill objects this many records at a time
+CHUNK_ROWS = 65536
+
+
+def cachePaths(fillspath):
+    return fillspath + ".fillcache.npy", fillspath + ".fillcache.json"
+
+
+def fileSha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def loadFillArray(fillspath):
+    """
+    Returns the parsed fills of the csv as a memory-mapped structured array, with a field for each attribute of
+    cryptotax.Fill, building the cache first if it is missing or out of date.
+    The cache is used if the csv has the size and modification time recorded for it, or failing that, the same
+    SHA-256 hash (eg, the file was copied or touched).
+    """
+    arraypath, metapath = cachePaths(fillspath)
+    stat = os.stat(fillspath)
+    meta = None
+    if os.path.exists(arraypath) and os.path.exists(metapath):
+        with open(metapath) as f:
+            meta = json.load(f)
+        if meta["size"] != stat.st_size:
+            meta = None
+        elif meta["mtime_ns"] != stat.st_mtime_ns:
+            if meta["sha256"] == fileSha256(fillspath):
+                meta["mtime_ns"] = stat.st_mtime_ns
+                writeJson(meta, metapath)
+            else:
+                meta = None
+    if meta is None:
+        logger.info("Parsing %s into %s", fillspath, arraypath)
+        buildCache(fillspath, arraypath, metapath, stat)
+    return np.load(arraypath, mmap_mode="r")
+
+
+def buildCache(fillspath, arraypath, metapath, stat):
+    columns = {name: [] for name in cryptotax.Fill.__slots__}
+    for fill in cryptotax.parseFills(fillspath):
+        for name, values in columns.items():
+            values.append(getattr(fill, name))
+    n = len(columns["offset"])
+    dtype = []
+    for name, values in columns.items():
+        if name in ("timestamp", "size", "price", "total"):
+            dtype.append((name, "<f8"))
+        elif name in ("day", "offset"):
+            dtype.append((name, "<i8"))
+        else:
+            # text columns are as wide as the longest value in the file
+            dtype.append((name, "<U{0}".format(max([len(v) for v in values], default=1) or 1)))
+    fills = np.empty(n, dtype=dtype)
+    for name, values in columns.items():
+        fills[name] = values
+    with open(arraypath + ".tmp", "wb") as f:
+        np.save(f, fills)
+    os.replace(arraypath + ".tmp", arraypath)
+    writeJson(
+        {
+            "fillspath": os.path.basename(fillspath),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": fileSha256(fillspath),
+            "rows": n,
+        },
+        metapath,
+    )
+
+
+def writeJson(meta, path):
+    with open(path + ".tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(path + ".tmp", path)
+
+
+def cachedFills(fillspath, offset=None):
+    """
+    Same as cryptotax.parseFills, but from the cache. Yields a Fill for each row of the csv, starting at the row at
+    offset (bytes into the csv) if given.
+    """
+    fills = loadFillArray(fillspath)
+    start = 0
+    if offset is not None:
+        start = int(np.searchsorted(fills["offset"], offset))
+    new = cryptotax.Fill.__new__
+    Fill = cryptotax.Fill
+    for i in range(start, len(fills), CHUNK_ROWS):
+        for record in fills[i : i + CHUNK_ROWS].tolist():
+            # the fields are in the order of Fill.__slots__
+            fill = new(Fill)
+            (
+                fill.tradeid,
+                fill.product,
+                fill.side,
+                fill.basecurrency,
+                fill.quotecurrency,
+                fill.timestamp,
+                fill.size,
+                fill.sizestr,
+                fill.price,
+                fill.total,
+                fill.totalstr,
+                fill.unit,
+                fill.day,
+                fill.offset,
+            ) = record
+            yield fill
+
+
+def priceColumns(fillspath, pairprices=False):
+    """
+    The prices and times that CryptoTax's price passes collect from the fills (see CryptoTax.readFillsForPrices and
+    planPriceFetches), straight from the columns of the cache instead of from a Fill for each row.
+    Returns (prices, querytimes). prices maps each pricelogs key (see crossrates.pricelogKey) to arrays of the times
+    and prices of its fills, only those in USD markets unless pairprices is set. querytimes maps each currency to the
+    times of the crypto-to-crypto fills procuring it (see cryptotax.procuredCurrency). All are in the order of the csv.
+    """
+    fills = loadFillArray(fillspath)
+    timestamps = np.asarray(fills["timestamp"])
+    products, codes = np.unique(fills["product"], return_inverse=True)
+    keys = [crossrates.pricelogKey(pid) for pid in products.tolist()]
+    logged = np.ones(len(fills), dtype=bool) if pairprices else fills["unit"] == "USD"
+    prices = {}
+    for key in set(keys):
+        rows = np.isin(codes, [code for code, k in enumerate(keys) if k == key]) & logged
+        if rows.any():
+            prices[key] = (timestamps[rows], np.asarray(fills["price"][rows]))
+    procured = np.where(fills["side"] == "BUY", fills["basecurrency"], fills["quotecurrency"])
+    crypto = fills["quotecurrency"] != "USD"
+    querytimes = {}
+    for curr in np.unique(procured[crypto]).tolist():
+        querytimes[curr] = timestamps[crypto & (procured == curr)]
+    return prices, querytimes
+
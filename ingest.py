@@ -0,0 +1,279 @@
+# Builds the modified fills (see README.md) straight from the "fills" and "accounts" statements downloaded from Coinbase Pro,
+# instead of joining them by hand in Excel.
+# Each fill gets the time of its trade from the accounts statement, which has the correct order of trades, and the
+# fills are sorted by that time. Times are kept to the millisecond.
+# Both statements are read one row at a time. When they are too big to join in memory, they are split into
+# partitions by trade id in temporary files, and sorted runs are written to temporary files and merged.
+import csv
+import datetime
+import heapq
+import logging
+import os
+import tempfile
+import zlib
+
+import cryptotax
+
+logger = logging.getLogger(__name__)
+
+# Statements bigger than this (in bytes) are joined in partitions, and at most this many fills are sorted in memory at once
+JOIN_MEMORY_BYTES = 256 * 1024 * 1024
+SORT_RUN_ROWS = 500000
+
+# The columns of the modified fills csv written by writeFills
+FILLS_COLUMNS = [
+    "portfolio",
+    "trade id",
+    "product",
+    "side",
+    "created at",
+    "size",
+    "size unit",
+    "price",
+    "fee",
+    "total",
+    "price/fee/total unit",
+    "accttime",
+    "timestamp",
+    "yyyy",
+    "mm",
+    "dd",
+]
+
+# The columns of the fills statement kept in the temporary files
+RAW_FILL_COLUMNS = [
+    "portfolio",
+    "trade id",
+    "product",
+    "side",
+    "created at",
+    "size",
+    "size unit",
+    "price",
+    "fee",
+    "total",
+    "price/fee/total unit",
+]
+
+# The columns of the accounts statement kept in the temporary files
+ACCOUNT_COLUMNS = ["trade id", "time", "amount/balance unit"]
+
+
+def parseTime(isotime):
+    """
+    Seconds since the epoch (UTC) from a statement's ISO 8601 time, eg 2019-08-28T01:32:08.457Z, keeping the milliseconds.
+    """
+    if isotime.endswith("Z"):
+        isotime = isotime[:-1] + "+00:00"
+    return datetime.datetime.fromisoformat(isotime).timestamp()
+
+
+def readStatement(paths):
+    # Rows of one or more statement csvs, as dicts
+    if isinstance(paths, str):
+        paths = [paths]
+    for path in paths:
+        with open(path, newline="", encoding="utf-8-sig") as f:
+            for row in csv.DictReader(f):
+                yield row
+
+
+def statementSize(paths):
+    if isinstance(paths, str):
+        paths = [paths]
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def partitionOf(tradeid, npartitions):
+    return zlib.crc32(tradeid.encode()) % npartitions
+
+
+def accountTimes(accountrows):
+    """
+    Maps (trade id, currency) to a list of (time, position) for the account entries of trades.
+    A trade has an entry for each currency it changes, one after the other in the accounts statement and with the same
+    time; position is the place of the first of them, to keep trades with the same time in the order the accounts
+    statement has them.
+    Trade ids are only unique within a product, so the currency is part of the key, and a key can still have the entries
+    of several trades (eg trade 100 of BTC-USD and of ETH-BTC both change BTC). See matchRows.
+    """
+    times = {}
+    last = None  # (trade id, time, position, position of the trade's first entry) of the previous row
+    for position, row in accountrows:
+        tradeid = row["trade id"]
+        if tradeid == "":
+            last = None
+            continue  # deposits, withdrawals, etc.
+        if last is not None and last[:3] == (tradeid, row["time"], position - 1):
+            first = last[3]
+        else:
+            first = position
+        last = (tradeid, row["time"], position, first)
+        key = (tradeid, row["amount/balance unit"])
+        entry = (parseTime(row["time"]), first)
+        if not key in times:
+            times[key] = []
+        if not entry in times[key]:
+            times[key].append(entry)
+    return times
+
+
+def matchRows(fillrows, times):
+    """
+    Yields a sort key (time, unmatched, position) and the row for each fill.
+    A fill is matched to the trade with entries for both its base and quote currencies under its trade id, at the same
+    position (see accountTimes), so that a trade of another product with the same trade id is never taken for it.
+    A fill whose trade is missing from the accounts statement keeps its own "created at" time, with a warning.
+    """
+    for position, row in fillrows:
+        base, quote = row["product"].split("-")
+        quoteentries = times.get((row["trade id"], quote), ())
+        found = None
+        for entry in times.get((row["trade id"], base), ()):
+            if entry in quoteentries:
+                found = entry
+                break
+        if found is not None:
+            yield (found[0], 0, found[1]), row
+        else:
+            logger.warning(
+                "Trade id %s (%s) is not in the accounts statement, using the fill's time",
+                row["trade id"],
+                row["product"],
+            )
+            yield (parseTime(row["created at"]), 1, position), row
+
+
+def joinStatements(fillspaths, accountspaths, **kwargs):
+    """
+    Joins fills statements with accounts statements and yields the fills ordered by the accounts' times,
+    as cryptotax.Fill, ready for CryptoTax.processFills. Takes the same arguments as joinedRows.
+    """
+    for row in joinedRows(fillspaths, accountspaths, **kwargs):
+        yield cryptotax.Fill(row)
+
+
+def writeFills(fillspaths, accountspaths, path, **kwargs):
+    """
+    Joins fills statements with accounts statements and writes the modified fills csv to path, which CryptoTax
+    can read like one made in Excel. Takes the same arguments as joinedRows.
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=FILLS_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        for row in joinedRows(fillspaths, accountspaths, **kwargs):
+            writer.writerow(row)
+
+
+def joinedRows(
+    fillspaths,
+    accountspaths,
+    memorybytes=JOIN_MEMORY_BYTES,
+    runrows=SORT_RUN_ROWS,
+    tmpdir=None,
+):
+    """
+    Joins fills statements with accounts statements on trade id and yields the rows of the modified fills csv,
+    ordered by the accounts' times.
+    fillspaths and accountspaths can each be one path or a list of paths.
+    Memory use is bounded by memorybytes of accounts statement per partition and runrows fills per sorted run.
+    """
+    npartitions = 1 + statementSize(accountspaths) // memorybytes
+    with tempfile.TemporaryDirectory(dir=tmpdir) as tmp:
+        if npartitions == 1:
+            partitions = [
+                (enumerate(readStatement(accountspaths)), enumerate(readStatement(fillspaths)))
+            ]
+        else:
+            logger.info("Joining the statements in %s partitions", npartitions)
+            partitions = partitionStatements(fillspaths, accountspaths, npartitions, tmp)
+
+        runs = []
+        buffer = []
+        for accountrows, fillrows in partitions:
+            times = accountTimes(accountrows)
+            for key, row in matchRows(fillrows, times):
+                buffer.append((key, row))
+                if len(buffer) >= runrows:
+                    runs.append(writeRun(buffer, tmp, len(runs)))
+                    buffer = []
+            del times
+        if not runs:
+            buffer.sort(key=lambda keyrow: keyrow[0])
+            merged = iter(buffer)
+        else:
+            if buffer:
+                runs.append(writeRun(buffer, tmp, len(runs)))
+                buffer = []
+            logger.info("Merging %s sorted runs", len(runs))
+            merged = heapq.merge(*[readRun(path) for path in runs], key=lambda keyrow: keyrow[0])
+        for key, row in merged:
+            yield modifiedRow(key[0], row)
+
+
+def partitionStatements(fillspaths, accountspaths, npartitions, tmp):
+    """
+    Splits both statements into npartitions temporary files each by trade id, so that all the rows of a trade end up in
+    the same partition. Row positions are kept. Yields (accountrows, fillrows) for each partition in turn.
+    """
+    for name, paths, columns in (
+        ("accounts", accountspaths, ACCOUNT_COLUMNS),
+        ("fills", fillspaths, RAW_FILL_COLUMNS),
+    ):
+        files = [
+            open(os.path.join(tmp, "{0}{1}.csv".format(name, n)), "w", newline="")
+            for n in range(npartitions)
+        ]
+        writers = [csv.writer(f) for f in files]
+        for position, row in enumerate(readStatement(paths)):
+            writers[partitionOf(row["trade id"], npartitions)].writerow(
+                [position] + [row[c] for c in columns]
+            )
+        for f in files:
+            f.close()
+
+    def partitionRows(name, n, columns):
+        with open(os.path.join(tmp, "{0}{1}.csv".format(name, n)), newline="") as f:
+            for values in csv.reader(f):
+                yield int(values[0]), dict(zip(columns, values[1:]))
+
+    for n in range(npartitions):
+        yield (
+            partitionRows("accounts", n, ACCOUNT_COLUMNS),
+            partitionRows("fills", n, RAW_FILL_COLUMNS),
+        )
+
+
+def writeRun(buffer, tmp, n):
+    # Sorts the buffer and writes it to a temporary file, returning its path
+    buffer.sort(key=lambda keyrow: keyrow[0])
+    path = os.path.join(tmp, "run{0}.csv".format(n))
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        for (t, unmatched, position), row in buffer:
+            writer.writerow([repr(t), unmatched, position] + [row[c] for c in RAW_FILL_COLUMNS])
+    return path
+
+
+def readRun(path):
+    with open(path, newline="") as f:
+        for values in csv.reader(f):
+            yield (float(values[0]), int(values[1]), int(values[2])), dict(
+                zip(RAW_FILL_COLUMNS, values[3:])
+            )
+
+
+def modifiedRow(timestamp, row):
+    """
+    Adds the columns of the modified fills csv to a fills statement row, given the time of its trade:
+    accttime, timestamp, and the UTC date as yyyy, mm, dd.
+    """
+    t = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    row["accttime"] = t.strftime("%Y-%m-%dT%H:%M:%S.") + "{0:03d}Z".format(
+        t.microsecond // 1000
+    )
+    row["timestamp"] = repr(timestamp)
+    row["yyyy"] = str(t.year)
+    row["mm"] = str(t.month)
+    row["dd"] = str(t.day)
+    return row
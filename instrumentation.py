@@ -0,0 +1,68 @@
+# Counters and timings for a CryptoTax run, to see where the time goes on large fills files.
+import collections
+import contextlib
+import time
+
+
+class Instrumentation:
+    """
+    counters counts events by name (fills processed, lots scanned, cache hits, ...).
+    phasetimes adds up the seconds spent in each phase of a run (parse, price resolution, FIFO, write).
+    Phases can be timed with the phase() context manager, or by adding to phasetimes directly in hot loops.
+    """
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.phasetimes = collections.defaultdict(float)
+        self.maxima = {}
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def maximum(self, name, value):
+        # Keeps the largest value seen under name
+        if value > self.maxima.get(name, value - 1):
+            self.maxima[name] = value
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phasetimes[name] += time.perf_counter() - t
+
+    def timedIter(self, iterable, name):
+        """
+        Yields from iterable, adding the time spent producing each item to the phase name.
+        """
+        iterator = iter(iterable)
+        phasetimes = self.phasetimes
+        while True:
+            t = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                phasetimes[name] += time.perf_counter() - t
+                return
+            phasetimes[name] += time.perf_counter() - t
+            yield item
+
+    def report(self):
+        return {
+            "phases": dict(self.phasetimes),
+            "counters": dict(self.counters),
+            "maxima": dict(self.maxima),
+        }
+
+
+def formatReport(report):
+    # Human-readable version of a report dict, as returned by Instrumentation.report
+    lines = ["Timing by phase (s):"]
+    for name, seconds in report["phases"].items():
+        lines.append("  {0:<30} {1:10.3f}".format(name, seconds))
+    lines.append("Counters:")
+    for name, n in sorted(report["counters"].items()):
+        lines.append("  {0:<30} {1:>10}".format(name, n))
+    for name, n in sorted(report.get("maxima", {}).items()):
+        lines.append("  {0:<30} {1:>10}".format(name, n))
+    return "\n".join(lines)
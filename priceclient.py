@@ -0,0 +1,178 @@
+# A client for Coinbase Pro's historic rates endpoint that can have several requests in flight at once,
+# while staying under the API's request limit.
+# It has the same get_product_historic_rates method as the cbpro clients, so it can be used in their place.
+import concurrent.futures
+import logging
+import multiprocessing
+import threading
+import time
+
+import requests
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Rate limiter. Tokens are added at rate per second, up to burst tokens. Every request takes a token,
+    waiting for one if there are none. Can be shared between threads.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Waits until a token is available and takes it. Returns the time spent waiting, in seconds.
+        """
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return waited
+                wait = (1.0 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def tryTake(self):
+        # Takes a token if one is available, without waiting. Returns whether it did.
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1.0:
+                self.tokens -= 1.0
+                return True
+            return False
+
+
+class SharedTokenBucket:
+    """
+    TokenBucket that can be shared between processes, for workers that together must stay under the API's limit.
+    The tokens and the time they were last topped up are in shared memory. Give it to the worker processes when
+    they are started, eg through a process pool's initializer.
+    time.monotonic is the same clock in every process on the machine.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.state = multiprocessing.Array("d", [burst, time.monotonic()], lock=False)  # tokens, last
+        self.lock = multiprocessing.Lock()
+
+    def take(self):
+        # Same as TokenBucket.take
+        waited = 0.0
+        state = self.state
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                tokens = min(self.burst, state[0] + (now - state[1]) * self.rate)
+                state[1] = now
+                if tokens >= 1.0:
+                    state[0] = tokens - 1.0
+                    return waited
+                state[0] = tokens
+                wait = (1.0 - tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class HistoricRatesClient:
+    """
+    Requests historic rates ("candles") from the public Coinbase Pro API.
+    All requests go through one keep-alive HTTP session and one TokenBucket, whichever thread makes them.
+    A response that isn't a list of candles is an error message. Those caused by too many requests or a server
+    problem (and connection errors) are retried, waiting backoff seconds and doubling that each time.
+    Other error messages are returned as they are, like cbpro does.
+    api_url can point to a local stand-in for the API.
+    """
+    def __init__(
+        self,
+        api_url="https://api.pro.coinbase.com",
+        rate=3.0,
+        burst=3,
+        workers=3,
+        maxretries=5,
+        backoff=1.0,
+        timeout=30,
+        limiter=None,
+    ):
+        self.url = api_url.rstrip("/")
+        self.limiter = limiter if limiter else TokenBucket(rate, burst)
+        self.workers = workers
+        self.maxretries = maxretries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=workers, pool_maxsize=workers
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # Running totals, for reporting
+        self.apicalls = 0
+        self.retries = 0
+        self.sleeptime = 0.0
+        self.countlock = threading.Lock()
+
+    def get_product_historic_rates(self, product_id, start=None, end=None, granularity=None):
+        """
+        Same as cbpro's: start and end are ISO 8601 strings, and a list of [time, low, high, open, close, volume]
+        candles is returned, newest first.
+        """
+        params = {}
+        if start is not None:
+            params["start"] = start
+        if end is not None:
+            params["end"] = end
+        if granularity is not None:
+            params["granularity"] = granularity
+        url = "{0}/products/{1}/candles".format(self.url, product_id)
+        attempt = 0
+        while True:
+            waited = self.limiter.take()
+            retry = False
+            try:
+                r = self.session.get(url, params=params, timeout=self.timeout)
+                try:
+                    info = r.json()
+                except ValueError:
+                    info = {"message": r.text}
+                retry = r.status_code == 429 or r.status_code >= 500
+            except requests.RequestException as e:
+                info = {"message": str(e)}
+                retry = True
+            with self.countlock:
+                self.apicalls += 1
+                self.sleeptime += waited
+            if type(info) == list or not retry or attempt == self.maxretries:
+                return info
+            delay = self.backoff * 2 ** attempt
+            logger.warning(
+                "Retrying historic rates for %s in %ss, we got %s", product_id, delay, info
+            )
+            time.sleep(delay)
+            attempt += 1
+            with self.countlock:
+                self.retries += 1
+                self.sleeptime += delay
+
+    def getManyHistoricRates(self, requestlist):
+        """
+        Makes several historic rates requests at once, from a pool of worker threads.
+        requestlist is a list of (product_id, start, end, granularity).
+        Returns the responses in the same order.
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [
+                pool.submit(self.get_product_historic_rates, pid, start, end, granularity)
+                for pid, start, end, granularity in requestlist
+            ]
+            return [f.result() for f in futures]
@@ -0,0 +1,80 @@
+# PriceIndex holds the USD prices from our fills as sorted NumPy arrays, one pair of arrays per currency,
+# so that the closest price for a whole array of timestamps can be found at once.
+import numpy as np
+
+
+class PriceIndex:
+    """
+    For each currency, times and prices are NumPy arrays sorted by time.
+    Prices at the same time stay in the order they were added, so the results match the bisect search of
+    cryptotax.nearestPrice on the equivalent pricelog.
+    """
+    def __init__(self):
+        self.times = {}
+        self.prices = {}
+
+    @classmethod
+    def fromPricelogs(cls, pricelogs):
+        # pricelogs as made by CryptoTax.readFillsForPrices
+        index = cls()
+        for curr, pricelog in pricelogs.items():
+            index.add(curr, [p[0] for p in pricelog], [p[1] for p in pricelog])
+        return index
+
+    def add(self, curr, times, prices):
+        """
+        Adds prices (in USD) for a currency at the given timestamps. times and prices can be any sequence,
+        including array.array, and don't need to be sorted.
+        """
+        times = np.asarray(times, dtype=np.float64)
+        prices = np.asarray(prices, dtype=np.float64)
+        if curr in self.times:
+            times = np.concatenate((self.times[curr], times))
+            prices = np.concatenate((self.prices[curr], prices))
+        order = np.argsort(times, kind="stable")
+        self.times[curr] = times[order]
+        self.prices[curr] = prices[order]
+
+    def closestPrices(self, curr, timestamps, tolerance=30.0):
+        """
+        Finds the closest price in time to each of the timestamps with a single searchsorted.
+        Returns three arrays the same length as timestamps: the prices, their distance in time (seconds) from
+        the timestamps, and a mask that is True where the closest price is tolerance seconds or more away.
+        Where there is no price at all for the currency, the price is nan and the distance inf.
+        """
+        queries = np.asarray(timestamps, dtype=np.float64)
+        times = self.times.get(curr)
+        if times is None or len(times) == 0:
+            return (
+                np.full(queries.shape, np.nan),
+                np.full(queries.shape, np.inf),
+                np.ones(queries.shape, dtype=bool),
+            )
+        n = len(times)
+        # after is the first price at or after the query time, before is the last price before it
+        after = np.searchsorted(times, queries, side="left")
+        before = after - 1
+        afterclipped = np.minimum(after, n - 1)
+        beforeclipped = np.maximum(before, 0)
+        useafter = (after == 0) | (
+            (after < n)
+            & (
+                np.abs(times[afterclipped] - queries)
+                < np.abs(times[beforeclipped] - queries)
+            )
+        )
+        closest = np.where(useafter, afterclipped, beforeclipped)
+        distances = np.abs(times[closest] - queries)
+        return self.prices[curr][closest], distances, ~(distances < tolerance)
+
+    def nearest(self, curr, timestamp):
+        # The (time, price) closest to timestamp, like cryptotax.nearestPrice, or None if there are no prices for curr
+        times = self.times.get(curr)
+        if times is None or len(times) == 0:
+            return None
+        after = int(np.searchsorted(times, timestamp, side="left"))
+        if after == len(times) or (
+            after > 0 and abs(times[after] - timestamp) >= abs(times[after - 1] - timestamp)
+        ):
+            after -= 1
+        return float(times[after]), float(self.prices[curr][after])
@@ -0,0 +1,318 @@
+# Clients that stand in for the Coinbase API, so that the parts of a run that call it can be tested and profiled
+# without network access or API keys.
+# RecordingClient wraps a real client (a cbpro client or priceclient.HistoricRatesClient) and saves every response
+# of get_products, get_product_historic_rates and get_product_order_book to an archive.
+# ReplayClient answers the same calls from the archive, optionally taking as long as the API did.
+# StandInServer serves an archive over HTTP at the API's paths, with the API's rate limit, for clients that take an
+# api_url, eg priceclient.HistoricRatesClient(api_url=server.url) or cbpro.PublicClient(api_url=server.url).
+#
+# The archive is a gzipped file of JSON lines, one per response:
+# {"method": ..., "product": ..., "params": {...}, "response": ..., "seconds": ...}
+# Recording again to the same archive adds to it.
+#
+# python replayclient.py archive.jsonl.gz --port 8080
+import argparse
+import collections
+import concurrent.futures
+import gzip
+import http.server
+import json
+import logging
+import threading
+import time
+import urllib.parse
+
+import priceclient
+
+logger = logging.getLogger(__name__)
+
+# The public API's limit, requests per second and burst
+PUBLIC_RATE = 3.0
+PUBLIC_BURST = 6
+
+
+def requestKey(method, product=None, params=None):
+    # Identifies a request, the same whether its parameters were given as numbers or as text from a URL
+    params = {name: str(value) for name, value in (params or {}).items() if value is not None}
+    return json.dumps([method, product, params], sort_keys=True)
+
+
+def readArchive(path):
+    """
+    The responses in an archive, as a dict of request key to the list of (response JSON, seconds) recorded for it,
+    in the order they were recorded.
+    """
+    responses = collections.defaultdict(list)
+    with gzip.open(path, "rt") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            key = requestKey(entry["method"], entry.get("product"), entry.get("params"))
+            responses[key].append((json.dumps(entry["response"]), entry.get("seconds", 0.0)))
+    return responses
+
+
+class RecordingClient:
+    """
+    Passes calls on to client, and saves each response with the time it took to the archive at path.
+    Other attributes are the client's, eg apicalls of a HistoricRatesClient.
+    Call close() when done, or use it as a context manager.
+    """
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.file = gzip.open(path, "at")
+        self.lock = threading.Lock()
+        self.recorded = 0
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def record(self, method, product, params, call):
+        t = time.perf_counter()
+        response = call()
+        seconds = time.perf_counter() - t
+        entry = {
+            "method": method,
+            "product": product,
+            "params": {name: value for name, value in params.items() if value is not None},
+            "response": response,
+            "seconds": round(seconds, 4),
+        }
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.recorded += 1
+        return response
+
+    def get_products(self):
+        return self.record("get_products", None, {}, self.client.get_products)
+
+    def get_product_historic_rates(self, product_id, start=None, end=None, granularity=None):
+        return self.record(
+            "get_product_historic_rates",
+            product_id,
+            {"start": start, "end": end, "granularity": granularity},
+            lambda: self.client.get_product_historic_rates(
+                product_id, start=start, end=end, granularity=granularity
+            ),
+        )
+
+    def get_product_order_book(self, product_id, level=1):
+        return self.record(
+            "get_product_order_book",
+            product_id,
+            {"level": level},
+            lambda: self.client.get_product_order_book(product_id, level=level),
+        )
+
+    def getManyHistoricRates(self, requestlist):
+        # As many at once as the client would make itself (its requests are still limited by the client)
+        workers = getattr(self.client, "workers", 1)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [
+                pool.submit(self.get_product_historic_rates, pid, start, end, granularity)
+                for pid, start, end, granularity in requestlist
+            ]
+            return [f.result() for f in futures]
+
+    def close(self):
+        self.file.close()
+        logger.info("Recorded %s responses to %s", self.recorded, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ReplayClient:
+    """
+    Answers get_products, get_product_historic_rates and get_product_order_book from an archive, in place of the
+    cbpro clients and priceclient.HistoricRatesClient.
+    A request recorded more than once gets its responses in the order they were recorded, starting over after the
+    last, so a series of order books plays back as a series.
+    A request that isn't in the archive gets an error message, the way the API answers with one.
+    Each call takes latency seconds, or as long as it did when recorded if latency is None, times scale.
+    limiter (eg a priceclient.TokenBucket) makes requests wait for the API's rate limit too.
+    Like HistoricRatesClient, it counts apicalls and sleeptime, and getManyHistoricRates makes workers requests at once.
+    """
+    def __init__(self, path, latency=None, scale=1.0, limiter=None, workers=3):
+        self.path = path
+        self.responses = readArchive(path)
+        self.latency = latency
+        self.scale = scale
+        self.limiter = limiter
+        self.workers = workers
+        self.next = collections.Counter()
+        self.lock = threading.Lock()
+        self.apicalls = 0
+        self.retries = 0
+        self.misses = 0
+        self.sleeptime = 0.0
+
+    def respond(self, method, product=None, params=None):
+        waited = self.limiter.take() if self.limiter else 0.0
+        key = requestKey(method, product, params)
+        with self.lock:
+            self.apicalls += 1
+            self.sleeptime += waited
+            recorded = self.responses.get(key)
+            if recorded:
+                text, seconds = recorded[self.next[key] % len(recorded)]
+                self.next[key] += 1
+            else:
+                self.misses += 1
+        if not recorded:
+            logger.warning("No recorded response for %s", key)
+            return {"message": "No recorded response for " + key}
+        delay = (seconds if self.latency is None else self.latency) * self.scale
+        if delay > 0:
+            time.sleep(delay)
+        # parsed again every time, so that a caller changing a response doesn't change the archive
+        return json.loads(text)
+
+    def get_products(self):
+        return self.respond("get_products")
+
+    def get_product_historic_rates(self, product_id, start=None, end=None, granularity=None):
+        return self.respond(
+            "get_product_historic_rates",
+            product_id,
+            {"start": start, "end": end, "granularity": granularity},
+        )
+
+    def get_product_order_book(self, product_id, level=1):
+        return self.respond("get_product_order_book", product_id, {"level": level})
+
+    def getManyHistoricRates(self, requestlist):
+        # Same as HistoricRatesClient.getManyHistoricRates
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as pool:
+            futures = [
+                pool.submit(self.get_product_historic_rates, pid, start, end, granularity)
+                for pid, start, end, granularity in requestlist
+            ]
+            return [f.result() for f in futures]
+
+
+class StandInHandler(http.server.BaseHTTPRequestHandler):
+    # Answers GET /products, /products/<id>/candles and /products/<id>/book from the server's ReplayClient
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        params = dict(urllib.parse.parse_qsl(url.query))
+        parts = [part for part in url.path.split("/") if part]
+        with server.countlock:
+            server.requests += 1
+        if not server.limiter.tryTake():
+            with server.countlock:
+                server.ratelimited += 1
+            self.reply(429, {"message": "Public rate limit exceeded"})
+            return
+        if parts == ["products"]:
+            response = server.client.get_products()
+        elif len(parts) == 3 and parts[0] == "products" and parts[2] == "candles":
+            response = server.client.get_product_historic_rates(
+                parts[1], params.get("start"), params.get("end"), params.get("granularity")
+            )
+        elif len(parts) == 3 and parts[0] == "products" and parts[2] == "book":
+            response = server.client.get_product_order_book(parts[1], params.get("level", 1))
+        else:
+            self.reply(404, {"message": "NotFound"})
+            return
+        if type(response) == dict and list(response) == ["message"]:
+            self.reply(404, response)
+        else:
+            self.reply(200, response)
+
+    def reply(self, status, response):
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class StandInServer:
+    """
+    Local HTTP server for an archive, at the API's paths. Requests beyond rate per second (after a burst) are
+    answered with 429, like the API does, rather than made to wait.
+    Responses take latency seconds, or as long as they did when recorded if latency is None, times scale.
+    port 0 picks a free port. Use start() and stop(), or use it as a context manager; url is its address.
+    """
+    def __init__(
+        self,
+        archivepath,
+        host="127.0.0.1",
+        port=0,
+        rate=PUBLIC_RATE,
+        burst=PUBLIC_BURST,
+        latency=0.0,
+        scale=1.0,
+    ):
+        self.httpd = http.server.ThreadingHTTPServer((host, port), StandInHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.client = ReplayClient(archivepath, latency=latency, scale=scale)
+        self.httpd.limiter = priceclient.TokenBucket(rate, burst)
+        self.httpd.requests = 0
+        self.httpd.ratelimited = 0
+        self.httpd.countlock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return "http://{0}:{1}".format(host, port)
+
+    @property
+    def requests(self):
+        return self.httpd.requests
+
+    @property
+    def ratelimited(self):
+        return self.httpd.ratelimited
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve a recorded archive in place of the Coinbase API.")
+    parser.add_argument("archive")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--rate", type=float, default=PUBLIC_RATE)
+    parser.add_argument("--burst", type=int, default=PUBLIC_BURST)
+    parser.add_argument("--latency", type=float, default=None, help="seconds per response, recorded times if not given")
+    parser.add_argument("--scale", type=float, default=1.0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    server = StandInServer(
+        args.archive, args.host, args.port, args.rate, args.burst, args.latency, args.scale
+    )
+    logger.info("Serving %s at %s", args.archive, server.url)
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.httpd.server_close()
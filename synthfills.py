@@ -0,0 +1,204 @@
+# Makes made-up but realistic modified fills csvs (see README.md), for trying out and benchmarking CryptoTax on
+# histories much bigger than the example.
+# The same arguments and seed always make the same file.
+#
+# Trades are one of:
+#   buying a currency with USD, in one fill or split into several smaller fills ("fragmentation"), which makes many lots
+#   selling a currency for USD
+#   a triangle: USD to a currency, that currency to BTC, and BTC back to USD, within a couple of seconds, so the
+#   crypto-to-crypto fill has USD prices close by
+#   a lone crypto-to-crypto trade, with no USD fill of the currency procured close by ("price gap"), so its price has
+#   to come from the API
+# The fills never sell more than has been bought.
+import argparse
+import csv
+import datetime
+import random
+
+import cryptotax
+import ingest
+
+# Seconds since the epoch when the generated fills start, 2019-01-01 UTC
+START_TIME = 1546300800
+
+DEFAULT_CURRENCIES = ["BTC", "ETH", "LTC", "XTZ", "EOS", "XLM", "BCH", "ETC", "ZRX", "DASH"]
+
+FEE_RATE = 0.005
+
+
+def amountStr(amount, decimals=8):
+    # Fixed decimals, without trailing zeros, the way Coinbase writes amounts
+    text = "{0:.{1}f}".format(amount, decimals).rstrip("0").rstrip(".")
+    return text if text not in ("", "-0") else "0"
+
+
+class FillsGenerator:
+    """
+    Writes fills one trade at a time. Prices of every currency in USD follow a random walk.
+    holdings is how much of each currency the fills so far have left us with.
+    """
+    def __init__(self, writer, currencies, seed):
+        self.writer = writer
+        self.random = random.Random(seed)
+        self.currencies = list(currencies)
+        if not "BTC" in self.currencies:
+            self.currencies.insert(0, "BTC")
+        self.prices = {}
+        for curr in self.currencies:
+            self.prices[curr] = 8000.0 if curr == "BTC" else self.random.uniform(0.5, 300.0)
+        self.holdings = {curr: 0.0 for curr in self.currencies}
+        self.time = float(START_TIME)
+        self.tradeid = 100000000
+        self.rows = 0
+
+    def step(self, seconds):
+        self.time += seconds
+        for curr in self.currencies:
+            self.prices[curr] *= 1.0 + self.random.gauss(0.0, 0.0005) * min(seconds, 3600) ** 0.5
+
+    def writeFill(self, product, side, size, price, pricedecimals):
+        base, quote = product.split("-")
+        value = size * price
+        fee = value * FEE_RATE
+        if side == "BUY":
+            total = -(value + fee)
+            self.holdings[base] += size
+            if quote != "USD":
+                self.holdings[quote] += total
+        else:
+            total = value - fee
+            self.holdings[base] -= size
+            if quote != "USD":
+                self.holdings[quote] += total
+        t = datetime.datetime.fromtimestamp(self.time, datetime.timezone.utc)
+        isotime = t.strftime("%Y-%m-%dT%H:%M:%S.") + "{0:03d}Z".format(t.microsecond // 1000)
+        self.tradeid += self.random.randint(1, 50)
+        decimals = 6 if quote == "USD" else 8
+        self.writer.writerow(
+            {
+                "portfolio": "default",
+                "trade id": str(self.tradeid),
+                "product": product,
+                "side": side,
+                "created at": isotime,
+                "size": amountStr(size),
+                "size unit": base,
+                "price": amountStr(price, pricedecimals),
+                "fee": amountStr(fee, decimals),
+                "total": amountStr(total, decimals),
+                "price/fee/total unit": quote,
+                "accttime": isotime,
+                "timestamp": repr(round(self.time, 3)),
+                "yyyy": str(t.year),
+                "mm": str(t.month),
+                "dd": str(t.day),
+            }
+        )
+        self.rows += 1
+
+    def usdBuy(self, curr, usd, fragments):
+        price = round(self.prices[curr], 2)
+        for n in range(fragments):
+            size = round(usd / fragments / price, 8)
+            if size > 0:
+                self.writeFill(curr + "-USD", "BUY", size, price, 2)
+            self.step(self.random.choice([0.0, 0.2, 1.0]))
+
+    def usdSell(self, curr, share):
+        size = round(self.holdings[curr] * share, 8)
+        if size > 0:
+            self.writeFill(curr + "-USD", "SELL", size, round(self.prices[curr], 2), 2)
+
+    def cryptoTrade(self, curr, share):
+        """
+        A curr-BTC trade: buying curr with some of our BTC, or selling some of our curr for BTC.
+        """
+        price = round(self.prices[curr] / self.prices["BTC"], 8)
+        if price <= 0:
+            return
+        if self.random.random() < 0.5 and self.holdings["BTC"] > 0:
+            size = round(self.holdings["BTC"] * share / price / (1 + FEE_RATE), 8)
+            if size > 0:
+                self.writeFill(curr + "-BTC", "BUY", size, price, 8)
+        else:
+            size = round(self.holdings[curr] * share, 8)
+            if size > 0:
+                self.writeFill(curr + "-BTC", "SELL", size, price, 8)
+
+    def triangle(self, curr, usd):
+        # USD -> curr -> BTC -> USD, a second or so apart
+        self.usdBuy(curr, usd, 1)
+        self.step(self.random.uniform(0.1, 1.0))
+        before = self.holdings["BTC"]
+        size = round(self.holdings[curr] * 0.5, 8)
+        price = round(self.prices[curr] / self.prices["BTC"], 8)
+        if size > 0 and price > 0:
+            self.writeFill(curr + "-BTC", "SELL", size, price, 8)
+        self.step(self.random.uniform(0.1, 1.0))
+        gained = round(self.holdings["BTC"] - before, 8)
+        if gained > 0:
+            self.writeFill("BTC-USD", "SELL", gained, round(self.prices["BTC"], 2), 2)
+
+
+def generateFills(
+    path,
+    rows=10000,
+    currencies=DEFAULT_CURRENCIES,
+    triangleshare=0.3,
+    fragmentation=1,
+    pricegapshare=0.02,
+    seed=0,
+):
+    """
+    Writes a modified fills csv of about rows fills to path.
+    currencies are the currencies traded (BTC is always one of them, as the crypto quote currency).
+    triangleshare is the share of trades that are triangles, pricegapshare the share that are lone crypto-to-crypto
+    trades with no USD price close by. The rest are USD buys and sells.
+    Each USD buy is split into up to fragmentation fills.
+    """
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=ingest.FILLS_COLUMNS)
+        writer.writeheader()
+        g = FillsGenerator(writer, currencies, seed)
+        r = g.random
+        # start with something to sell
+        for curr in g.currencies:
+            g.usdBuy(curr, 20000.0, 1)
+        while g.rows < rows:
+            g.step(r.expovariate(1.0 / 120.0))
+            curr = r.choice(g.currencies[1:]) if len(g.currencies) > 1 else "BTC"
+            k = r.random()
+            if k < triangleshare and curr != "BTC":
+                g.triangle(curr, r.uniform(50.0, 2000.0))
+            elif k < triangleshare + pricegapshare and curr != "BTC":
+                # far enough from the last fill that no USD price is close by
+                g.step(2 * cryptotax.PRICE_TOLERANCE + r.uniform(0.0, 600.0))
+                g.cryptoTrade(curr, r.uniform(0.05, 0.5))
+                g.step(2 * cryptotax.PRICE_TOLERANCE)
+            elif k < (1.0 + triangleshare + pricegapshare) / 2:
+                g.usdBuy(curr, r.uniform(10.0, 5000.0), r.randint(1, max(1, fragmentation)))
+            else:
+                g.usdSell(curr, r.uniform(0.05, 0.6))
+    return g.rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a made-up modified fills csv.")
+    parser.add_argument("path")
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--currencies", default=",".join(DEFAULT_CURRENCIES))
+    parser.add_argument("--triangleshare", type=float, default=0.3)
+    parser.add_argument("--fragmentation", type=int, default=1)
+    parser.add_argument("--pricegapshare", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    n = generateFills(
+        args.path,
+        rows=args.rows,
+        currencies=args.currencies.split(","),
+        triangleshare=args.triangleshare,
+        fragmentation=args.fragmentation,
+        pricegapshare=args.pricegapshare,
+        seed=args.seed,
+    )
+    print("Wrote {0} fills to {1}".format(n, args.path))
@@ -0,0 +1,14 @@
+import os
+import sys
+
+import pytest
+
+# The modules are at the top of the repository
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+
+@pytest.fixture
+def samplefills():
+    # The example fills csv that comes with the repository
+    return os.path.join(REPO, "example_fills_data", "fills_2019.csv")
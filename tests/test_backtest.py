@@ -0,0 +1,62 @@
+import datetime
+import gzip
+import json
+import random
+
+import numpy as np
+
+import backtest
+
+START = datetime.datetime(2019, 8, 31, 12, tzinfo=datetime.timezone.utc).timestamp()
+PRODUCTS = ["BTC-USD", "ETH-USD", "ETH-BTC"]
+
+
+def writeFeed(path, days=3, updates=3000):
+    r = random.Random(1)
+    with gzip.open(path, "wt") as f:
+        for pid in PRODUCTS:
+            bids = [["{0:.2f}".format(99.0 - k * 0.01), "1.0"] for k in range(20)]
+            asks = [["{0:.2f}".format(101.0 + k * 0.01), "1.0"] for k in range(20)]
+            f.write(json.dumps({"type": "snapshot", "product_id": pid, "bids": bids, "asks": asks}) + "\n")
+        for k in range(updates):
+            t = datetime.datetime.fromtimestamp(START + k * days * 86400.0 / updates, datetime.timezone.utc)
+            side = r.choice(["buy", "sell"])
+            price = 99.0 - r.randint(0, 30) * 0.01 if side == "buy" else 101.0 + r.randint(0, 30) * 0.01
+            size = "0" if r.random() < 0.3 else "{0:.4f}".format(r.uniform(0.1, 2.0))
+            f.write(
+                json.dumps(
+                    {
+                        "type": "l2update",
+                        "product_id": r.choice(PRODUCTS),
+                        "time": t.strftime("%Y-%m-%dT%H:%M:%S.%fZ"),
+                        "changes": [[side, "{0:.2f}".format(price), size]],
+                    }
+                )
+                + "\n"
+            )
+
+
+def books(replay):
+    return {pid: (dict(replay.mirror.bids[pid]), dict(replay.mirror.asks[pid])) for pid in replay.productids}
+
+
+def test_day_tasks_warm_up_from_the_day_snapshots(tmp_path):
+    feed = str(tmp_path / "feed.jsonl.gz")
+    eventspath = str(tmp_path / "events.npy")
+    writeFeed(feed)
+    backtest.convertMessages(feed, eventspath)
+    events, meta = backtest.loadEvents(eventspath)
+    assert np.all(np.diff(events["time"]) >= 0)
+
+    tasks = backtest.dayTasks(eventspath)
+    assert len(tasks) == 4
+    for start, end, evaluatefrom, productids in tasks[1:]:
+        # the warm-up is only the snapshots added at the end of the day before
+        warmup = events[start : int(np.searchsorted(events["time"], evaluatefrom))]
+        assert np.count_nonzero(warmup["kind"] == backtest.RESET) == len(PRODUCTS)
+        assert not np.any(warmup["time"] < evaluatefrom - 1.0)
+        day = backtest.Replay(events[start:end], meta, [])
+        day.run()
+        whole = backtest.Replay(events[:end], meta, [])
+        whole.run()
+        assert books(day) == books(whole)
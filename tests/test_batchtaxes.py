@@ -0,0 +1,37 @@
+import csv
+import os
+
+import batchtaxes
+
+
+def usdFills(samplefills, path):
+    # The sample's fills up to its first of a product not quoted in USD, which need no historical prices
+    with open(samplefills, newline="", encoding="utf-8-sig") as f:
+        rows = list(csv.reader(f))
+    n = next(n for n, row in enumerate(rows) if n and not row[2].endswith("-USD"))
+    with open(path, "w", newline="") as f:
+        csv.writer(f).writerows(rows[:n])
+
+
+def test_failed_account_leaves_no_output(samplefills, tmp_path):
+    # Offline and without cross rates, the sample's ETH-BTC fills have no price for BTC, part way through
+    outputpath = str(tmp_path / "8949.csv")
+    result = batchtaxes.runAccount(
+        "a", samplefills, outputpath, str(tmp_path / "candles.sqlite"), offline=True, fixedpoint=False
+    )
+    assert not result["ok"]
+    assert result["transactions"] > 0
+    assert os.listdir(tmp_path) == ["candles.sqlite"]
+
+
+def test_account_output(samplefills, tmp_path):
+    fillspath = str(tmp_path / "fills.csv")
+    usdFills(samplefills, fillspath)
+    outputpath = str(tmp_path / "8949.csv")
+    result = batchtaxes.runAccount(
+        "a", fillspath, outputpath, str(tmp_path / "candles.sqlite"), offline=True, fixedpoint=False
+    )
+    assert result["ok"]
+    assert not os.path.exists(outputpath + ".tmp")
+    with open(outputpath, newline="") as f:
+        assert len(list(csv.DictReader(f))) == result["transactions"] > 0
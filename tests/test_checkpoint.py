@@ -0,0 +1,80 @@
+import json
+import os
+
+import pytest
+
+import cryptotax
+import synthfills
+
+
+def transactionKeys(transactions):
+    return [
+        (t["description"], t["dateacquired"], t["datesold"], t["proceeds"], t["cost"], t["gain"])
+        for t in transactions
+    ]
+
+
+def newCryptoTax(fixedpoint=False):
+    # Offline, with cross rates, the sample's prices all come from its own fills
+    return cryptotax.CryptoTax(offline=True, crossrates=True, fixedpoint=fixedpoint)
+
+
+@pytest.mark.parametrize("fixedpoint", [False, True])
+def test_appended_runs_match_a_full_run(samplefills, tmp_path, fixedpoint):
+    full = newCryptoTax(fixedpoint)
+    full.readFills(samplefills)
+
+    with open(samplefills, "rb") as f:
+        lines = f.read().splitlines(keepends=True)
+    header, rows = lines[0], lines[1:]
+    partpath = str(tmp_path / "fills.csv")
+    checkpointpath = str(tmp_path / "checkpoint.json")
+    cuts = [20, 57, 58, 110, 160, len(rows)]
+    transactions = []
+    start = 0
+    for n, cut in enumerate(cuts):
+        with open(partpath, "ab") as f:
+            if start == 0:
+                f.write(header)
+            f.writelines(rows[start:cut])
+        start = cut
+        ct = newCryptoTax(fixedpoint)
+        ct.readFills(partpath, checkpointpath, final=n == len(cuts) - 1)
+        transactions.extend(ct.transactions)
+        with open(checkpointpath) as f:
+            saved = json.load(f)
+        assert saved["transactioncount"] == ct.transactioncount == len(transactions)
+
+    assert transactionKeys(transactions) == transactionKeys(full.transactions)
+
+
+def test_resume_without_new_fills_adds_nothing(samplefills, tmp_path):
+    checkpointpath = str(tmp_path / "checkpoint.json")
+    first = newCryptoTax()
+    first.readFills(samplefills, checkpointpath)
+    again = newCryptoTax()
+    again.readFills(samplefills, checkpointpath)
+    assert again.transactions == []
+    assert again.transactioncount == first.transactioncount
+    assert os.path.exists(checkpointpath)
+
+
+def test_resume_refused_after_an_edit_in_the_middle(tmp_path):
+    # Big enough that the middle is far from both the start of the file and the checkpoint's position
+    fillspath = str(tmp_path / "fills.csv")
+    synthfills.generateFills(fillspath, rows=2000, pricegapshare=0.0)
+    checkpointpath = str(tmp_path / "checkpoint.json")
+    newCryptoTax().readFills(fillspath, checkpointpath)
+    with open(checkpointpath) as f:
+        offset = json.load(f)["offset"]
+    with open(fillspath, "rb") as f:
+        data = f.read()
+    assert offset > 4 * 65536
+    # change one digit of a row half way through what the checkpoint has read, keeping the file's length
+    middle = data.index(b"\n", offset // 2) + 1
+    digit = next(n for n in range(middle, offset) if data[n : n + 1].isdigit())
+    edited = data[:digit] + (b"1" if data[digit : digit + 1] != b"1" else b"2") + data[digit + 1 :]
+    with open(fillspath, "wb") as f:
+        f.write(edited)
+    with pytest.raises(Exception, match="doesn't match checkpoint"):
+        newCryptoTax().readFills(fillspath, checkpointpath)
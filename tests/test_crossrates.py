@@ -0,0 +1,35 @@
+import crossrates
+
+
+def pricesAt(entries):
+    # A nearest function for CrossRates over {key: (time away, price)}
+    def nearest(key, t):
+        if not key in entries:
+            return None
+        away, price = entries[key]
+        return t + away, price
+
+    return nearest
+
+
+def test_fewer_hops_through_a_currency_reached_cheaper_with_more():
+    # XXX is closest in time through BBB (2 hops), but only the direct AAA-XXX (1 hop) leaves room to reach USD
+    entries = {
+        "AAA-BBB": (1.0, 2.0),
+        "BBB-XXX": (1.0, 2.0),
+        "AAA-XXX": (10.0, 2.0),
+        "XXX-YYY": (1.0, 2.0),
+        "YYY": (1.0, 2.0),
+    }
+    resolver = crossrates.CrossRates(30.0, maxhops=3)
+    derived = resolver.derivePrice("AAA", 1000.0, entries.keys(), pricesAt(entries))
+    assert derived == (8.0, ["AAA-XXX", "XXX-YYY", "YYY-USD"])
+
+
+def test_graph_follows_the_keys_given():
+    resolver = crossrates.CrossRates(30.0)
+    first = {"AAA-BBB": (1.0, 2.0), "BBB": (1.0, 3.0)}
+    assert resolver.derivePrice("AAA", 0.0, first.keys(), pricesAt(first)) == (6.0, ["AAA-BBB", "BBB-USD"])
+    # as many keys, but other ones
+    second = {"AAA-CCC": (1.0, 2.0), "CCC": (1.0, 5.0)}
+    assert resolver.derivePrice("AAA", 0.0, second.keys(), pricesAt(second)) == (10.0, ["AAA-CCC", "CCC-USD"])
@@ -0,0 +1,27 @@
+import shutil
+
+import pytest
+
+import cryptotax
+
+
+@pytest.mark.parametrize("crossrates", [False, True])
+def test_price_passes_from_the_cache_columns(samplefills, tmp_path, crossrates):
+    fillspath = str(tmp_path / "fills.csv")
+    shutil.copy(samplefills, fillspath)
+    plain = cryptotax.CryptoTax(offline=True, crossrates=crossrates)
+    cached = cryptotax.CryptoTax(offline=True, crossrates=crossrates, fillcache=True)
+    assert cached.readFillsForPrices(fillspath) == plain.readFillsForPrices(fillspath)
+    assert cached.planPriceFetches(fillspath) == plain.planPriceFetches(fillspath)
+
+
+def test_two_pass_run_from_the_cache(samplefills, tmp_path):
+    fillspath = str(tmp_path / "fills.csv")
+    shutil.copy(samplefills, fillspath)
+    runs = []
+    for fillcache in (False, True, True):
+        ct = cryptotax.CryptoTax(offline=True, crossrates=True, fillcache=fillcache)
+        ct.readFillsForGains(fillspath, ct.readFillsForPrices(fillspath))
+        # the Fill of each transaction is a different object in each run
+        runs.append([{k: v for k, v in t.items() if k != "row"} for t in ct.transactions])
+    assert runs[0] == runs[1] == runs[2]
@@ -0,0 +1,78 @@
+import csv
+import logging
+
+import pytest
+
+import cryptotax
+import transactionsinks
+
+
+def test_sample_has_no_shortfall_in_fixed_point(samplefills, caplog):
+    ct = cryptotax.CryptoTax(offline=True, crossrates=True, fixedpoint=True)
+    with caplog.at_level(logging.WARNING, logger="cryptotax"):
+        ct.readFills(samplefills)
+    assert not [r for r in caplog.records if "no holdings left" in r.getMessage()]
+    assert ct.sizedigits["BTC"] == 9
+
+    floating = cryptotax.CryptoTax(offline=True, crossrates=True)
+    floating.readFills(samplefills)
+    assert len(ct.transactions) == len(floating.transactions)
+    for fixed, other in zip(ct.transactions, floating.transactions):
+        proceeds = transactionsinks.toCents(fixed["proceeds"]) / 100
+        assert proceeds == pytest.approx(other["proceeds"], abs=0.01)
+
+
+def test_toFixed_is_exact_or_raises():
+    assert cryptotax.toFixed("-0.001039663", 9) == -1039663
+    assert cryptotax.toFixed("1.50000000000", 2) == 150
+    assert cryptotax.toFixed("2e-8", 8) == 2
+    with pytest.raises(Exception):
+        cryptotax.toFixed("0.001039663", 8)
+    with pytest.raises(Exception):
+        cryptotax.toFixed("1.5e-9", 8)
+
+
+def test_toFixed_range():
+    assert cryptotax.toFixed("9223372036.854775807", 9) == cryptotax.FIXED_MAX
+    assert cryptotax.toFixed("0.000", 8) == 0
+    with pytest.raises(Exception, match="too big"):
+        cryptotax.toFixed("9223372036.854775808", 9)
+    with pytest.raises(Exception, match="too big"):
+        cryptotax.toFixed("1e999999999", 8)
+    with pytest.raises(Exception, match="more than 8 decimals"):
+        cryptotax.toFixed("1e-999999999", 8)
+    with pytest.raises(Exception, match="not a number"):
+        cryptotax.toFixed("nan", 8)
+
+
+def test_usdValue_is_exact():
+    ct = cryptotax.CryptoTax(offline=True, fixedpoint=True)
+    # more units than a float holds exactly
+    assert ct.usdValue("BTC", 0.5, 123456789012345678) == 617283945061728390
+    with pytest.raises(Exception, match="doesn't fit"):
+        ct.usdValue("BTC", 1e6, 10**15)
+
+
+def writeFills(samplefills, path, rows, **changes):
+    # The first rows of the sample, with changes to the columns of the last one
+    with open(samplefills, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        fills = [row for row, n in zip(reader, range(rows))]
+    fills[-1].update(changes)
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=reader.fieldnames)
+        writer.writeheader()
+        writer.writerows(fills)
+
+
+@pytest.mark.parametrize(
+    "size, error",
+    [("100000000000.5", "too big"), ("0.0000000000000000001", "more than 18 decimals")],
+)
+def test_unrepresentable_size_names_the_fill(samplefills, tmp_path, size, error):
+    fillspath = str(tmp_path / "fills.csv")
+    writeFills(samplefills, fillspath, 2, **{"size": size, "trade id": "12345"})
+    ct = cryptotax.CryptoTax(offline=True, crossrates=True, fixedpoint=True)
+    with pytest.raises(Exception, match=error) as raised:
+        ct.readFills(fillspath)
+    assert "BTC-USD" in str(raised.value) and "'12345'" in str(raised.value)
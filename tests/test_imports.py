@@ -0,0 +1,24 @@
+import subprocess
+import sys
+
+from conftest import REPO
+
+
+def test_importing_cryptotax_leaves_out_numpy_and_the_api_modules():
+    # Those are only imported once a run needs them, so short runs start quickly
+    code = (
+        "import sys, cryptotax; "
+        "print(' '.join(m for m in ('numpy', 'coinutil', 'cbpro', 'priceclient') if m in sys.modules))"
+    )
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=REPO, capture_output=True, text=True, check=True
+    ).stdout
+    assert output.strip() == ""
+
+
+def test_importing_coinutil_leaves_out_numpy():
+    code = "import sys, coinutil; print('numpy' in sys.modules)"
+    output = subprocess.run(
+        [sys.executable, "-c", code], cwd=REPO, capture_output=True, text=True, check=True
+    ).stdout
+    assert output.strip() == "False"
@@ -0,0 +1,47 @@
+import csv
+
+import pytest
+
+import ingest
+
+ACCOUNTS_COLUMNS = [
+    "portfolio", "type", "time", "amount", "balance", "amount/balance unit", "transfer id", "trade id", "order id"
+]
+
+
+def writeCsv(path, columns, rows):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(dict(zip(columns, row)))
+
+
+@pytest.mark.parametrize("memorybytes", [ingest.JOIN_MEMORY_BYTES, 1])
+def test_same_trade_id_in_two_products(tmp_path, memorybytes):
+    # Trade 100 of ETH-BTC and trade 100 of BTC-USD both change BTC, the ETH-BTC one first
+    accountspath = str(tmp_path / "account.csv")
+    writeCsv(accountspath, ACCOUNTS_COLUMNS, [
+        ["default", "match", "2019-09-01T10:00:00.100Z", "1", "1", "ETH", "", "100", "a"],
+        ["default", "match", "2019-09-01T10:00:00.100Z", "-0.02", "0.98", "BTC", "", "100", "a"],
+        ["default", "fee", "2019-09-01T10:00:00.100Z", "-0.0001", "0.9799", "BTC", "", "100", "a"],
+        ["default", "match", "2019-09-01T10:00:05.200Z", "-0.5", "0.4799", "BTC", "", "100", "b"],
+        ["default", "match", "2019-09-01T10:00:05.200Z", "5000", "5000", "USD", "", "100", "b"],
+        ["default", "match", "2019-09-01T10:00:07.300Z", "0.1", "0.5799", "BTC", "", "101", "c"],
+        ["default", "match", "2019-09-01T10:00:07.300Z", "-1000", "4000", "USD", "", "101", "c"],
+    ])
+    fillspath = str(tmp_path / "fills.csv")
+    writeCsv(fillspath, ingest.RAW_FILL_COLUMNS, [
+        ["default", "100", "BTC-USD", "SELL", "2019-09-01T10:00:05.100Z", "0.5", "BTC", "10000", "0", "5000", "USD"],
+        ["default", "100", "ETH-BTC", "BUY", "2019-09-01T10:00:00.050Z", "1", "ETH", "0.02", "0.0001", "-0.0201", "BTC"],
+        ["default", "101", "BTC-USD", "BUY", "2019-09-01T10:00:07.200Z", "0.1", "BTC", "10000", "0", "-1000", "USD"],
+        # a trade of a product the accounts statement has no entries of, though BTC has entries under its trade id
+        ["default", "101", "LTC-BTC", "BUY", "2019-09-01T10:00:09.000Z", "1", "LTC", "0.01", "0", "-0.01", "BTC"],
+    ])
+    rows = list(ingest.joinedRows(fillspath, accountspath, memorybytes=memorybytes))
+    assert [(row["product"], row["accttime"]) for row in rows] == [
+        ("ETH-BTC", "2019-09-01T10:00:00.100Z"),
+        ("BTC-USD", "2019-09-01T10:00:05.200Z"),
+        ("BTC-USD", "2019-09-01T10:00:07.300Z"),
+        ("LTC-BTC", "2019-09-01T10:00:09.000Z"),
+    ]
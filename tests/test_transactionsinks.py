@@ -0,0 +1,13 @@
+import pytest
+
+import cryptotax
+import transactionsinks
+
+
+def test_writeTransactions_refuses_when_sinks_keep_nothing(samplefills, tmp_path):
+    totals = transactionsinks.ScheduleDTotals()
+    ct = cryptotax.CryptoTax(offline=True, crossrates=True, sinks=[totals])
+    ct.readFills(samplefills)
+    assert ct.transactions == []
+    with pytest.raises(Exception):
+        ct.writeTransactions(str(tmp_path / "transactions.csv"))
@@ -0,0 +1,45 @@
+import datetime
+import types
+
+import pytest
+
+import transactionsinks
+import transactionstore
+
+
+def transaction(sold, lots, proceeds, scale):
+    # lots are (size, usdbasis, date acquired), amounts in dollars, times scale
+    row = types.SimpleNamespace(
+        day=sold.toordinal(), side="SELL", basecurrency="ETH", quotecurrency="USD"
+    )
+    proceeds *= scale
+    holdinglist = [(size, basis * scale, day.toordinal()) for size, basis, day in lots]
+    cost = sum(basis for size, basis, day in holdinglist)
+    return {"row": row, "holdinglist": holdinglist, "proceeds": proceeds, "cost": cost, "gain": proceeds - cost}
+
+
+@pytest.mark.parametrize("fixedpoint", [False, True])
+def test_box_totals_split_mixed_transactions_like_termTotals(fixedpoint):
+    sold = datetime.date(2021, 3, 1)
+    old = datetime.date(2019, 6, 1)
+    recent = datetime.date(2021, 1, 5)
+    scale = 10 ** transactionsinks.USD_DIGITS if fixedpoint else 1
+    store = transactionstore.TransactionStore.fromTransactions(
+        [
+            transaction(sold, [(1, 100, old)], 300, scale),
+            transaction(sold, [(1, 50, recent)], 80, scale),
+            transaction(sold, [(3, 120, old), (1, 60, recent)], 400, scale),
+        ],
+        fixedpoint,
+    )
+    boxes = {row["box"]: row for row in store.groupBy("box")}
+    assert sorted(boxes) == ["C", "F"]
+    totals = store.termTotals()
+    for term in ("short", "long"):
+        box = boxes[totals[term]["box"]]
+        for name in ("count", "proceeds", "cost", "gain"):
+            assert box[name] == totals[term][name]
+    assert boxes["F"]["proceeds"] == 300 + 300
+    assert boxes["C"]["cost"] == 50 + 60
+    bycurrency = store.groupBy("box", "currency")
+    assert [(row["box"], row["currency"], row["count"]) for row in bycurrency] == [("C", "ETH", 2), ("F", "ETH", 2)]
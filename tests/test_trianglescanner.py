@@ -0,0 +1,68 @@
+import math
+
+import coinutil
+import trianglescanner
+
+MIDS = {"BTC-USD": 10000.0, "ETH-USD": 200.0, "ETH-BTC": 0.0201}
+
+
+def book(mid):
+    levels = range(1, 20)
+    return {
+        "bids": [[str(mid * (1 - 0.001 * k)), "3.0"] for k in levels],
+        "asks": [[str(mid * (1 + 0.001 * k)), "3.0"] for k in levels],
+        "sequence": 1,
+    }
+
+
+class ProductsClient:
+    def get_products(self):
+        return [
+            {
+                "id": pid,
+                "post_only": False,
+                "limit_only": False,
+                "cancel_only": False,
+                "trading_disabled": False,
+                "status": "online",
+                "quote_increment": "0.01",
+                "base_increment": "0.0001",
+            }
+            for pid in MIDS
+        ]
+
+    def get_product_order_book(self, pid, level=2):
+        return book(MIDS[pid])
+
+
+def newScanner():
+    mi = coinutil.MarketInfo(ProductsClient(), None)
+    return trianglescanner.TriangleScanner(mi, sizes=[100.0, 1000.0], workers=1)
+
+
+def test_round_trips_match_the_helpers():
+    scanner = newScanner()
+    books = {pid: book(mid) for pid, mid in MIDS.items()}
+    result = scanner.scan(books)
+    scanner.close()
+    assert result["ranked"]
+    for entry in result["ranked"]:
+        for size, value in zip([100.0, 1000.0], entry["returns"].tolist()):
+            amount = size
+            for pa in reversed(entry["triangle"].tri):
+                if pa.action == "buy":
+                    amount = coinutil.estimateMarketBuyFilledSize(scanner.mi, pa.trueid, amount, books[pa.trueid])
+                else:
+                    amount = coinutil.estimateMarketSellExecutedValue(scanner.mi, pa.trueid, amount, books[pa.trueid])
+                amount *= 1.0 - scanner.fee
+            assert math.isclose(value, amount / size - 1.0, rel_tol=1e-12)
+
+
+def test_missing_book_on_any_leg_comes_back_nan():
+    scanner = newScanner()
+    for missing in MIDS:
+        books = {pid: book(mid) for pid, mid in MIDS.items() if pid != missing}
+        result = scanner.scan(books)
+        for entry in result["ranked"]:
+            assert math.isnan(entry["bestreturn"])
+    scanner.close()
@@ -0,0 +1,207 @@
+# Sinks receive the transactions (disposals) from CryptoTax one at a time as they are made, so that a run with
+# millions of them doesn't have to hold them all in memory.
+# A sink is any object with an add(transaction) method and a close() method. transaction is the dict made by
+# CryptoTax.processFill: description, dateacquired, datesold, proceeds, cost, gain, row (the Fill) and holdinglist
+# (the lots pulled, as (size, usdbasis, day)), and for crypto-to-crypto fills, pricesource (see CryptoTax.resolvePrice).
+# In fixed-point mode the amounts are scaled integers (see CryptoTax).
+import csv
+import datetime
+import json
+
+# The columns of the transactions csv, essentially those of form 8949
+FORM_8949_COLUMNS = ["description", "dateacquired", "datesold", "proceeds", "cost", "gain"]
+
+# In fixed-point mode, USD amounts are whole numbers of 10**-USD_DIGITS dollars (nano-dollars), enough for the
+# USD totals in Coinbase's fills, which have up to 9 decimals
+USD_DIGITS = 9
+
+
+def toCents(amount):
+    # A fixed-point USD amount rounded to whole cents, half away from zero
+    unit = 10 ** (USD_DIGITS - 2)
+    cents = (abs(amount) + unit // 2) // unit
+    return -cents if amount < 0 else cents
+
+
+def formatCents(cents):
+    # eg 123457 as 1234.57
+    return "{0}{1}.{2:02d}".format("-" if cents < 0 else "", abs(cents) // 100, abs(cents) % 100)
+
+
+def centsRow(transaction):
+    """
+    A fixed-point transaction with proceeds, cost and gain as dollars and cents.
+    Proceeds and cost are rounded, and gain is the difference of the rounded amounts, so the row adds up.
+    """
+    proceeds = toCents(transaction["proceeds"])
+    cost = toCents(transaction["cost"])
+    return dict(
+        transaction,
+        proceeds=formatCents(proceeds),
+        cost=formatCents(cost),
+        gain=formatCents(proceeds - cost),
+    )
+
+
+def isLongTerm(acquiredday, soldday):
+    """
+    True if an asset acquired on acquiredday and sold on soldday (date ordinals) was held for more than one year,
+    which makes the gain or loss long-term.
+    """
+    acquired = datetime.date.fromordinal(acquiredday)
+    try:
+        anniversary = acquired.replace(year=acquired.year + 1)
+    except ValueError:
+        anniversary = datetime.date(acquired.year + 1, 2, 28)  # acquired on February 29th
+    return soldday > anniversary.toordinal()
+
+
+def splitByTerm(transaction, fixedpoint=False):
+    """
+    Splits a transaction's proceeds and cost into short-term and long-term.
+    Returns a dict of term ("short" or "long") to (proceeds, cost), with one entry, or two if the transaction pulled
+    lots of both terms ("mixed"). Then each term gets the cost of its own lots, and the share of the proceeds that
+    its lots make up of the size disposed of.
+    """
+    soldday = transaction["row"].day
+    size = {"short": 0, "long": 0}
+    cost = {"short": 0, "long": 0}
+    for lotsize, usdbasis, day in transaction["holdinglist"]:
+        term = "long" if isLongTerm(day, soldday) else "short"
+        size[term] += lotsize
+        cost[term] += usdbasis
+    proceeds = transaction["proceeds"]
+    if size["long"] == 0:
+        return {"short": (proceeds, cost["short"])}
+    if size["short"] == 0:
+        return {"long": (proceeds, cost["long"])}
+    totalsize = size["short"] + size["long"]
+    if fixedpoint:
+        longproceeds = proceeds * size["long"] // totalsize
+    else:
+        longproceeds = proceeds * size["long"] / totalsize
+    return {
+        "short": (proceeds - longproceeds, cost["short"]),
+        "long": (longproceeds, cost["long"]),
+    }
+
+
+class ListSink:
+    """
+    Keeps every transaction in a list, as CryptoTax always used to (see CryptoTax.transactions).
+    """
+    def __init__(self, transactions=None):
+        self.transactions = transactions if transactions is not None else []
+
+    def add(self, transaction):
+        self.transactions.append(transaction)
+
+    def close(self):
+        pass
+
+
+class Form8949Writer:
+    """
+    Writes each transaction to a csv as it comes, in the format of CryptoTax.writeTransactions.
+    In fixed-point mode, amounts are rounded to cents here.
+    """
+    def __init__(self, path, fixedpoint=False):
+        self.fixedpoint = fixedpoint
+        self.file = open(path, "w", newline="")
+        self.writer = csv.DictWriter(
+            self.file, fieldnames=FORM_8949_COLUMNS, extrasaction="ignore"
+        )
+        self.writer.writeheader()
+
+    def add(self, transaction):
+        if self.fixedpoint:
+            transaction = centsRow(transaction)
+        self.writer.writerow(transaction)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ScheduleDTotals:
+    """
+    Running totals of proceeds, cost and gain for short-term and long-term transactions, as they go on Schedule D.
+    A transaction that pulled lots of both terms ("mixed") is split between them (see splitByTerm).
+    If path is given, the totals are written there as JSON on close.
+    """
+    def __init__(self, path=None, fixedpoint=False):
+        self.path = path
+        self.fixedpoint = fixedpoint
+        zero = 0 if fixedpoint else 0.0
+        self.totals = {
+            term: {"count": 0, "proceeds": zero, "cost": zero, "gain": zero}
+            for term in ("short", "long")
+        }
+        self.mixed = 0
+
+    def add(self, transaction):
+        terms = splitByTerm(transaction, self.fixedpoint)
+        if len(terms) == 2:
+            self.mixed += 1
+        for term, (proceeds, cost) in terms.items():
+            totals = self.totals[term]
+            totals["count"] += 1
+            totals["proceeds"] += proceeds
+            totals["cost"] += cost
+            totals["gain"] += proceeds - cost
+
+    def report(self):
+        # The totals in dollars, rounded to cents
+        report = {"mixed": self.mixed}
+        for term, totals in self.totals.items():
+            report[term] = {"count": totals["count"]}
+            for name in ("proceeds", "cost", "gain"):
+                amount = totals[name]
+                if self.fixedpoint:
+                    report[term][name] = toCents(amount) / 100
+                else:
+                    report[term][name] = round(amount, 2)
+        return report
+
+    def close(self):
+        if self.path is not None:
+            with open(self.path, "w") as f:
+                json.dump(self.report(), f, indent=2)
+
+
+class AuditLog:
+    """
+    Writes one JSON line per transaction, with the fill it came from and every lot pulled, so that any line of the
+    8949 can be traced back to the trades behind it.
+    """
+    def __init__(self, path):
+        self.file = open(path, "w")
+
+    def add(self, transaction):
+        fill = transaction["row"]
+        entry = {
+            "description": transaction["description"],
+            "dateacquired": transaction["dateacquired"],
+            "datesold": transaction["datesold"],
+            "proceeds": transaction["proceeds"],
+            "cost": transaction["cost"],
+            "gain": transaction["gain"],
+            "tradeid": fill.tradeid,
+            "product": fill.product,
+            "side": fill.side,
+            "timestamp": fill.timestamp,
+            "pricesource": transaction.get("pricesource"),
+            "lots": [
+                [size, usdbasis, datetime.date.fromordinal(day).isoformat()]
+                for size, usdbasis, day in transaction["holdinglist"]
+            ],
+        }
+        self.file.write(json.dumps(entry) + "\n")
+
+    def close(self):
+        self.file.close()
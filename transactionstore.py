@@ -0,0 +1,248 @@
+# TransactionStore keeps the transactions of a run as typed columns (one array per field) instead of a list of dicts,
+# so that totals by term, currency, month or 8949 box can be added up with NumPy instead of rescanning the list.
+# It is a sink (see transactionsinks.py), so it can be filled while CryptoTax runs, and it can be saved to a file
+# and loaded again to make reports without running again.
+import array
+import datetime
+
+import numpy as np
+
+import transactionsinks
+
+# Holding period flags
+SHORT = 0
+LONG = 1
+MIXED = 2
+TERMS = ["short", "long", "mixed"]
+
+# The form 8949 box for short and long-term transactions. There is no Form 1099-B for these, so they are boxes C and F.
+BOXES = {SHORT: "C", LONG: "F"}
+
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+
+class TransactionStore:
+    """
+    Columns, one entry per transaction:
+    soldday and acquiredday are date ordinals (acquiredday is the oldest lot's), and various is 1 where the lots were
+    acquired on more than one day.
+    currency is the code of the currency disposed of, an index into currencies.
+    term is SHORT, LONG or MIXED. longproceeds and longcost are the long-term part of proceeds and cost (see
+    transactionsinks.splitByTerm), so short and long-term totals are exact for mixed transactions too.
+    proceeds, cost, gain, longproceeds and longcost are floats, or 64-bit integers of 10**-USD_DIGITS dollars in fixed-point mode (see transactionsinks.USD_DIGITS).
+    """
+    amountcolumns = ["proceeds", "cost", "gain", "longproceeds", "longcost"]
+
+    def __init__(self, fixedpoint=False):
+        self.fixedpoint = fixedpoint
+        self.currencies = []
+        self.currencycodes = {}
+        amounttype = "q" if fixedpoint else "d"
+        self.columns = {
+            "soldday": array.array("l"),
+            "acquiredday": array.array("l"),
+            "various": array.array("b"),
+            "currency": array.array("h"),
+            "term": array.array("b"),
+        }
+        for name in self.amountcolumns:
+            self.columns[name] = array.array(amounttype)
+
+    def __len__(self):
+        return len(self.columns["soldday"])
+
+    @classmethod
+    def fromTransactions(cls, transactions, fixedpoint=False):
+        # Store for a list of transactions, eg CryptoTax.transactions after a run
+        store = cls(fixedpoint)
+        for transaction in transactions:
+            store.add(transaction)
+        return store
+
+    def currencyCode(self, curr):
+        code = self.currencycodes.get(curr)
+        if code is None:
+            code = len(self.currencies)
+            self.currencies.append(curr)
+            self.currencycodes[curr] = code
+        return code
+
+    def add(self, transaction):
+        fill = transaction["row"]
+        holdinglist = transaction["holdinglist"]
+        # BUY disposes of the quote currency, SELL of the base currency
+        curr = fill.quotecurrency if fill.side == "BUY" else fill.basecurrency
+        terms = transactionsinks.splitByTerm(transaction, self.fixedpoint)
+        if len(terms) == 2:
+            term = MIXED
+        elif "long" in terms:
+            term = LONG
+        else:
+            term = SHORT
+        longproceeds, longcost = terms.get("long", (0, 0))
+        firstday = holdinglist[0][2]
+        columns = self.columns
+        columns["soldday"].append(fill.day)
+        columns["acquiredday"].append(firstday)
+        columns["various"].append(any(lot[2] != firstday for lot in holdinglist))
+        columns["currency"].append(self.currencyCode(curr))
+        columns["term"].append(term)
+        columns["proceeds"].append(transaction["proceeds"])
+        columns["cost"].append(transaction["cost"])
+        columns["gain"].append(transaction["gain"])
+        columns["longproceeds"].append(longproceeds)
+        columns["longcost"].append(longcost)
+
+    def close(self):
+        pass
+
+    def array(self, name):
+        # A column as a NumPy array, without copying it
+        column = self.columns[name]
+        return np.frombuffer(column, dtype=column.typecode) if len(column) else np.zeros(0, dtype=column.typecode)
+
+    def keyArray(self, key, terms=None):
+        """
+        The values to group by for a key: "term", "box", "currency", "year" or "month" (of the date sold),
+        as an array of codes, and a function that turns a code into its label.
+        For "box", terms are the terms of the transactions with the mixed ones split (see splitMixed).
+        """
+        if key == "term":
+            return self.array("term"), lambda code: TERMS[code]
+        if key == "box":
+            return terms if terms is not None else self.array("term"), lambda code: BOXES[code]
+        if key == "currency":
+            return self.array("currency"), lambda code: self.currencies[code]
+        days = (self.array("soldday") - EPOCH_ORDINAL).astype("datetime64[D]")
+        if key == "year":
+            return days.astype("datetime64[Y]").astype(np.int64) + 1970, int
+        if key == "month":
+            return days.astype("datetime64[M]").astype(np.int64), lambda code: str(
+                np.datetime64(int(code), "M")
+            )
+        raise ValueError("Can't group transactions by {0}".format(key))
+
+    def splitMixed(self):
+        """
+        The transactions with each mixed one split in two, its short-term part and its long-term part, as they go in
+        boxes C and F (see termTotals). Returns the index of the transaction of each part, the term of each part
+        (SHORT or LONG), and a dict of the proceeds, cost and gain of each part.
+        """
+        term = self.array("term")
+        mixed = np.flatnonzero(term == MIXED)
+        longproceeds = self.array("longproceeds")[mixed]
+        longcost = self.array("longcost")[mixed]
+        proceeds = self.array("proceeds").copy()
+        cost = self.array("cost").copy()
+        gain = self.array("gain").copy()
+        proceeds[mixed] -= longproceeds
+        cost[mixed] -= longcost
+        gain[mixed] = proceeds[mixed] - cost[mixed]
+        rows = np.concatenate((np.arange(len(term)), mixed))
+        terms = np.concatenate((np.where(term == MIXED, SHORT, term), np.full(len(mixed), LONG, dtype=term.dtype)))
+        amounts = {
+            "proceeds": np.concatenate((proceeds, longproceeds)),
+            "cost": np.concatenate((cost, longcost)),
+            "gain": np.concatenate((gain, longproceeds - longcost)),
+        }
+        return rows, terms, amounts
+
+    def groupBy(self, *keys):
+        """
+        Sums of proceeds, cost and gain, and the number of transactions, for each combination of the keys
+        (see keyArray), eg groupBy("currency", "month").
+        Grouped by "box", a mixed transaction is split between boxes C and F, and counted in both, the same as in
+        termTotals.
+        Returns a list of dicts, one per group, in order of the keys.
+        """
+        if "box" in keys:
+            rows, terms, amounts = self.splitMixed()
+        else:
+            rows = None
+            terms = None
+            amounts = {name: self.array(name) for name in ("proceeds", "cost", "gain")}
+        n = len(self) if rows is None else len(rows)
+        keyarrays = []
+        labels = []
+        for key in keys:
+            codes, label = self.keyArray(key, terms)
+            if rows is not None and key != "box":
+                codes = codes[rows]
+            keyarrays.append(codes.astype(np.int64))
+            labels.append(label)
+        if keys:
+            groups, inverse = np.unique(
+                np.stack(keyarrays, axis=1), axis=0, return_inverse=True
+            )
+            inverse = inverse.reshape(-1)
+        else:
+            groups = np.zeros((1 if n else 0, 0), dtype=np.int64)
+            inverse = np.zeros(n, dtype=np.int64)
+        ngroups = len(groups)
+        sums = {name: self.groupSums(values, inverse, ngroups) for name, values in amounts.items()}
+        counts = np.bincount(inverse, minlength=ngroups)
+        rows = []
+        for g in range(ngroups):
+            row = {key: labels[k](groups[g, k]) for k, key in enumerate(keys)}
+            row["count"] = int(counts[g])
+            for name, values in sums.items():
+                row[name] = self.dollars(values[g])
+            rows.append(row)
+        return rows
+
+    def groupSums(self, values, inverse, ngroups):
+        if self.fixedpoint:
+            # exact integer sums, which bincount's float weights wouldn't be
+            sums = np.zeros(ngroups, dtype=np.int64)
+            np.add.at(sums, inverse, values)
+            return sums
+        return np.bincount(inverse, weights=values, minlength=ngroups)
+
+    def termTotals(self):
+        """
+        Short and long-term totals as they go on Schedule D (boxes C and F of form 8949), with mixed transactions
+        split between them and counted in both, the same as transactionsinks.ScheduleDTotals.
+        """
+        term = self.array("term")
+        mixed = term == MIXED
+        longproceeds = self.array("longproceeds").sum()
+        longcost = self.array("longcost").sum()
+        parts = {
+            SHORT: (self.array("proceeds").sum() - longproceeds, self.array("cost").sum() - longcost),
+            LONG: (longproceeds, longcost),
+        }
+        totals = {"mixed": int(np.count_nonzero(mixed))}
+        for t, (proceeds, cost) in parts.items():
+            totals[TERMS[t]] = {
+                "box": BOXES[t],
+                "count": int(np.count_nonzero((term == t) | mixed)),
+                "proceeds": self.dollars(proceeds),
+                "cost": self.dollars(cost),
+                "gain": self.dollars(proceeds - cost),
+            }
+        return totals
+
+    def dollars(self, amount):
+        # An amount from the columns in dollars, rounded to cents
+        if self.fixedpoint:
+            return transactionsinks.toCents(int(amount)) / 100
+        return round(float(amount), 2)
+
+    def save(self, path):
+        # Saves the columns to a NumPy .npz file
+        np.savez(
+            path,
+            currencies=np.array(self.currencies, dtype=str),
+            fixedpoint=np.array(self.fixedpoint),
+            **{name: self.array(name) for name in self.columns}
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            store = cls(bool(data["fixedpoint"]))
+            for curr in data["currencies"].tolist():
+                store.currencyCode(curr)
+            for name, column in store.columns.items():
+                column.frombytes(data[name].astype(column.typecode).tobytes())
+        return store
@@ -0,0 +1,163 @@
+# TriangleScanner works out the round-trip return of every usdtriangle of a MarketInfo at once, from one order book
+# per product, for several notional sizes, and ranks the triangles by it.
+# A usdtriangle such as "USD-ETH ETH-BTC BTC-USD" is traded back to front (see coinutil.ProductAction): USD to BTC,
+# BTC to ETH, then ETH back to USD. Each leg is a market order on the leg's product, a buy (spending the quote currency)
+# or a sell (spending the base currency) as its action says, and pays the taker fee out of what it gets.
+#
+# The books are fetched at the same time from a pool of threads, through coinutil.getOrderBook, so a MarketInfo with a
+# book mirror (see bookmirror.py) is scanned without any requests. Books can also be passed in.
+import concurrent.futures
+import logging
+import time
+
+import numpy as np
+
+import coinutil
+
+logger = logging.getLogger(__name__)
+
+# Coinbase Pro's taker fee, as a fraction of each order
+DEFAULT_TAKER_FEE = 0.005
+
+DEFAULT_SIZES = [100.0, 500.0, 1000.0, 5000.0, 10000.0]
+
+
+class TriangleScanner:
+    """
+    Scans the triangles of mi for the notional sizes (in USD) with a taker fee of fee (a fraction) on each leg.
+    Only triangles whose products are all OK right now are scanned (see MarketInfo.okTriangles).
+    Call close() when done, to stop the threads that fetch books.
+    """
+    def __init__(self, mi, sizes=DEFAULT_SIZES, fee=DEFAULT_TAKER_FEE, workers=8):
+        self.mi = mi
+        self.sizes = np.asarray(sizes, dtype=np.float64)
+        self.fee = fee
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.planned = None  # (the cycle keys planned for, the plan)
+        self.scans = 0
+
+    def close(self):
+        self.pool.shutdown()
+
+    def fetchBooks(self, productids):
+        # The book of each product, as a coinutil.OrderBookSnapshot, all fetched at once. A product whose book
+        # couldn't be had is left out.
+        books = {}
+        if self.mi.bookmirror is not None:
+            # those in the mirror take no time, so aren't worth handing to a thread
+            for pid in productids:
+                snapshot = self.mi.bookmirror.snapshot(pid)
+                if snapshot is not None:
+                    books[pid] = snapshot
+        futures = {
+            pid: self.pool.submit(coinutil.getOrderBook, self.mi, pid)
+            for pid in productids
+            if pid not in books
+        }
+        for pid, future in futures.items():
+            try:
+                book = future.result()
+                if not isinstance(book, coinutil.OrderBookSnapshot):
+                    book = coinutil.OrderBookSnapshot(book)
+                books[pid] = book
+            except Exception as e:
+                logger.warning("No book for %s: %s", pid, e)
+        return books
+
+    def plan(self, triangles):
+        """
+        For each of the three legs, in the order they are traded, groups the triangles by the product and action of
+        that leg, so each group can be done with one call on the product's book.
+        Returns the list of legs, each a list of (trueid, action, indices of the triangles).
+        """
+        keys = tuple(tri.cycleKey() for tri in triangles)
+        if self.planned is not None and self.planned[0] == keys:
+            return self.planned[1]
+        legs = []
+        for leg in (2, 1, 0):
+            groups = {}
+            for n, tri in enumerate(triangles):
+                pa = tri.tri[leg]
+                groups.setdefault((pa.trueid, pa.action), []).append(n)
+            legs.append(
+                [(pid, action, np.array(indices)) for (pid, action), indices in groups.items()]
+            )
+        self.planned = (keys, legs)
+        return legs
+
+    def roundTrips(self, triangles, books):
+        """
+        What each of the sizes in USD comes back as after going around each triangle, as an array of one row per
+        triangle and one column per size. A triangle with a product not in books comes back as nan.
+        """
+        amounts = np.tile(self.sizes, (len(triangles), 1))
+        missing = np.zeros(len(triangles), dtype=bool)
+        keep = 1.0 - self.fee
+        for groups in self.plan(triangles):
+            for pid, action, indices in groups:
+                book = books.get(pid)
+                if book is None:
+                    # the later legs would walk a book with nan, and come back with a number
+                    missing[indices] = True
+                elif action == "buy":
+                    amounts[indices] = book.filledSize(amounts[indices]) * keep
+                else:
+                    amounts[indices] = book.executedValue(amounts[indices]) * keep
+        amounts[missing] = np.nan
+        return amounts
+
+    def scan(self, books=None):
+        """
+        Scans every OK triangle, fetching the books of their products unless books (product id to book or
+        OrderBookSnapshot) is given.
+        Returns a dict with the ranked triangles, best return first, each a dict of the triangle, its returns for
+        each size (as fractions, after fees), and the best size and return; and the seconds taken to get the books
+        ("fetchseconds") and to work out the returns from them ("computeseconds"), and "latency", from the last book
+        arriving to the result.
+        """
+        start = time.perf_counter()
+        triangles = self.mi.okTriangles()
+        productids = sorted({pid for tri in triangles for pid in tri.trueids})
+        if books is None:
+            books = self.fetchBooks(productids)
+        else:
+            books = {
+                pid: book if isinstance(book, coinutil.OrderBookSnapshot) else coinutil.OrderBookSnapshot(book)
+                for pid, book in books.items()
+            }
+        fetched = time.perf_counter()
+        returns = self.roundTrips(triangles, books) / self.sizes - 1.0
+        # triangles missing a book rank last
+        bestsize = np.where(np.isnan(returns), -np.inf, returns).argmax(axis=1)
+        best = returns[np.arange(len(triangles)), bestsize]
+        order = np.argsort(np.where(np.isnan(best), np.inf, -best), kind="stable")
+        done = time.perf_counter()
+        ranked = []
+        for n in order.tolist():
+            j = int(bestsize[n])
+            ranked.append(
+                {
+                    "triangle": triangles[n],
+                    "chain": triangles[n].shortIdChain(),
+                    "returns": returns[n],
+                    "bestsize": float(self.sizes[j]),
+                    "bestreturn": float(returns[n, j]),
+                }
+            )
+        self.scans += 1
+        return {
+            "ranked": ranked,
+            "books": len(books),
+            "fetchseconds": fetched - start,
+            "computeseconds": done - fetched,
+            "latency": time.perf_counter() - fetched,
+        }
+
+    def scanRepeatedly(self, count, interval=0.0):
+        # Yields the results of count scans, starting one every interval seconds at most
+        for n in range(count):
+            start = time.monotonic()
+            yield self.scan()
+            wait = interval - (time.monotonic() - start)
+            if wait > 0:
+                time.sleep(wait)